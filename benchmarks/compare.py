@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+"""
+Usage: `python benchmarks/compare.py BASE.json NEW.json`
+
+Compares results of benchmarks/run.py of two commits, using the median of repeated runs of each job.
+Reducer lag is only compared if both were run with --reducer-lag.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import argparse
+import json
+
+# metric -> True if higher is better
+METRICS = [
+    ("elapsed_seconds", False),
+    ("files_per_second", True),
+    ("mb_per_second", True),
+    ("records_per_second", True),
+    ("reducer_lag_seconds", False),
+    ("peak_rss_bytes", False)
+]
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2 == 1:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2
+
+def get_medians(filename):
+    """ returns commit and a dict of (dataset, storage, workers) -> dict of median of each metric that was measured """
+    with open(filename) as f:
+        benchmark = json.load(f)
+    runs = {}
+    for result in benchmark["results"]:
+        runs.setdefault((result["dataset"], result["storage"], result["workers"]), []).append(result)
+    medians = {}
+    for job, results in runs.iteritems():
+        medians[job] = {}
+        for metric, _ in METRICS:
+            values = [result[metric] for result in results if metric in result]
+            if values:
+                medians[job][metric] = median(values)
+    return benchmark["commit"], medians
+
+def main():
+    parser = argparse.ArgumentParser(description="compare results of smr benchmarks of two commits")
+    parser.add_argument("base", help="results of the base commit")
+    parser.add_argument("new", help="results of the commit to compare with it")
+    args = parser.parse_args()
+    base_commit, base = get_medians(args.base)
+    new_commit, new = get_medians(args.new)
+    print("base: {}, new: {}".format(base_commit, new_commit))
+    print("{:<24} {:>7} {:<20} {:>14} {:>14} {:>8}".format("dataset", "workers", "metric", "base", "new", "change"))
+    for job in sorted(set(base) & set(new)):
+        dataset, storage, workers = job
+        for metric, higher_is_better in METRICS:
+            if metric not in base[job] or metric not in new[job]:
+                continue
+            base_value, new_value = base[job][metric], new[job][metric]
+            change = (new_value - base_value) / base_value * 100 if base_value else 0.0
+            better = change > 0 if higher_is_better else change < 0
+            print("{:<24} {:>7} {:<20} {:>14.2f} {:>14.2f} {:>+7.1f}% {}".format("{} ({})".format(dataset, storage), workers, metric,
+                base_value, new_value, change, "" if abs(change) < 5 else ("better" if better else "worse")))
+    for job in sorted(set(base) ^ set(new)):
+        print("{} ({}) with {} workers was only run for {}".format(job[0], job[1], job[2], base_commit if job in base else new_commit))
+
+if __name__ == "__main__":
+    main()
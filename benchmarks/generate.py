@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+"""
+Usage: `python benchmarks/generate.py [--data-dir DIR] [--scale FACTOR] [DATASET ...]`
+
+Generates synthetic datasets that benchmarks/run.py runs jobs on. Datasets are deterministic for a given seed and
+scale, so that results of different commits are comparable. Existing datasets are kept unless they were generated
+with different parameters.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import argparse
+import bisect
+import json
+import os
+import random
+import shutil
+
+DEFAULT_DATA_DIR = "/tmp/smr-benchmarks"
+DEFAULT_SEED = 1
+# number of distinct lines each dataset is composed of, lines are sampled from them to fill files quickly
+LINE_POOL_SIZE = 8192
+MANIFEST = "dataset.json"
+
+# job is the config in benchmarks/jobs that's run on the dataset
+# keys are either uniformly distributed, or follow zipf distribution with exponent zipf_s so that a few keys
+# make up most of the records, like words in text
+DATASETS = {
+    "small-files": {"files": 2000, "file_size": 16 * 1024, "job": "count_keys.py", "keys": 100000},
+    "huge-files": {"files": 4, "file_size": 64 * 1024 * 1024, "job": "count_keys.py", "keys": 100000},
+    "skewed-keys": {"files": 100, "file_size": 512 * 1024, "job": "count_keys.py", "keys": 100000, "zipf_s": 1.2},
+    "high-fanout": {"files": 100, "file_size": 512 * 1024, "job": "count_words.py", "keys": 50000, "zipf_s": 1.0, "words_per_line": 40}
+}
+
+class KeySampler(object):
+    """ samples key indexes from 0 to num_keys - 1, uniformly or with zipf distribution """
+    def __init__(self, rng, num_keys, zipf_s=None):
+        self.rng = rng
+        self.num_keys = num_keys
+        self.cumulative_weights = None
+        if zipf_s is not None:
+            total = 0.0
+            self.cumulative_weights = []
+            for rank in xrange(1, num_keys + 1):
+                total += 1 / rank ** zipf_s
+                self.cumulative_weights.append(total)
+
+    def sample(self):
+        if self.cumulative_weights is None:
+            return self.rng.randrange(self.num_keys)
+        return bisect.bisect_left(self.cumulative_weights, self.rng.random() * self.cumulative_weights[-1])
+
+def get_line_pool(params, seed):
+    rng = random.Random(seed)
+    sampler = KeySampler(rng, params["keys"], params.get("zipf_s"))
+    words_per_line = params.get("words_per_line")
+    lines = []
+    for _ in xrange(LINE_POOL_SIZE):
+        if words_per_line is None:
+            lines.append("k{:07d}\t{}\n".format(sampler.sample(), rng.randrange(1000000)))
+        else:
+            lines.append(" ".join("w{}".format(sampler.sample()) for _ in xrange(words_per_line)) + "\n")
+    return [line.encode("ascii") for line in lines]
+
+def get_dataset_params(name, scale, seed):
+    params = dict(DATASETS[name])
+    # scale total size of datasets, by number of files if there are many of them, by their size otherwise
+    if params["files"] >= 100:
+        params["files"] = max(1, int(params["files"] * scale))
+    else:
+        params["file_size"] = max(1024, int(params["file_size"] * scale))
+    params["seed"] = seed
+    return params
+
+def get_dataset_dir(data_dir, name):
+    return os.path.join(data_dir, name)
+
+def read_manifest(dataset_dir):
+    try:
+        with open(os.path.join(dataset_dir, MANIFEST)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+def generate_dataset(data_dir, name, scale=1.0, seed=DEFAULT_SEED):
+    """ generates dataset unless it already exists with the same parameters, returns its parameters """
+    params = get_dataset_params(name, scale, seed)
+    dataset_dir = get_dataset_dir(data_dir, name)
+    manifest = read_manifest(dataset_dir)
+    if manifest is not None and manifest["params"] == params:
+        return manifest
+    if os.path.exists(dataset_dir):
+        shutil.rmtree(dataset_dir)
+    files_dir = os.path.join(dataset_dir, "files")
+    os.makedirs(files_dir)
+    print("generating {}: {} files of {} bytes...".format(name, params["files"], params["file_size"]))
+    pool = get_line_pool(params, seed)
+    total_size = 0
+    for i in xrange(params["files"]):
+        rng = random.Random(seed * 1000003 + i)
+        size = 0
+        with open(os.path.join(files_dir, "part-{:05d}.txt".format(i)), "wb") as f:
+            while size < params["file_size"]:
+                chunk = b"".join(rng.choice(pool) for _ in xrange(256))
+                f.write(chunk)
+                size += len(chunk)
+        total_size += size
+    manifest = {"name": name, "params": params, "files": params["files"], "bytes": total_size}
+    with open(os.path.join(dataset_dir, MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+def get_files_dir(data_dir, name):
+    return os.path.join(get_dataset_dir(data_dir, name), "files")
+
+def main():
+    parser = argparse.ArgumentParser(description="generate synthetic datasets for smr benchmarks")
+    parser.add_argument("datasets", nargs="*", help="datasets to generate, all of them by default: {}".format(", ".join(sorted(DATASETS))))
+    parser.add_argument("--data-dir", help="directory where datasets are generated", default=DEFAULT_DATA_DIR)
+    parser.add_argument("--scale", type=float, help="multiply size of datasets by this factor", default=1.0)
+    parser.add_argument("--seed", type=int, help="seed of random generator", default=DEFAULT_SEED)
+    args = parser.parse_args()
+    for name in args.datasets:
+        if name not in DATASETS:
+            parser.error("unknown dataset: {}".format(name))
+    for name in args.datasets or sorted(DATASETS):
+        manifest = generate_dataset(args.data_dir, name, args.scale, args.seed)
+        print("{}: {} files, {} bytes in {}".format(name, manifest["files"], manifest["bytes"], get_files_dir(args.data_dir, name)))
+
+if __name__ == "__main__":
+    main()
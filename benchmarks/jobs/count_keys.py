@@ -0,0 +1,24 @@
+#!/usr/bin/env python
+"""
+Benchmark job that counts records of each key in lines of "key<tab>value", one map output record per input line.
+Input is set by benchmarks/run.py in SMR_BENCHMARK_INPUT environment variable.
+"""
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import os
+
+INPUT_DATA = os.environ.get("SMR_BENCHMARK_INPUT", "file:///tmp/smr-benchmarks/small-files/files")
+global_result = {}
+
+def MAP_FUNC(file_name):
+    with open(file_name) as f:
+        for line in f:
+            print(line.split("\t", 1)[0])
+
+def REDUCE_FUNC(key):
+    global_result[key] = global_result.get(key, 0) + 1
+
+def OUTPUT_RESULTS_FUNC():
+    for key, count in sorted(global_result.iteritems()):
+        print("{},{}".format(key, count))
@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+"""
+Benchmark job that counts occurrences of each word, like jobs/common_crawl_words.py without parsing HTML,
+so that mappers output many records for each line of input.
+Input is set by benchmarks/run.py in SMR_BENCHMARK_INPUT environment variable.
+"""
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import os
+
+INPUT_DATA = os.environ.get("SMR_BENCHMARK_INPUT", "file:///tmp/smr-benchmarks/high-fanout/files")
+global_result = {}
+
+def MAP_FUNC(file_name):
+    with open(file_name) as f:
+        for line in f:
+            for word in line.split():
+                print(word)
+
+def REDUCE_FUNC(word):
+    global_result[word] = global_result.get(word, 0) + 1
+
+def OUTPUT_RESULTS_FUNC():
+    for word, count in sorted(global_result.iteritems(), key=lambda x: x[1], reverse=True):
+        print("{},{}".format(word, count))
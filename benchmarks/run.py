@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+"""
+Usage: `python benchmarks/run.py [--workers 1 2 4 8] [--repeat 3] [--scale FACTOR] [--s3] [--reducer-lag] [--output FILE] [DATASET ...]`
+
+Runs benchmark jobs with smr on synthetic datasets from benchmarks/generate.py, at each number of workers,
+and saves throughput and peak memory of each run to a JSON file that benchmarks/compare.py compares
+with results of another commit.
+
+With --reducer-lag, each job is run once more with --trace to measure how long reducers lag behind mappers.
+Tracing slows smr down, so measurements of that run aren't mixed with the timed runs. smr, smr-map and smr-reduce on PATH are used, install the checkout that's being
+measured with `pip install -e .`
+
+With --s3, datasets are uploaded to a local moto_server (`pip install moto[server]`) and read from s3:// uris,
+so that downloads from S3 are measured too. smr is pointed at it with a boto config file in BOTO_CONFIG.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import psutil
+
+from generate import DATASETS, DEFAULT_DATA_DIR, DEFAULT_SEED, generate_dataset, get_files_dir
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+JOBS_DIR = os.path.join(BENCHMARKS_DIR, "jobs")
+RSS_SAMPLE_INTERVAL = 0.05
+S3_BUCKET = "smr-benchmarks"
+BOTO_CONFIG = """[Credentials]
+aws_access_key_id = benchmark
+aws_secret_access_key = benchmark
+s3_host = 127.0.0.1
+s3_port = {port}
+
+[Boto]
+is_secure = False
+
+[s3]
+calling_format = boto.s3.connection.OrdinaryCallingFormat
+"""
+
+def get_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=BENCHMARKS_DIR, stderr=subprocess.PIPE).strip().decode("ascii")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def get_free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+class MotoServer(object):
+    """ moto_server running in background, with datasets uploaded to S3_BUCKET """
+    def __init__(self, temp_dir):
+        self.port = get_free_port()
+        try:
+            self.process = subprocess.Popen(["moto_server", "s3", "-p", str(self.port)], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        except OSError:
+            sys.stderr.write("moto_server not found, install it with `pip install moto[server]`\n")
+            sys.exit(1)
+        self.boto_config = os.path.join(temp_dir, "boto.cfg")
+        with open(self.boto_config, "w") as f:
+            f.write(BOTO_CONFIG.format(port=self.port))
+        self.wait_for_port()
+        self.bucket = self.connect().create_bucket(S3_BUCKET)
+
+    def wait_for_port(self):
+        for _ in xrange(100):
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=1).close()
+                return
+            except socket.error:
+                time.sleep(0.1)
+        sys.stderr.write("moto_server didn't start\n")
+        sys.exit(1)
+
+    def connect(self):
+        from boto.s3.connection import OrdinaryCallingFormat, S3Connection
+        return S3Connection("benchmark", "benchmark", host="127.0.0.1", port=self.port, is_secure=False, calling_format=OrdinaryCallingFormat())
+
+    def upload(self, data_dir, name):
+        """ uploads files of dataset unless they're there already, returns their s3:// uri """
+        files_dir = get_files_dir(data_dir, name)
+        existing = set(key.name for key in self.bucket.list(prefix="{}/".format(name)))
+        for filename in sorted(os.listdir(files_dir)):
+            key_name = "{}/{}".format(name, filename)
+            if key_name not in existing:
+                self.bucket.new_key(key_name).set_contents_from_filename(os.path.join(files_dir, filename))
+        return "s3://{}/{}/".format(S3_BUCKET, name)
+
+    def get_env(self):
+        return {"BOTO_CONFIG": self.boto_config, "AWS_ACCESS_KEY_ID": "benchmark", "AWS_SECRET_ACCESS_KEY": "benchmark"}
+
+    def stop(self):
+        self.process.kill()
+        self.process.wait()
+
+def sample_rss(process, peak):
+    """ updates peak total RSS of process and its children, and peak RSS of a single one of them """
+    try:
+        processes = [process] + process.children(recursive=True)
+    except psutil.Error:
+        return
+    total = 0
+    for p in processes:
+        try:
+            rss = p.memory_info().rss
+        except psutil.Error:
+            continue
+        total += rss
+        peak["max_process_rss_bytes"] = max(peak["max_process_rss_bytes"], rss)
+    peak["peak_rss_bytes"] = max(peak["peak_rss_bytes"], total)
+
+def get_reducer_lag(trace_filename):
+    """
+    returns a tuple of (seconds between the last map and the last write of map output to reducers,
+    total seconds smr was blocked writing map output to reducers) from trace of a job
+    """
+    with open(trace_filename) as f:
+        events = json.load(f)["traceEvents"]
+    map_end = max([event["ts"] + event["dur"] for event in events if event.get("name") == "map" and event["ph"] == "X"] or [0])
+    reduce_spans = [event for event in events if event.get("name") == "reduce-batch" and event["ph"] == "X"]
+    reduce_end = max([event["ts"] + event["dur"] for event in reduce_spans] or [0])
+    return max(0, reduce_end - map_end) / 1000000, sum(event["dur"] for event in reduce_spans) / 1000000
+
+def run_job(name, input_uri, workers, extra_args, temp_dir, env, trace=False):
+    """
+    runs benchmark job of dataset once, returns its results
+    if trace is True, the job is traced and only reducer lag is returned, tracing skews other measurements
+    """
+    run_dir = tempfile.mkdtemp(dir=temp_dir)
+    report_filename = os.path.join(run_dir, "report.json")
+    trace_filename = os.path.join(run_dir, "trace.json")
+    args = ["smr", os.path.join(JOBS_DIR, DATASETS[name]["job"]), "--workers", str(workers), "--no-output-job-progress",
+        "--output-filename", os.path.join(run_dir, "output"), "--report", report_filename] + extra_args
+    if trace:
+        args += ["--trace", trace_filename]
+    job_env = dict(os.environ)
+    job_env.update(env)
+    job_env["SMR_BENCHMARK_INPUT"] = input_uri
+    peak = {"peak_rss_bytes": 0, "max_process_rss_bytes": 0}
+    start_time = time.time()
+    with open(os.path.join(run_dir, "log"), "w") as log:
+        process = subprocess.Popen(args, stdout=log, stderr=subprocess.STDOUT, env=job_env)
+        ps_process = psutil.Process(process.pid)
+        while process.poll() is None:
+            sample_rss(ps_process, peak)
+            time.sleep(RSS_SAMPLE_INTERVAL)
+    elapsed = time.time() - start_time
+    if process.returncode != 0:
+        with open(os.path.join(run_dir, "log")) as log:
+            sys.stderr.write(log.read())
+        sys.stderr.write("benchmark job on {} failed with exit code {}\n".format(name, process.returncode))
+        sys.exit(1)
+
+    if trace:
+        reducer_lag, reduce_write_seconds = get_reducer_lag(trace_filename)
+        shutil.rmtree(run_dir)
+        return {"reducer_lag_seconds": reducer_lag, "reduce_write_seconds": reduce_write_seconds}
+
+    with open(report_filename) as f:
+        report = json.load(f)
+    shutil.rmtree(run_dir)
+    result = {
+        "elapsed_seconds": elapsed,
+        "files": report["files_processed"],
+        "bytes": report["bytes_processed"],
+        "records": report["totals"]["output_records"],
+        "files_per_second": report["files_processed"] / elapsed,
+        "mb_per_second": report["bytes_processed"] / 1024 / 1024 / elapsed,
+        "records_per_second": report["totals"]["output_records"] / elapsed,
+        "map_seconds": report["totals"]["map_seconds"],
+        "download_seconds": report["totals"]["download_seconds"]
+    }
+    result.update(peak)
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="run smr benchmarks on synthetic datasets")
+    parser.add_argument("datasets", nargs="*", help="datasets to run jobs on, all of them by default: {}".format(", ".join(sorted(DATASETS))))
+    parser.add_argument("--workers", type=int, nargs="+", help="numbers of workers to run each job with", default=[1, 2, 4, 8])
+    parser.add_argument("--repeat", type=int, help="number of times each job is run", default=3)
+    parser.add_argument("--data-dir", help="directory where datasets are generated", default=DEFAULT_DATA_DIR)
+    parser.add_argument("--scale", type=float, help="multiply size of datasets by this factor", default=1.0)
+    parser.add_argument("--seed", type=int, help="seed of random generator used to generate datasets", default=DEFAULT_SEED)
+    parser.add_argument("--s3", action="store_true", help="read datasets from a local moto_server instead of local files")
+    parser.add_argument("--reducer-lag", action="store_true", help="run each job once more with --trace to measure reducer lag")
+    parser.add_argument("--smr-args", help="extra arguments passed to smr, e.g. \"--prefetch 2\"", default="")
+    parser.add_argument("--output", help="file where results are saved, benchmark-COMMIT.json by default")
+    args = parser.parse_args()
+    for name in args.datasets:
+        if name not in DATASETS:
+            parser.error("unknown dataset: {}".format(name))
+
+    commit = get_commit()
+    output_filename = args.output or "benchmark-{}.json".format((commit or "unknown")[:12])
+    temp_dir = tempfile.mkdtemp(prefix="smr-benchmark-")
+    moto_server = MotoServer(temp_dir) if args.s3 else None
+    results = []
+    try:
+        for name in args.datasets or sorted(DATASETS):
+            manifest = generate_dataset(args.data_dir, name, args.scale, args.seed)
+            if moto_server is not None:
+                input_uri = moto_server.upload(args.data_dir, name)
+                env = moto_server.get_env()
+            else:
+                input_uri = "file://{}".format(get_files_dir(args.data_dir, name))
+                env = {}
+            for workers in args.workers:
+                job = {"dataset": name, "storage": "s3" if args.s3 else "local", "workers": workers, "params": manifest["params"]}
+                for i in xrange(args.repeat):
+                    result = run_job(name, input_uri, workers, args.smr_args.split(), temp_dir, env)
+                    result.update(job, run=i)
+                    results.append(result)
+                    print("{} {} workers run {}: {:.2f}s, {:.1f} files/s, {:.2f} MB/s, {:.0f} records/s, peak RSS {:.1f} MB".format(
+                        name, workers, i, result["elapsed_seconds"], result["files_per_second"], result["mb_per_second"],
+                        result["records_per_second"], result["peak_rss_bytes"] / 1024 / 1024))
+                if args.reducer_lag:
+                    result = run_job(name, input_uri, workers, args.smr_args.split(), temp_dir, env, trace=True)
+                    result.update(job, traced=True)
+                    results.append(result)
+                    print("{} {} workers traced run: reducer lag {:.2f}s, {:.2f}s writing to reducers".format(
+                        name, workers, result["reducer_lag_seconds"], result["reduce_write_seconds"]))
+    finally:
+        if moto_server is not None:
+            moto_server.stop()
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    with open(output_filename, "w") as f:
+        json.dump({
+            "commit": commit,
+            "date": datetime.datetime.utcnow().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": psutil.cpu_count(),
+            "smr_args": args.smr_args,
+            "results": results
+        }, f, indent=2, sort_keys=True)
+    print("results are in {}".format(output_filename))
+
+if __name__ == "__main__":
+    main()
@@ -11,6 +11,7 @@ from __future__ import (absolute_import, division,
 import gzip
 import re
 import sys
+from smr.aggregators import Counter
 try:
     from bs4 import BeautifulSoup
 except ImportError:
@@ -24,7 +25,7 @@ except ImportError:
 
 # use only a small chunk of it for testing purposes
 INPUT_DATA = "s3://aws-publicdatasets/common-crawl/crawl-002/2010/09/25/45"
-global_result = {}
+global_result = Counter()
 
 # These are required to run smr-ec2, 
 # they can be passed on the command line as:
@@ -52,8 +53,8 @@ def MAP_FUNC(file_name):
 
 def REDUCE_FUNC(word):
     word = word.rstrip() # remove trailing linebreak
-    global_result[word] = global_result.get(word, 0) + 1
+    global_result.add(word)
 
 def OUTPUT_RESULTS_FUNC():
-    for word, count in sorted(global_result.iteritems(), key=lambda x: x[1], reverse=True):
+    for word, count in global_result.most_common():
         print("{},{}".format(word, count))
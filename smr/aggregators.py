@@ -0,0 +1,307 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import base64
+import hashlib
+import heapq
+import math
+import marshal
+import struct
+import zlib
+
+# aggregators that jobs can use in MAP_FUNC, COMBINE_FUNC and REDUCE_FUNC, each of them can be merged with another
+# one of the same kind, e.g. partial results of mappers in a reducer, and serialized with dumps() into a single line
+# of text that MAP_FUNC can print and REDUCE_FUNC can read with loads()
+
+HASH = struct.Struct(b">Q")
+
+class Aggregator(object):
+    """
+    base class of aggregators, subclasses define get_state() that returns state of the aggregator as
+    a value marshal can serialize, and classmethod from_state(state) that returns an aggregator with that state
+    """
+    def dumps(self):
+        """ returns aggregator serialized into a string without linebreaks """
+        return base64.b64encode(zlib.compress(marshal.dumps(self.get_state())))
+
+    @classmethod
+    def loads(cls, data):
+        return cls.from_state(marshal.loads(zlib.decompress(base64.b64decode(data))))
+
+class Counter(Aggregator):
+    """ number of occurrences of each key """
+    def __init__(self):
+        self.counts = {}
+
+    def add(self, key, count=1):
+        self.counts[key] = self.counts.get(key, 0) + count
+
+    def merge(self, other):
+        counts = self.counts
+        for key, count in other.counts.iteritems():
+            counts[key] = counts.get(key, 0) + count
+
+    def get(self, key):
+        return self.counts.get(key, 0)
+
+    def most_common(self, n=None):
+        """ returns a list of (key, count) tuples, n most common keys or all keys if n is None """
+        if n is None:
+            return sorted(self.counts.iteritems(), key=lambda x: x[1], reverse=True)
+        return heapq.nlargest(n, self.counts.iteritems(), key=lambda x: x[1])
+
+    def __len__(self):
+        return len(self.counts)
+
+    def get_state(self):
+        return self.counts
+
+    @classmethod
+    def from_state(cls, state):
+        counter = cls()
+        counter.counts = state
+        return counter
+
+class Sum(Aggregator):
+    """ sum and number of added values """
+    def __init__(self):
+        self.total = 0
+        self.count = 0
+
+    def add(self, value):
+        self.total += value
+        self.count += 1
+
+    def merge(self, other):
+        self.total += other.total
+        self.count += other.count
+
+    def mean(self):
+        return self.total / self.count if self.count > 0 else 0.0
+
+    def get_state(self):
+        return (self.total, self.count)
+
+    @classmethod
+    def from_state(cls, state):
+        result = cls()
+        result.total, result.count = state
+        return result
+
+class TopK(Aggregator):
+    """
+    approximate most frequent keys using space-saving algorithm, keeps counts of at most capacity keys
+    counts are overestimated by at most error of each key, keys more frequent than total / capacity are always kept
+    """
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self.heap = [] # (count, key) of tracked keys, may contain outdated counts
+
+    def add(self, key, count=1):
+        counts = self.counts
+        if key in counts:
+            counts[key] += count
+        elif len(counts) < self.capacity:
+            counts[key] = count
+            self.errors[key] = 0
+        else:
+            # replace the least frequent key, new key could have occurred as many times as it
+            min_count, min_key = self.pop_min()
+            del counts[min_key]
+            del self.errors[min_key]
+            counts[key] = min_count + count
+            self.errors[key] = min_count
+        heapq.heappush(self.heap, (counts[key], key))
+        if len(self.heap) > 4 * self.capacity:
+            self.rebuild_heap()
+
+    def pop_min(self):
+        while True:
+            count, key = heapq.heappop(self.heap)
+            if self.counts.get(key) == count:
+                return count, key
+
+    def rebuild_heap(self):
+        self.heap = [(count, key) for key, count in self.counts.iteritems()]
+        heapq.heapify(self.heap)
+
+    def get_min_count(self):
+        """ count that keys which aren't tracked could have at most """
+        if len(self.counts) < self.capacity:
+            return 0
+        return min(self.counts.itervalues())
+
+    def merge(self, other):
+        min_count, other_min_count = self.get_min_count(), other.get_min_count()
+        counts = {}
+        errors = {}
+        for key in set(self.counts) | set(other.counts):
+            counts[key] = self.counts.get(key, min_count) + other.counts.get(key, other_min_count)
+            errors[key] = self.errors.get(key, min_count) + other.errors.get(key, other_min_count)
+        keys = heapq.nlargest(self.capacity, counts, key=counts.get)
+        self.counts = dict((key, counts[key]) for key in keys)
+        self.errors = dict((key, errors[key]) for key in keys)
+        self.rebuild_heap()
+
+    def top(self, n=None):
+        """ returns a list of (key, count) tuples of n most frequent keys """
+        return heapq.nlargest(n or self.capacity, self.counts.iteritems(), key=lambda x: x[1])
+
+    def get_state(self):
+        return (self.capacity, self.counts, self.errors)
+
+    @classmethod
+    def from_state(cls, state):
+        capacity, counts, errors = state
+        top_k = cls(capacity)
+        top_k.counts = counts
+        top_k.errors = errors
+        top_k.rebuild_heap()
+        return top_k
+
+def hash64(value):
+    """ returns a 64 bit hash of value that's stable across processes and runs, unlike hash() """
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    elif not isinstance(value, bytes):
+        value = str(value)
+    return HASH.unpack_from(hashlib.md5(value).digest())[0]
+
+class HyperLogLog(Aggregator):
+    """ approximate number of distinct values, standard error is about 1.04 / sqrt(2 ** precision) """
+    def __init__(self, precision=14):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, value):
+        x = hash64(value)
+        index = x >> (64 - self.precision)
+        # position of the leftmost 1 bit in the rest of the hash
+        rank = 64 - self.precision - (x & ((1 << (64 - self.precision)) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError("can't merge HyperLogLog with precision {} into {}".format(other.precision, self.precision))
+        registers = self.registers
+        for i, rank in enumerate(other.registers):
+            if rank > registers[i]:
+                registers[i] = rank
+
+    def count(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -rank for rank in self.registers)
+        zeros = self.registers.count(b"\0")
+        if estimate <= 2.5 * m and zeros > 0:
+            # linear counting is more accurate for small cardinalities
+            return m * math.log(m / zeros)
+        return estimate
+
+    def get_state(self):
+        return (self.precision, bytes(self.registers))
+
+    @classmethod
+    def from_state(cls, state):
+        precision, registers = state
+        hll = cls(precision)
+        hll.registers = bytearray(registers)
+        return hll
+
+class QuantileSketch(Aggregator):
+    """
+    approximate quantiles of values with relative accuracy, using logarithmic buckets like DDSketch
+    returned quantiles are within relative_accuracy of the exact ones, except for values in the lowest buckets
+    that are collapsed together once there are more than max_buckets of them
+    """
+    def __init__(self, relative_accuracy=0.01, max_buckets=2048):
+        self.relative_accuracy = relative_accuracy
+        self.max_buckets = max_buckets
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.positive = {} # bucket index -> count
+        self.negative = {} # bucket index of absolute value -> count
+        self.zeros = 0
+        self.count = 0
+        self.min = None
+        self.max = None
+
+    def get_index(self, value):
+        return int(math.ceil(math.log(value) / self.log_gamma))
+
+    def get_value(self, index):
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def add(self, value, count=1):
+        if value > 0:
+            index = self.get_index(value)
+            self.positive[index] = self.positive.get(index, 0) + count
+        elif value < 0:
+            index = self.get_index(-value)
+            self.negative[index] = self.negative.get(index, 0) + count
+        else:
+            self.zeros += count
+        self.count += count
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        if len(self.positive) > self.max_buckets:
+            self.collapse(self.positive)
+        if len(self.negative) > self.max_buckets:
+            self.collapse(self.negative)
+
+    def collapse(self, buckets):
+        """ merges lowest buckets into one, so that there are at most max_buckets of them """
+        indexes = sorted(buckets)
+        excess = indexes[:len(indexes) - self.max_buckets + 1]
+        target = excess[-1]
+        for index in excess[:-1]:
+            buckets[target] += buckets.pop(index)
+
+    def merge(self, other):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("can't merge quantile sketches with different relative accuracy")
+        for buckets, other_buckets in ((self.positive, other.positive), (self.negative, other.negative)):
+            for index, count in other_buckets.iteritems():
+                buckets[index] = buckets.get(index, 0) + count
+            if len(buckets) > self.max_buckets:
+                self.collapse(buckets)
+        self.zeros += other.zeros
+        self.count += other.count
+        if other.count > 0:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def quantile(self, q):
+        """ returns approximate q-quantile of added values, 0 <= q <= 1, None if nothing was added """
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for index in sorted(self.negative, reverse=True):
+            seen += self.negative[index]
+            if seen > rank:
+                return max(-self.get_value(index), self.min)
+        seen += self.zeros
+        if seen > rank:
+            return 0
+        for index in sorted(self.positive):
+            seen += self.positive[index]
+            if seen > rank:
+                return min(self.get_value(index), self.max)
+        return self.max
+
+    def get_state(self):
+        return (self.relative_accuracy, self.max_buckets, self.positive, self.negative, self.zeros, self.count, self.min, self.max)
+
+    @classmethod
+    def from_state(cls, state):
+        relative_accuracy, max_buckets, positive, negative, zeros, count, min_value, max_value = state
+        sketch = cls(relative_accuracy, max_buckets)
+        sketch.positive = positive
+        sketch.negative = negative
+        sketch.zeros = zeros
+        sketch.count = count
+        sketch.min = min_value
+        sketch.max = max_value
+        return sketch
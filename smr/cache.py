@@ -0,0 +1,174 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+from contextlib import contextmanager
+import errno
+import fcntl
+import hashlib
+import os
+import tempfile
+import time
+
+# eviction frees space down to this fraction of max_size, so that a full cache isn't scanned again on the next add
+EVICTION_TARGET = 0.9
+# files in temp_dir that weren't touched for this many seconds were left behind by crashed processes
+TEMP_FILE_MAX_AGE = 24 * 60 * 60
+
+def get_cache_key(*parts):
+    """ returns a filesystem friendly cache key for given parts """
+    return hashlib.sha1("\0".join(unicode(part) for part in parts).encode("utf-8")).hexdigest()
+
+class DiskCache(object):
+    """
+    directory of files keyed by a hash, limited to max_size bytes by evicting least recently used files
+
+    several processes on the same host can use the same directory at once:
+    files are added to the cache with an atomic link/rename under an exclusive lock, which also protects a running
+    total of their size, so that the directory is only scanned for eviction once the total is over max_size.
+    files in temp_dir don't count towards max_size, they are hard links to cached files
+    handed out to readers so that eviction can't remove data that's still being used
+    """
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.data_dir = os.path.join(directory, "data")
+        self.temp_dir = os.path.join(directory, "tmp")
+        self.lock_filename = os.path.join(directory, "lock")
+        self.size_filename = os.path.join(directory, "size") # running total size of files in data_dir
+        for path in (self.data_dir, self.temp_dir):
+            try:
+                os.makedirs(path)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def get_path(self, key):
+        return os.path.join(self.data_dir, key)
+
+    def get(self, key):
+        """ returns the path of cached file for key and marks it as recently used, None if it's not cached """
+        path = self.get_path(key)
+        try:
+            os.utime(path, None)
+        except OSError:
+            return None
+        return path
+
+    def get_temp_filename(self):
+        """ returns a new file name in temp_dir """
+        fd, temp_filename = tempfile.mkstemp(dir=self.temp_dir)
+        os.close(fd)
+        return temp_filename
+
+    def checkout(self, key):
+        """
+        returns a new hard link in temp_dir to cached file for key, None if it's not cached
+        caller is responsible for deleting the link when done with it
+        """
+        path = self.get(key)
+        if path is None:
+            return None
+        temp_filename = self.get_temp_filename()
+        os.unlink(temp_filename)
+        try:
+            os.link(path, temp_filename)
+        except OSError:
+            return None # evicted in the meantime
+        return temp_filename
+
+    @contextmanager
+    def lock(self):
+        """ exclusive lock shared by all processes that use the cache directory """
+        with open(self.lock_filename, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def read_total_size(self):
+        """ returns total size of cached files kept in size file, None if it's missing or invalid """
+        try:
+            with open(self.size_filename) as f:
+                return int(f.read())
+        except (IOError, ValueError):
+            return None
+
+    def write_total_size(self, total_size):
+        with open(self.size_filename, "w") as f:
+            f.write(unicode(total_size))
+
+    def add(self, key, filename, move=False):
+        """
+        adds filename to cache under key, filename must be on the same filesystem as cache directory
+        returns the path of cached file
+        """
+        path = self.get_path(key)
+        with self.lock():
+            try:
+                replaced_size = os.path.getsize(path)
+            except OSError:
+                replaced_size = None
+            if move:
+                os.rename(filename, path)
+            elif replaced_size is None:
+                try:
+                    os.link(filename, path)
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+                    return path # added by a process that doesn't use the lock
+            else:
+                return path # another process added it first
+            # running total avoids scanning the whole cache on each add, it's only scanned when it's over max_size
+            total_size = self.read_total_size()
+            if total_size is not None:
+                total_size += os.path.getsize(path) - (replaced_size or 0)
+            if total_size is None or total_size > self.max_size:
+                total_size = self.evict_locked()
+            self.write_total_size(total_size)
+        return path
+
+    def evict(self):
+        """ removes least recently used files until cache is not larger than EVICTION_TARGET of max_size """
+        with self.lock():
+            self.write_total_size(self.evict_locked())
+
+    def evict_locked(self):
+        """
+        evicts files while the lock is held, returns total size of files that are left
+        old files in temp_dir are removed too
+        """
+        self.remove_old_temp_files()
+        files = []
+        total_size = 0
+        for file_name in os.listdir(self.data_dir):
+            path = os.path.join(self.data_dir, file_name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, path))
+            total_size += st.st_size
+        files.sort()
+        if total_size <= self.max_size:
+            return total_size
+        for _, size, path in files:
+            if total_size <= self.max_size * EVICTION_TARGET:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total_size -= size
+        return total_size
+
+    def remove_old_temp_files(self):
+        now = time.time()
+        for file_name in os.listdir(self.temp_dir):
+            path = os.path.join(self.temp_dir, file_name)
+            try:
+                st = os.stat(path)
+                # ctime changes when a link is created, mtime while a download is being written
+                if now - max(st.st_mtime, st.st_ctime) > TEMP_FILE_MAX_AGE:
+                    os.unlink(path)
+            except OSError:
+                pass
@@ -6,6 +6,10 @@ import logging
 import os
 import sys
 
+from .engine import ENGINES
+from .profiling import PROFILE_MODES
+from .schedule import SCHEDULES
+from .transport import TRANSPORTS, RECORD_ENCODINGS
 from .version import __version__
 
 LOG_LEVELS = {
@@ -16,10 +20,31 @@ LOG_LEVELS = {
     "debug": logging.DEBUG
 }
 
+# options that smr and smr-ec2 pass on to smr-map and smr-reduce processes when they differ from defaults
+FORWARDED_OPTIONS = [
+    "prefetch", "stream_buffer_size", "s3_multipart_threshold", "s3_part_size", "s3_download_concurrency",
+    "input_cache_dir", "input_cache_size", "combine_buffer_size", "transport", "record_encoding", "frame_size", "partitions", "mark_output",
+    "sort_buffer_size", "sort_dir", "reduce_batch_size", "metrics",
+    "profile", "profile_interval", "profile_dir", "trace_spans"
+]
+
 class DefaultConfig(object):
     def __init__(self):
         self.paramiko_log_level = "warning"
         self.workers = 8
+        self.reducers = 1
+        self.merge_reduce_output = False
+        self.prefetch = 0
+        self.stream_buffer_size = 8 * 1024 * 1024
+        self.s3_multipart_threshold = 128 * 1024 * 1024
+        self.s3_part_size = 32 * 1024 * 1024
+        self.s3_download_concurrency = 4
+        self.input_cache_dir = None
+        self.input_cache_size = 10 * 1024 * 1024 * 1024
+        self.combine_buffer_size = 64 * 1024 * 1024
+        self.transport = "lines"
+        self.record_encoding = "text"
+        self.frame_size = 64 * 1024
         self.output_job_progress = True
         self.aws_access_key = None
         self.aws_secret_key = None
@@ -41,6 +66,38 @@ class DefaultConfig(object):
         self.cpu_usage_interval = 0.1
         self.screen_refresh_interval = 1.0
         self.date_range = None
+        self.s3_list_threads = 16
+        self.s3_list_split_depth = 0
+        self.listing_cache_dir = None
+        self.listing_cache_ttl = 24 * 60 * 60
+        self.stream_listing = False
+        self.input_queue_size = 10000
+        self.schedule = "largest-first"
+        self.split_size = 0
+        self.bundle_size = 0
+        self.speculative = False
+        self.speculative_factor = 2.0
+        self.mark_output = False
+        self.partitions = 0
+        self.journal = None
+        self.resume = None
+        self.checkpoint_interval = 300
+        self.map_output_cache_dir = None
+        self.map_output_cache_size = 10 * 1024 * 1024 * 1024
+        self.map_output_cache_version = None
+        self.pending_output_size = 64 * 1024 * 1024
+        self.engine = "subprocess"
+        self.sort_buffer_size = 256 * 1024 * 1024
+        self.sort_dir = None
+        self.reduce_batch_size = 10000
+        self.report = None
+        self.prometheus_file = None
+        self.metrics = False
+        self.profile = None
+        self.profile_interval = 0.005
+        self.profile_dir = None
+        self.trace = None
+        self.trace_spans = False
         self.start_date = None
         self.end_date = None
 
@@ -73,6 +130,20 @@ def get_config_module(config_name):
         setattr(config, "MAP_FUNC", None)
     if not hasattr(config, "REDUCE_FUNC"):
         setattr(config, "REDUCE_FUNC", None)
+    if not hasattr(config, "COMBINE_FUNC"):
+        setattr(config, "COMBINE_FUNC", None)
+    if not hasattr(config, "KEY_FUNC"):
+        setattr(config, "KEY_FUNC", None)
+    if not hasattr(config, "MERGE_RESULTS_FUNC"):
+        setattr(config, "MERGE_RESULTS_FUNC", None)
+    if not hasattr(config, "SCHEDULE_FUNC"):
+        setattr(config, "SCHEDULE_FUNC", None)
+    if not hasattr(config, "SAVE_STATE_FUNC"):
+        setattr(config, "SAVE_STATE_FUNC", None)
+    if not hasattr(config, "LOAD_STATE_FUNC"):
+        setattr(config, "LOAD_STATE_FUNC", None)
+    if not hasattr(config, "REDUCE_BATCH_FUNC"):
+        setattr(config, "REDUCE_BATCH_FUNC", None)
     if not hasattr(config, "OUTPUT_RESULTS_FUNC"):
         def default_output_results_func():
             print("done")
@@ -91,6 +162,19 @@ def get_config(args=None):
 
     parser.add_argument("--paramiko-log-level", help="level of logging to be used for paramiko ssh connections (for smr-ec2 only)", choices=LOG_LEVELS.keys(), default=default_config.paramiko_log_level)
     parser.add_argument("-w", "--workers", type=int, help="number of worker processes to use", default=default_config.workers)
+    parser.add_argument("-r", "--reducers", type=int, help="number of reduce processes to use, map output is partitioned across them by key in smr-map and always sent with framed transport", default=default_config.reducers)
+    parser.add_argument("--merge-reduce-output", help="merge output of all reducers into a single file when using multiple reducers", action="store_true", default=default_config.merge_reduce_output)
+    parser.add_argument("--prefetch", type=int, help="number of files each smr-map worker downloads in background while processing the current file", default=default_config.prefetch)
+    parser.add_argument("--stream-buffer-size", type=int, help="number of bytes to read ahead of MAP_FUNC when STREAM_INPUT is set in config", default=default_config.stream_buffer_size)
+    parser.add_argument("--s3-multipart-threshold", type=int, help="S3 files of at least this many bytes are downloaded in parts using parallel range requests, 0 to disable", default=default_config.s3_multipart_threshold)
+    parser.add_argument("--s3-part-size", type=int, help="number of bytes to download in a single range request", default=default_config.s3_part_size)
+    parser.add_argument("--s3-download-concurrency", type=int, help="max number of parallel range requests used to download a single S3 file", default=default_config.s3_download_concurrency)
+    parser.add_argument("--input-cache-dir", help="directory where smr-map caches downloaded S3 files between runs, keyed by bucket, key and ETag")
+    parser.add_argument("--input-cache-size", type=int, help="max number of bytes stored in input cache, least recently used files are evicted first", default=default_config.input_cache_size)
+    parser.add_argument("--combine-buffer-size", type=int, help="max number of bytes of map output to buffer before passing it through COMBINE_FUNC", default=default_config.combine_buffer_size)
+    parser.add_argument("--transport", help="how map output is sent to reducers: one record per line, or length-prefixed frames of many records", choices=TRANSPORTS, default=default_config.transport)
+    parser.add_argument("--record-encoding", help="encoding of records inside frames when using framed transport", choices=RECORD_ENCODINGS, default=default_config.record_encoding)
+    parser.add_argument("--frame-size", type=int, help="number of bytes of map output to batch into a single frame when using framed transport", default=default_config.frame_size)
     parser.add_argument("--output-filename", help="filename where results for this job will be stored")
     parser.add_argument("--output-job-progress", help="Output job progress to screen", dest='output_job_progress', action='store_true', default=default_config.output_job_progress)
     parser.add_argument("--no-output-job-progress", help="Do not output job progress to screen", dest='output_job_progress', action='store_false')
@@ -105,11 +189,43 @@ def get_config(args=None):
     parser.add_argument("--aws-ec2-workers", help="number of EC2 instances to use for this job", type=int, default=default_config.aws_ec2_workers)
     parser.add_argument("--aws-ec2-remote-config-path", help="where to store smr config on EC2 instances", default=default_config.aws_ec2_remote_config_path)
     parser.add_argument("--aws-ec2-initialization-commands", help="initialization commands to use for EC2 instances", nargs="+", default=default_config.aws_ec2_initialization_commands)
-    parser.add_argument("--cpu-usage-interval", type=float, help="interval used for measuring CPU usage in seconds", default=default_config.cpu_usage_interval)
+    parser.add_argument("--cpu-usage-interval", type=float, help=argparse.SUPPRESS, default=default_config.cpu_usage_interval) # no longer used, CPU usage is sampled without blocking
     parser.add_argument("--screen-refresh-interval", type=float, help="how often to refresh job progress that's displayed on screen in seconds", default=default_config.screen_refresh_interval)
     parser.add_argument("--start-date", type=mkdate, help="start date (YYYY-mm-dd) for this job, only used if using {year}/{month}/{day} macros in INPUT_DATA")
     parser.add_argument("--end-date", type=mkdate, help="end date (YYYY-mm-dd) for this job, only used if using {year}/{month}/{day} macros in INPUT_DATA", default=datetime.datetime.utcnow().date())
     parser.add_argument("--date-range", type=int, help="number of days back to process, overrides start date if used")
+    parser.add_argument("--s3-list-threads", type=int, help="number of S3 prefixes (e.g. days) to list concurrently", default=default_config.s3_list_threads)
+    parser.add_argument("--s3-list-split-depth", type=int, help="split S3 prefixes by \"/\" this many levels deep so that sub-prefixes can be listed concurrently", default=default_config.s3_list_split_depth)
+    parser.add_argument("--listing-cache-dir", help="directory where S3 listings are stored and reused by next runs")
+    parser.add_argument("--listing-cache-ttl", type=int, help="number of seconds after which S3 listings stored in listing cache expire", default=default_config.listing_cache_ttl)
+    parser.add_argument("--stream-listing", action="store_true", help="start mapping files while input data is still being listed", default=default_config.stream_listing)
+    parser.add_argument("--input-queue-size", type=int, help="maximum number of listed files waiting to be processed when using --stream-listing", default=default_config.input_queue_size)
+    parser.add_argument("--schedule", help="order in which listed files are processed, ignored with --stream-listing", choices=SCHEDULES, default=default_config.schedule)
+    parser.add_argument("--split-size", type=int, help="process newline delimited files larger than this many bytes in splits of this size by several workers, 0 to disable", default=default_config.split_size)
+    parser.add_argument("--bundle-size", type=int, help="send files to mappers in bundles of at least this many bytes instead of one by one, 0 to disable", default=default_config.bundle_size)
+    parser.add_argument("--speculative", action="store_true", help="once there are no files left to start, process files that take much longer than others again on idle workers and keep output of the copy that finishes first, map output of each file is held by smr until the file is processed (see --pending-output-size)", default=default_config.speculative)
+    parser.add_argument("--speculative-factor", type=float, help="with --speculative, files are processed again once they take this many times longer than the median time per byte", default=default_config.speculative_factor)
+    parser.add_argument("--mark-output", action="store_true", help=argparse.SUPPRESS, default=default_config.mark_output) # set by smr for smr-map and smr-reduce
+    parser.add_argument("--partitions", type=int, help=argparse.SUPPRESS, default=default_config.partitions) # set by smr for smr-map and smr-reduce
+    parser.add_argument("--journal", help="directory where the list of processed files and state of reducers are saved periodically, so that the job can be resumed with --resume, map output of each file is held by smr until the file is processed (see --pending-output-size)", default=default_config.journal)
+    parser.add_argument("--resume", help="journal directory of a job that didn't finish, files it processed are skipped and reducers continue from saved state, map output of each file is held by smr until the file is processed (see --pending-output-size)", default=default_config.resume)
+    parser.add_argument("--checkpoint-interval", type=int, help="number of seconds between saving state of reducers to journal", default=default_config.checkpoint_interval)
+    parser.add_argument("--map-output-cache-dir", help="directory where map output of each file is cached, files whose job file and contents didn't change since are not mapped again, map output of each file is held by smr until the file is processed (see --pending-output-size)", default=default_config.map_output_cache_dir)
+    parser.add_argument("--map-output-cache-size", type=int, help="max number of bytes of compressed map output to keep in map output cache", default=default_config.map_output_cache_size)
+    parser.add_argument("--map-output-cache-version", help="key map output cache by this version and source of MAP_FUNC and COMBINE_FUNC instead of the whole job file, so that cached output is reused after other changes to the job; change it when code that MAP_FUNC calls changes", default=default_config.map_output_cache_version)
+    parser.add_argument("--pending-output-size", type=int, help="with --speculative, --journal, --resume or --map-output-cache-dir, max number of bytes of map output of a file that smr holds in memory per worker until the file is processed, the rest is spilled to --sort-dir", default=default_config.pending_output_size)
+    parser.add_argument("--engine", help="how smr starts mappers: subprocess runs smr-map for each worker, multiprocessing forks workers from smr so that the job is loaded only once (smr only)", choices=ENGINES, default=default_config.engine)
+    parser.add_argument("--sort-buffer-size", type=int, help="with REDUCE_FUNC(key, values), max number of bytes of map output that each reducer sorts in memory before spilling a sorted run to disk", default=default_config.sort_buffer_size)
+    parser.add_argument("--sort-dir", help="directory where reducers spill sorted runs of map output, and smr spills map output of files that are still being processed, system temp dir by default", default=default_config.sort_dir)
+    parser.add_argument("--reduce-batch-size", type=int, help="max number of records passed to REDUCE_BATCH_FUNC at once", default=default_config.reduce_batch_size)
+    parser.add_argument("--report", help="file where a JSON report of the job is saved once it finishes: throughput, time spent downloading and mapping files per worker and histograms of them", default=default_config.report)
+    parser.add_argument("--prometheus-file", help="file where the same metrics are saved in prometheus text format, e.g. for node_exporter's textfile collector", default=default_config.prometheus_file)
+    parser.add_argument("--metrics", action="store_true", help=argparse.SUPPRESS, default=default_config.metrics) # set by smr for smr-map
+    parser.add_argument("--profile", nargs="?", const="cprofile", choices=PROFILE_MODES, help="run MAP_FUNC and REDUCE_FUNC under cProfile, or a sampling profiler with lower overhead, and save merged profiles next to output of the job", default=default_config.profile)
+    parser.add_argument("--profile-interval", type=float, help="number of seconds of CPU time between samples when using --profile sampling", default=default_config.profile_interval)
+    parser.add_argument("--profile-dir", help=argparse.SUPPRESS, default=default_config.profile_dir) # set by smr for smr-map and smr-reduce
+    parser.add_argument("--trace", help="file where a timeline of listing, dispatching, downloading and mapping each file and writing map output to reducers is saved, in Chrome trace format that Perfetto can open", default=default_config.trace)
+    parser.add_argument("--trace-spans", action="store_true", help=argparse.SUPPRESS, default=default_config.trace_spans) # set by smr for smr-map
 
     parser.add_argument("-v", "--version", action="version", version="SMR {}".format(__version__))
 
@@ -121,7 +237,8 @@ def configure_job(args):
     config = get_config_module(args.config)
 
     # add extra options to args that cannot be specified in cli
-    for arg in ("MAP_FUNC", "REDUCE_FUNC", "OUTPUT_RESULTS_FUNC", "INPUT_DATA"):
+    args.STREAM_INPUT = getattr(config, "STREAM_INPUT", False)
+    for arg in ("MAP_FUNC", "REDUCE_FUNC", "OUTPUT_RESULTS_FUNC", "COMBINE_FUNC", "KEY_FUNC", "MERGE_RESULTS_FUNC", "SCHEDULE_FUNC", "SAVE_STATE_FUNC", "LOAD_STATE_FUNC", "REDUCE_BATCH_FUNC", "INPUT_DATA"):
         setattr(args, arg, getattr(config, arg))
 
     pip_requirements = getattr(config, "PIP_REQUIREMENTS", None)
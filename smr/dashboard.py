@@ -0,0 +1,166 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+from collections import deque
+import datetime
+import time
+
+import psutil
+
+from .version import __version__
+from .shared import add_str, get_param, get_progress_str
+
+# seconds over which recent throughput of the job and of each worker is measured
+RATE_WINDOW = 10.0
+# number of most recent messages shown on screen
+MESSAGES_SHOWN = 10
+
+class RateTracker(object):
+    """ measures rate of files and bytes processed over the last window seconds, from snapshots of their totals """
+    def __init__(self, window=RATE_WINDOW):
+        self.window = window
+        self.snapshots = deque()
+
+    def add(self, now, files, num_bytes):
+        self.snapshots.append((now, files, num_bytes))
+        # keep the newest snapshot that's at least window seconds old, so that rate covers the whole window
+        while len(self.snapshots) > 2 and now - self.snapshots[1][0] >= self.window:
+            self.snapshots.popleft()
+
+    def get_rates(self):
+        """ returns (files per second, bytes per second) """
+        if len(self.snapshots) < 2:
+            return 0.0, 0.0
+        start_time, start_files, start_bytes = self.snapshots[0]
+        end_time, end_files, end_bytes = self.snapshots[-1]
+        if end_time <= start_time:
+            return 0.0, 0.0
+        return (end_files - start_files) / (end_time - start_time), (end_bytes - start_bytes) / (end_time - start_time)
+
+def get_eta(bytes_remaining, bytes_per_second):
+    """ returns estimated seconds until bytes_remaining are processed, None if nothing is being processed """
+    if bytes_remaining <= 0:
+        return 0.0
+    if bytes_per_second <= 0:
+        return None
+    return bytes_remaining / bytes_per_second
+
+def format_rate(files_per_second, bytes_per_second):
+    return "{:8.2f} MB/s {:8.2f} files/s".format(bytes_per_second / 1024 / 1024, files_per_second)
+
+def format_eta(eta):
+    if eta is None:
+        return "unknown"
+    return str(datetime.timedelta(seconds=int(eta)))
+
+class ProcessSampler(object):
+    """
+    CPU usage of local processes, each sample covers the time since the previous one
+    unlike cpu_percent with an interval, it doesn't block, so the screen takes the same time to draw with any number of processes
+    """
+    def __init__(self):
+        self.processes = {} # pid -> psutil.Process
+
+    def sample(self, pids):
+        """ returns dict of pid -> CPU percent, None for processes that exited """
+        usage = {}
+        for pid in pids:
+            try:
+                process = self.processes.get(pid)
+                if process is None:
+                    process = self.processes[pid] = psutil.Process(pid)
+                usage[pid] = process.cpu_percent(None)
+            except psutil.Error:
+                usage[pid] = None
+        return usage
+
+def format_cpu(cpu_percent):
+    if cpu_percent is None:
+        return "    -"
+    return "{:4.0f}%".format(cpu_percent)
+
+def get_current_file(mapper):
+    if mapper.finished:
+        return "finished"
+    try:
+        return mapper.files_in_flight[0]
+    except IndexError:
+        return "idle"
+
+class Dashboard(object):
+    """ job progress, throughput and state of each worker that's shown on screen while the job runs """
+    def __init__(self, title, mappers, reduce_processes, input_queue, output_queue, listing_done, start_time, show_input_cache=False):
+        self.title = title
+        self.mappers = mappers # list of MapperConnection, workers on instances are added to it as they're started
+        self.reduce_processes = reduce_processes
+        self.input_queue = input_queue
+        self.output_queue = output_queue
+        self.listing_done = listing_done
+        self.start_time = start_time
+        self.show_input_cache = show_input_cache
+        self.job_rate = RateTracker()
+        self.worker_rates = {} # mapper name -> RateTracker
+        self.sampler = ProcessSampler()
+
+    def get_worker_lines(self, mappers, now):
+        pids = [mapper.pid for mapper in mappers if mapper.pid is not None] + [process.pid for process in self.reduce_processes]
+        cpu_usage = self.sampler.sample(pids)
+        name_width = max([len(mapper.name) for mapper in mappers] or [0])
+        lines = []
+        for mapper in mappers:
+            rate = self.worker_rates.get(mapper.name)
+            if rate is None:
+                rate = self.worker_rates[mapper.name] = RateTracker()
+            rate.add(now, mapper.files_processed, mapper.bytes_processed)
+            lines.append("  {} CPU {} {} {:7} files  {}".format(mapper.name.ljust(name_width), format_cpu(cpu_usage.get(mapper.pid)),
+                format_rate(*rate.get_rates()), mapper.files_processed, get_current_file(mapper)))
+        reduce_lines = []
+        for i, process in enumerate(self.reduce_processes):
+            reduce_lines.append("  reducer {} pid {} CPU {}".format(i, process.pid, format_cpu(cpu_usage.get(process.pid))))
+        return lines, reduce_lines
+
+    def get_lines(self, max_lines):
+        """ returns lines to draw on a screen of max_lines lines, workers that don't fit are summarized in one line """
+        now = time.time()
+        elapsed_time = datetime.datetime.now() - self.start_time
+        elapsed = elapsed_time.total_seconds()
+        files_processed, bytes_processed = get_param("files_processed"), get_param("bytes_processed")
+        self.job_rate.add(now, files_processed, bytes_processed)
+        files_per_second, bytes_per_second = self.job_rate.get_rates()
+        eta = format_eta(get_eta(get_param("bytes_listed") - bytes_processed, bytes_per_second))
+        if not self.listing_done.is_set():
+            eta += " (more files are being listed)"
+
+        header = [
+            "{} v{} - {} - elapsed: {}".format(self.title, __version__, datetime.datetime.ctime(datetime.datetime.now()), elapsed_time),
+            get_progress_str(self.listing_done),
+            "throughput: {} recent, {} overall, ETA {}".format(format_rate(files_per_second, bytes_per_second),
+                format_rate(files_processed / elapsed, bytes_processed / elapsed) if elapsed > 0 else format_rate(0.0, 0.0), eta),
+            "queued: {} work items to map, {} blocks of map output to reduce".format(self.input_queue.qsize(), self.output_queue.qsize()),
+            ""
+        ]
+        mappers = list(self.mappers)
+        worker_lines, reduce_lines = self.get_worker_lines(mappers, now)
+
+        footer = ["", "last file processed: {}".format(get_param("last_file_processed"))]
+        if self.show_input_cache:
+            footer.append("input cache: {} hits, {} misses".format(get_param("input_cache_hits"), get_param("input_cache_misses")))
+        messages = get_param("messages")[-MESSAGES_SHOWN:]
+        if len(messages) > 0:
+            footer.append("last messages:")
+            footer.extend("  {}".format(message) for message in messages)
+
+        worker_lines += reduce_lines
+        available = max_lines - len(header) - len(footer)
+        if len(worker_lines) > available:
+            shown = max(0, available - 1)
+            worker_lines = worker_lines[:shown] + ["  ... and {} more".format(len(worker_lines) - shown)]
+        return header + worker_lines + footer
+
+def dashboard_thread(dashboard, window, abort_event, refresh_interval):
+    while not abort_event.wait(refresh_interval):
+        max_lines, _ = window.getmaxyx()
+        lines = dashboard.get_lines(max_lines)
+        window.erase()
+        for i, line in enumerate(lines[:max_lines]):
+            add_str(window, i, line)
+        if not abort_event.is_set():
+            window.refresh()
@@ -7,19 +7,25 @@ import curses
 import datetime
 import os
 import paramiko
-import psutil
 from Queue import Queue
 import socket
-import subprocess
 import sys
 import threading
 import time
 
-from .version import __version__
 from .config import get_config, configure_job
-from .shared import reduce_thread, progress_thread, write_file_to_descriptor, print_pid, \
-    get_param, add_message, add_str, ensure_dir_exists, get_args
-from .uri import get_uris
+from .shared import reduce_thread, progress_thread, get_param, ensure_dir_exists, get_args, \
+    start_reduce_processes, finish_reduce_processes, merge_reduce_output, get_results_description, start_listing, \
+    restore_reduce_state, start_checkpoint_thread, stop_threads
+from .dashboard import Dashboard, dashboard_thread
+from .eventloop import Coordinator, SshMapper, Waker, WakeupQueue
+from .journal import get_journal, save_checkpoint
+from .memo import get_map_output_cache
+from .metrics import get_job_metrics, write_job_metrics
+from .profiling import finish_profiling, start_profiling
+from .speculate import get_output_tracker
+from .trace import get_tracer
+from .transport import configure_partitions
 
 RSA_BITS = 2048
 
@@ -28,53 +34,6 @@ def get_ssh_connection():
     ssh_connection.set_missing_host_key_policy(paramiko.AutoAddPolicy())
     return ssh_connection
 
-def worker_stdout_read_thread(output_queue, chan):
-    stdout = chan.makefile("rb")
-    for line in iter(stdout.readline, ""):
-        output_queue.put(line)
-
-def worker_stderr_read_thread(processed_files_queue, input_queue, chan, ssh, abort_event):
-
-    stdin = chan.makefile("wb")
-    stderr = chan.makefile_stderr("rb")
-
-    # write first file to mapper
-    if not abort_event.is_set() and not write_file_to_descriptor(input_queue, stdin):
-        chan.shutdown_write()
-        abort_event.set()
-        sys.exit(1)
-
-    for line in iter(stderr.readline, ""):
-        line = line.rstrip() # remove trailing linebreak
-        splt = line.split(",", 2)
-        if len(splt) != 3:
-            add_message("invalid message received from mapper: {}".format(line))
-        else:
-            file_status, file_size, file_name = splt
-            if file_status == "+":
-                processed_files_queue.put((file_name, int(file_size)))
-            elif file_status == "!":
-                add_message("error processing {}, requeuing...".format(file_name))
-                input_queue.put(file_name) # re-queue file
-            else:
-                add_message("invalid status received from mapper: {}".format(file_status))
-
-        if abort_event.is_set():
-            break
-        if not write_file_to_descriptor(input_queue, stdin):
-            # stdin.close() is not enough with paramiko to actually close it, need to do this too:
-            chan.shutdown_write()
-            break
-
-        if chan.exit_status_ready():
-            break
-
-    if not abort_event.is_set():
-        while not chan.exit_status_ready():
-            time.sleep(1)
-
-    ssh.close()
-
 def wait_for_instance(instance):
     """ wait for instance status to be 'running' in which case return True, False otherwise """
 
@@ -164,7 +123,7 @@ def run_command(ssh, instance, command):
         ssh.close()
         return False
 
-def start_worker(config, instance, abort_event, output_queue, processed_files_queue, input_queue, ssh_key):
+def start_worker(config, instance, abort_event, ssh_key, worker_id):
     ssh = get_ssh_connection()
 
     try:
@@ -176,71 +135,47 @@ def start_worker(config, instance, abort_event, output_queue, processed_files_qu
 
     chan = ssh.get_transport().open_session()
     chan.exec_command(" ".join(get_args("smr-map", config, config.aws_ec2_remote_config_path)))
+    return SshMapper("{}:{}".format(instance.id, worker_id), chan, ssh)
 
-    stdout_thread = threading.Thread(target=worker_stdout_read_thread, args=(output_queue, chan))
-    stdout_thread.daemon = True
-    stdout_thread.start()
-
-    stderr_thread = threading.Thread(target=worker_stderr_read_thread, args=(processed_files_queue, input_queue, chan, ssh, abort_event))
-    stderr_thread.daemon = True
-    stderr_thread.start()
-
-    return (chan, stderr_thread)
-
-def curses_thread(config, abort_event, instances, reduce_processes, window, start_time, bytes_total):
-    reduce_pids = [psutil.Process(x.pid) for x in reduce_processes]
-    sleep_time = config.screen_refresh_interval - (config.cpu_usage_interval * len(reduce_pids))
-    while not abort_event.is_set() and sleep_time > 0 and not abort_event.wait(sleep_time):
-        if abort_event.is_set():
-            break
-        window.clear()
-        now = datetime.datetime.now()
-        add_str(window, 0, "smr-ec2 v{} - {} - elapsed: {}".format(__version__, datetime.datetime.ctime(now), now - start_time))
-        i = 1
-        for instance in instances:
-            add_str(window, i, "  instance {} {}".format(instance.id, instance.ip_address))
-            i += 1
-            for _ in xrange(config.workers):
-                add_str(window, i, "    smr-map")
-                i += 1
-        for p in reduce_pids:
-            print_pid(p, window, i, "smr-reduce")
-            i += 1
-        add_str(window, i + 1, "job progress: {0:%}".format(get_param("bytes_processed") / bytes_total))
-        add_str(window, i + 2, "last file processed: {}".format(get_param("last_file_processed")))
-        messages = get_param("messages")[-10:]
-        if len(messages) > 0:
-            add_str(window, i + 3, "last messages:")
-            i += 4
-            for message in messages:
-                add_str(window, i, "  {}".format(message))
-                i += 1
-        if not abort_event.is_set():
-            window.refresh()
-
-def run_job_on_instances(config, instances, abort_event, output_queue, processed_files_queue, input_queue, ssh_key):
-    workers = []
+def fetch_profiles(config, instances, ssh_key):
+    """ copies profiles that smr-map processes saved on instances to local profile_dir, under the same path """
     for instance in instances:
-        for _ in xrange(config.workers):
-            workers.append(start_worker(config, instance, abort_event, output_queue, processed_files_queue, input_queue, ssh_key))
-
-    for chan, worker in workers:
-        worker.join()
-        exit_code = chan.recv_exit_status()
-        if exit_code != 0:
-            sys.stderr.write("map process exited with code {}\n".format(exit_code))
+        ssh = get_ssh_connection()
+        try:
+            ssh.connect(instance.ip_address, username=config.aws_ec2_ssh_username, pkey=ssh_key)
+            sftp = ssh.open_sftp()
+            for filename in sftp.listdir(config.profile_dir):
+                path = os.path.join(config.profile_dir, filename)
+                sftp.get(path, path)
+            sftp.close()
+        except (IOError, OSError, paramiko.SSHException, socket.error) as e:
+            print("could not fetch profiles from instance {} {}: {}".format(instance.id, instance.ip_address, e))
+        finally:
+            ssh.close()
+
+def run_job_on_instances(config, coordinator, instances, abort_event, ssh_key):
+    for instance in instances:
+        for worker_id in xrange(config.workers):
+            coordinator.add(start_worker(config, instance, abort_event, ssh_key, worker_id))
+
+    coordinator.run()
+    for mapper in coordinator.mappers:
+        if not mapper.finished:
+            # still processing a file that was already processed by another worker
+            mapper.stop()
+            continue
+        if mapper.exit_code != 0:
+            sys.stderr.write("map process exited with code {}\n".format(mapper.exit_code))
 
-def run_helper(config, ssh_key, bytes_total, file_names, instances):
-    files_total = len(file_names)
-    input_queue = Queue(files_total)
-    for file_name in file_names:
-        input_queue.put(file_name)
-    output_queue = Queue()
-    processed_files_queue = Queue(files_total)
+def run_helper(config, ssh_key, input_queue, listing_done, abort_event, tracker, journal, map_output_cache, tracer, instances):
+    output_queue = WakeupQueue(input_queue.waker)
+    processed_files_queue = Queue()
+    job_metrics = get_job_metrics(config)
+    # smr-map saves profiles to the same directory on instances, they're fetched once the job is done
+    start_profiling(config)
 
     start_time = datetime.datetime.now()
 
-    abort_event = threading.Event()
     try:
         initialize_instances(config, instances, abort_event, ssh_key)
     except KeyboardInterrupt:
@@ -260,10 +195,11 @@ def run_helper(config, ssh_key, bytes_total, file_names, instances):
             config.output_filename = "results/{}.{}.out".format(os.path.basename(config.config), datetime.datetime.now().strftime("%Y-%m-%d_%H:%M:%S.%f"))
         ensure_dir_exists(config.output_filename)
 
-        reduce_stdout = open(config.output_filename, "w")
-        reduce_process = subprocess.Popen(get_args("smr-reduce", config, config.config), stdin=subprocess.PIPE, stdout=reduce_stdout, stderr=subprocess.PIPE)
+        reducers = start_reduce_processes(config, config.config)
+        reduce_processes = [reduce_process for reduce_process, _ in reducers]
+        restore_reduce_state(config, reduce_processes, journal)
 
-        reduce_worker = threading.Thread(target=reduce_thread, args=(reduce_process, output_queue, abort_event))
+        reduce_worker = threading.Thread(target=reduce_thread, args=(reduce_processes, output_queue, abort_event, config, tracer))
         #reduce_worker.daemon = True
         reduce_worker.start()
 
@@ -271,51 +207,91 @@ def run_helper(config, ssh_key, bytes_total, file_names, instances):
         #progress_worker.daemon = True
         progress_worker.start()
 
+        start_checkpoint_thread(config, journal, tracker, output_queue, abort_event)
+        if map_output_cache is not None:
+            map_output_cache.start(input_queue, output_queue, processed_files_queue, tracker, abort_event)
+
+        # workers are added to the coordinator as they're started, the dashboard shows them as soon as they are
+        coordinator = Coordinator(config, input_queue, output_queue, processed_files_queue, listing_done, abort_event, tracker, map_output_cache, job_metrics, tracer)
         if config.output_job_progress:
             window = curses.initscr()
-            curses_worker = threading.Thread(target=curses_thread, args=(config, abort_event, instances, [reduce_process], window, start_time, bytes_total))
+            dashboard = Dashboard("smr-ec2", coordinator.mappers, reduce_processes, input_queue, output_queue, listing_done, start_time, bool(config.input_cache_dir))
+            curses_worker = threading.Thread(target=dashboard_thread, args=(dashboard, window, abort_event, config.screen_refresh_interval))
             #curses_worker.daemon = True
             curses_worker.start()
 
-        run_job_on_instances(config, instances, abort_event, output_queue, processed_files_queue, input_queue, ssh_key)
+        run_job_on_instances(config, coordinator, instances, abort_event, ssh_key)
+    except SystemExit:
+        # could not connect to a worker
+        stop_threads(abort_event, output_queue, processed_files_queue, map_output_cache)
+        if config.output_job_progress:
+            curses.endwin()
+        raise
     except KeyboardInterrupt:
-        abort_event.set()
+        stop_threads(abort_event, output_queue, processed_files_queue, map_output_cache)
         if config.output_job_progress:
             curses.endwin()
         print("user aborted. elapsed time: {}".format(str(datetime.datetime.now() - start_time)))
-        print("partial results are in {}".format(config.output_filename))
+        print("partial results are in {}".format(get_results_description(config)))
         sys.exit(1)
 
-    output_queue.join() # wait for reducer to process everything
-
-    abort_event.set()
+    if not abort_event.is_set():
+        output_queue.join() # wait for reducer to process everything
+        if journal is not None:
+            save_checkpoint(journal, tracker, output_queue, abort_event, final=True)
+    stop_threads(abort_event, output_queue, processed_files_queue, map_output_cache)
     if config.output_job_progress:
         curses_worker.join()
         curses.endwin()
 
     # wait for reduce to finish before exiting
     reduce_worker.join()
-    (_, stderr) = reduce_process.communicate()
-    if stderr:
-        sys.stderr.write(stderr)
-    if reduce_process.returncode != 0:
-        print("reduce process {} exited with code {}".format(reduce_process.pid, reduce_process.returncode))
-        print("partial results are in {}".format(config.output_filename))
+    if not finish_reduce_processes(reducers):
+        print("partial results are in {}".format(get_results_description(config)))
         sys.exit(1)
 
-    reduce_stdout.close()
+    if get_param("files_listed") <= 0 and (journal is None or not journal.files):
+        sys.stderr.write("no files to process\n")
+        sys.exit(1)
+
+    if config.merge_reduce_output:
+        merge_reduce_output(config)
+
     for message in get_param("messages"):
         print(message)
     
+    if config.input_cache_dir:
+        print("input cache: {} hits, {} misses".format(get_param("input_cache_hits"), get_param("input_cache_misses")))
+
+    if map_output_cache is not None:
+        print("map output cache: output of {} files replayed".format(map_output_cache.replayed))
+
+    if job_metrics is not None:
+        write_job_metrics(config, job_metrics, (datetime.datetime.now() - start_time).total_seconds())
+
+    if config.profile:
+        fetch_profiles(config, instances, ssh_key)
+        finish_profiling(config)
+
+    if tracer is not None:
+        tracer.save(config.trace)
+
     print("done. elapsed time: {}".format(str(datetime.datetime.now() - start_time)))
-    print("results are in {}".format(config.output_filename))
+    print("results are in {}".format(get_results_description(config)))
 
 def run(config):
     configure_job(config)
+    configure_partitions(config)
 
-    print("getting list of the files to process...")
-    bytes_total, file_names = get_uris(config)
-    if len(file_names) <= 0:
+    input_queue = WakeupQueue(Waker())
+    abort_event = threading.Event()
+    # with --stream-listing files keep being listed while instances start
+    tracker = get_output_tracker(config)
+    journal = get_journal(config)
+    map_output_cache = get_map_output_cache(config)
+    tracer = get_tracer(config)
+    listing_done = start_listing(config, input_queue, abort_event, tracker, journal, map_output_cache, tracer)
+    if listing_done.is_set() and get_param("files_listed") <= 0 and (journal is None or not journal.files):
         sys.stderr.write("no files to process\n")
         sys.exit(1)
 
@@ -338,7 +314,7 @@ echo "ssh-rsa {public_key} smr" > /home/{user}/.ssh/authorized_keys
         instance.add_tag('Name', 'smr-worker')
         instance.add_tag('job', os.path.basename(config.config))
     try:
-        run_helper(config, ssh_key, bytes_total, file_names, instances)
+        run_helper(config, ssh_key, input_queue, listing_done, abort_event, tracker, journal, map_output_cache, tracer, instances)
     finally:
         instance_ids = [instance.id for instance in instances]
         print("terminating all instances: {}".format(",".join(instance_ids)))
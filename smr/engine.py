@@ -0,0 +1,71 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import fcntl
+import multiprocessing
+import os
+import signal
+import subprocess
+import sys
+
+ENGINES = ("subprocess", "multiprocessing")
+PARENT_FDS = [] # pipe ends of forked workers used by smr, closed in other forked workers
+
+def map_worker(config, stdin_fd, stdout_fd, stderr_fd, parent_fds):
+    from .map import run_mapper # smr.map imports smr.config, which imports this module
+    from .uri import reset_after_fork
+    reset_after_fork()
+    # pipe ends that belong to smr, workers wouldn't get EOF on their stdin if this process kept a copy of them
+    for fd in parent_fds:
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+    sys.stdin = os.fdopen(stdin_fd, "rb")
+    sys.stdout = os.fdopen(stdout_fd, "wb")
+    sys.stderr = os.fdopen(stderr_fd, "wb")
+    run_mapper(config)
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+class MapWorker(object):
+    """
+    smr-map forked from smr with multiprocessing instead of started as a new process,
+    so that the job is loaded and configured only once and the worker shares already imported modules
+
+    it has the part of subprocess.Popen interface that smr uses, and talks to smr over pipes the same way smr-map does
+    """
+    def __init__(self, config):
+        stdin_read, stdin_write = os.pipe()
+        stdout_read, stdout_write = os.pipe()
+        stderr_read, stderr_write = os.pipe()
+        parent_fds = [stdin_write, stdout_read, stderr_read]
+        self.process = multiprocessing.Process(target=map_worker, args=(config, stdin_read, stdout_write, stderr_write, PARENT_FDS + parent_fds))
+        self.process.start()
+        for fd in (stdin_read, stdout_write, stderr_write):
+            os.close(fd)
+        for fd in parent_fds:
+            # reducers started later mustn't inherit them either
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        PARENT_FDS.extend(parent_fds)
+        self.pid = self.process.pid
+        self.stdin = os.fdopen(stdin_write, "wb", 0)
+        self.stdout = os.fdopen(stdout_read, "rb", 0)
+        self.stderr = os.fdopen(stderr_read, "rb")
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None:
+            self.returncode = self.process.exitcode
+        return self.returncode
+
+    def wait(self):
+        self.process.join()
+        return self.poll()
+
+    def kill(self):
+        os.kill(self.pid, signal.SIGKILL)
+
+def start_map_process(config, map_args):
+    """ starts a mapper using config.engine, returns subprocess.Popen or an object that behaves like one """
+    if config.engine == "multiprocessing":
+        return MapWorker(config)
+    return subprocess.Popen(map_args, bufsize=0, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
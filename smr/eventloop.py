@@ -0,0 +1,367 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import errno
+import fcntl
+import os
+from Queue import Empty, Queue
+import select
+import socket
+import threading
+
+from .metrics import METRICS_STATUS
+from .shared import add_message, handle_status_line
+from .speculate import MAX_QUEUED_OUTPUT, OutputCommitter, OutputFeeder
+from .split import split_bundle
+from .trace import TRACE_STATUS
+from .transport import READ_SIZE, get_decoder
+
+# idle mappers wait for listing to finish or for a file to be speculated, neither wakes up the coordinator
+IDLE_CHECK_INTERVAL = 1.0
+
+OUTPUT = "output"
+STATUS = "status"
+
+class Waker(object):
+    """ self-pipe that wakes up the coordinator when other threads change something it waits for """
+    def __init__(self):
+        self.read_fd, self.write_fd = os.pipe()
+        for fd in (self.read_fd, self.write_fd):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        # True while a byte is in the pipe, so that frequent wakeups don't write a byte each
+        self.pending = False
+        self.lock = threading.Lock()
+
+    def fileno(self):
+        return self.read_fd
+
+    def wake(self):
+        with self.lock:
+            if self.pending:
+                return
+            self.pending = True
+            try:
+                os.write(self.write_fd, b"\0")
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+
+    def clear(self):
+        # a wakeup can't happen between draining the pipe and resetting pending, it would be lost for good
+        with self.lock:
+            try:
+                while os.read(self.read_fd, READ_SIZE):
+                    pass
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+            self.pending = False
+
+class WakeupQueue(Queue):
+    """ Queue that wakes up the coordinator whenever an item is put into it or taken out of it """
+    def __init__(self, waker):
+        Queue.__init__(self)
+        self.waker = waker
+
+    def _put(self, item):
+        Queue._put(self, item)
+        self.waker.wake()
+
+    def _get(self):
+        item = Queue._get(self)
+        self.waker.wake()
+        # several threads may wait for room in the queue, see wait_for_room
+        self.not_full.notify_all()
+        return item
+
+class MapperConnection(object):
+    """ a mapper that the coordinator sends work items to, and reads map output and status lines from """
+    def __init__(self, name, pid=None):
+        self.name = name # identifies the mapper in job report
+        self.pid = pid # of local processes, whose CPU usage is shown on screen
+        self.decoder = None
+        self.committer = None
+        self.status_buffer = b""
+        self.in_flight = 0
+        self.files_in_flight = [] # in order they were sent, the first one is being processed
+        self.files_processed = 0
+        self.bytes_processed = 0
+        self.input_closed = False
+        self.output_done = False
+        self.status_done = False
+        self.finished = False
+        self.exit_code = None
+
+    def close_input(self):
+        self.input_closed = True
+
+class LocalMapper(MapperConnection):
+    """ smr-map process started by smr, or a worker forked from it """
+    def __init__(self, map_process):
+        MapperConnection.__init__(self, "{}:{}".format(socket.gethostname(), map_process.pid), map_process.pid)
+        self.process = map_process
+        self.stdout_fd = map_process.stdout.fileno()
+        self.stderr_fd = map_process.stderr.fileno()
+
+    def get_read_fds(self, read_output):
+        fds = []
+        if read_output and not self.output_done:
+            fds.append(self.stdout_fd)
+        if not self.status_done:
+            fds.append(self.stderr_fd)
+        return fds
+
+    def read(self, fd):
+        """ returns a list of (stream, data) tuples, data is empty once stream was closed """
+        return [(OUTPUT if fd == self.stdout_fd else STATUS, os.read(fd, READ_SIZE))]
+
+    def write(self, data):
+        self.process.stdin.write(data)
+        self.process.stdin.flush()
+
+    def close_input(self):
+        MapperConnection.close_input(self)
+        try:
+            self.process.stdin.close()
+        except IOError:
+            pass
+
+    def wait(self):
+        return self.process.wait()
+
+    def stop(self):
+        self.process.kill()
+
+class SshMapper(MapperConnection):
+    """ smr-map running on an EC2 instance, connected over SSH """
+    def __init__(self, name, chan, ssh):
+        MapperConnection.__init__(self, name)
+        self.chan = chan
+        self.ssh = ssh
+        self.fd = chan.fileno()
+        self.stdin = chan.makefile("wb")
+
+    def get_read_fds(self, read_output):
+        # stdout and stderr of a channel share a single descriptor, none of them is read while reducers are behind
+        if not read_output or (self.output_done and self.status_done):
+            return []
+        return [self.fd]
+
+    def read(self, fd):
+        eof = self.chan.eof_received or self.chan.closed
+        events = []
+        while self.chan.recv_ready():
+            events.append((OUTPUT, self.chan.recv(READ_SIZE)))
+        while self.chan.recv_stderr_ready():
+            events.append((STATUS, self.chan.recv_stderr(READ_SIZE)))
+        if eof:
+            # everything that was received before EOF was read above
+            if not self.output_done:
+                events.append((OUTPUT, b""))
+            if not self.status_done:
+                events.append((STATUS, b""))
+        return events
+
+    def write(self, data):
+        self.stdin.write(data)
+        self.stdin.flush()
+
+    def close_input(self):
+        MapperConnection.close_input(self)
+        # stdin.close() is not enough with paramiko to actually close it, need to do this too:
+        self.stdin.close()
+        self.chan.shutdown_write()
+
+    def wait(self):
+        exit_code = self.chan.recv_exit_status()
+        self.ssh.close()
+        return exit_code
+
+    def stop(self):
+        self.chan.close()
+
+class Coordinator(object):
+    """
+    event loop that sends work items to all mappers and reads their output and status lines, local or over SSH,
+    so that smr doesn't need two threads per mapper
+
+    input_queue and output_queue are WakeupQueues with the same Waker, so that the coordinator wakes up
+    as soon as files are queued or reducers take map output, instead of polling them
+    """
+    def __init__(self, config, input_queue, output_queue, processed_files_queue, listing_done, abort_event, tracker=None, map_output_cache=None, job_metrics=None, tracer=None):
+        self.config = config
+        self.input_queue = input_queue
+        self.output_queue = output_queue
+        self.processed_files_queue = processed_files_queue
+        self.listing_done = listing_done
+        self.abort_event = abort_event
+        self.tracker = tracker
+        self.map_output_cache = map_output_cache
+        self.job_metrics = job_metrics
+        self.tracer = tracer
+        self.waker = input_queue.waker
+        self.max_in_flight = 1 + config.prefetch
+        self.mappers = []
+        # output of files is committed by the feeder thread while their spilled output waits for reducers
+        self.feeder = OutputFeeder(self.waker) if tracker is not None else None
+
+    def add(self, mapper):
+        mapper.decoder = get_decoder(self.config)
+        if self.tracker is not None:
+            mapper.committer = OutputCommitter(self.tracker, self.output_queue, self.config, self.map_output_cache, self.abort_event, self.feeder)
+        self.mappers.append(mapper)
+
+    def is_done(self):
+        if self.abort_event.is_set():
+            return True
+        if self.tracker is not None and self.tracker.is_finished(self.listing_done):
+            # with --speculative, some mappers may still be processing files that other mappers already processed,
+            # they're stopped, others had their input closed and exit on their own
+            return all(mapper.finished or self.is_duplicating(mapper) for mapper in self.mappers)
+        return all(mapper.finished for mapper in self.mappers)
+
+    def is_duplicating(self, mapper):
+        """ returns True if mapper is processing a file whose output it didn't finish, once output of all files was committed """
+        return any(file_name not in mapper.committer.marked_items for file_name in mapper.files_in_flight)
+
+    def run(self):
+        """ returns once all mappers exited, output of all files was queued for reducers, or the job was aborted """
+        try:
+            self.run_loop()
+        finally:
+            if self.feeder is not None:
+                self.feeder.stop()
+
+    def run_loop(self):
+        while not self.is_done():
+            for mapper in self.mappers:
+                self.send_items(mapper)
+            if self.is_done():
+                break
+            # don't fill memory with map output faster than reducers can take it, mappers block on their stdout instead
+            # or faster than the feeder commits it
+            read_output = self.output_queue.qsize() < MAX_QUEUED_OUTPUT and (self.feeder is None or not self.feeder.is_busy())
+            fds = {}
+            idle = False
+            for mapper in self.mappers:
+                for fd in mapper.get_read_fds(read_output):
+                    fds[fd] = mapper
+                if not mapper.finished and not mapper.input_closed and mapper.in_flight == 0:
+                    idle = True
+            try:
+                readable, _, _ = select.select(list(fds) + [self.waker], [], [], IDLE_CHECK_INTERVAL if idle else None)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            self.waker.clear()
+            for fd in readable:
+                mapper = fds.get(fd)
+                if mapper is None or mapper.finished:
+                    continue
+                for stream, data in mapper.read(fd):
+                    if stream == OUTPUT:
+                        self.handle_output(mapper, data)
+                    else:
+                        self.handle_status(mapper, data)
+                if mapper.output_done and mapper.status_done:
+                    self.finish(mapper)
+
+    def send_items(self, mapper):
+        """
+        sends work items to mapper until max_in_flight items were sent to it and not yet processed,
+        its input is closed if there is nothing left to process
+        with --speculative, idle mappers are kept around to process files that take too long again
+        """
+        while not mapper.finished and not mapper.input_closed and mapper.in_flight < self.max_in_flight and not self.abort_event.is_set():
+            speculative = False
+            try:
+                item = self.input_queue.get_nowait()
+            except Empty:
+                if mapper.in_flight > 0 or not self.listing_done.is_set():
+                    return # mapper is still busy, or more files are going to be listed
+                if self.tracker is not None and not self.tracker.is_finished(self.listing_done):
+                    item = self.tracker.get_speculative_item()
+                    if item is None:
+                        return # wait for stragglers, or for files that failed on other mappers to be requeued
+                    add_message("{} is taking too long, processing it again".format(item))
+                    speculative = True
+                else:
+                    # no more files in queue
+                    mapper.close_input()
+                    return
+            try:
+                mapper.write("{}\n".format(item))
+            except (IOError, OSError):
+                if not speculative:
+                    self.input_queue.put(item) # let other mappers process it
+                mapper.input_closed = True # probably bad descriptor
+                return
+            finally:
+                if not speculative:
+                    self.input_queue.task_done()
+            # mapper reports status of each file in a bundle
+            files = split_bundle(item)
+            if self.tracker is not None:
+                for file_name in files:
+                    self.tracker.start(file_name)
+            mapper.in_flight += len(files)
+            mapper.files_in_flight.extend(files)
+            if self.tracer is not None:
+                for file_name in files:
+                    self.tracer.dispatch(mapper.name, file_name)
+
+    def handle_output(self, mapper, data):
+        if data:
+            blocks = mapper.decoder.feed(data)
+        else:
+            mapper.output_done = True
+            blocks = mapper.decoder.finish()
+        for block in blocks:
+            if mapper.committer is not None:
+                mapper.committer.add(block)
+            else:
+                self.output_queue.put(block)
+
+    def handle_status(self, mapper, data):
+        if data:
+            lines = (mapper.status_buffer + data).split(b"\n")
+            mapper.status_buffer = lines.pop()
+        else:
+            mapper.status_done = True
+            lines = [mapper.status_buffer] if mapper.status_buffer else []
+            mapper.status_buffer = b""
+        for line in lines:
+            if line.startswith(METRICS_STATUS + ","):
+                if self.job_metrics is not None:
+                    self.job_metrics.add_status_line(mapper.name, line)
+                continue
+            if line.startswith(TRACE_STATUS + ","):
+                if self.tracer is not None:
+                    self.tracer.add_status_line(mapper.name, line)
+                continue
+            if handle_status_line(line, self.processed_files_queue, self.input_queue, self.tracker):
+                mapper.in_flight -= 1
+                file_status, file_size, file_name = line.rstrip().split(",", 2)
+                try:
+                    mapper.files_in_flight.remove(file_name)
+                except ValueError:
+                    pass
+                if mapper.committer is not None:
+                    mapper.committer.marked_items.discard(file_name)
+                if file_status == "+":
+                    mapper.files_processed += 1
+                    mapper.bytes_processed += int(file_size)
+                if self.tracer is not None:
+                    self.tracer.finish_dispatch(mapper.name, file_name)
+        if not mapper.status_done:
+            self.send_items(mapper)
+
+    def finish(self, mapper):
+        """ called once mapper closed its stdout and stderr """
+        mapper.exit_code = mapper.wait()
+        mapper.finished = True
+        if mapper.committer is not None:
+            mapper.committer.close()
+        if mapper.in_flight > 0:
+            # mapper exited before it processed all files it was sent
+            self.abort_event.set()
@@ -0,0 +1,164 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import cPickle as pickle
+import errno
+import json
+import os
+import sys
+import threading
+
+from .config import get_config_module
+from .sort import is_grouped_reduce
+from .speculate import MARKER_PREFIX
+from .transport import records_to_block, to_bytes
+
+# records that smr sends to reducers when using --journal
+CHECKPOINT_MARKER = MARKER_PREFIX + b"checkpoint\t"
+RESTORE_MARKER = MARKER_PREFIX + b"restore\t"
+JOURNAL_FILENAME = "journal.json"
+
+def get_journal(config):
+    """ returns Journal for --journal or --resume, None if job isn't journaled """
+    if config.resume:
+        config.journal = config.resume
+    if not config.journal:
+        return None
+    if is_grouped_reduce(config):
+        sys.stderr.write("--journal can't be used with REDUCE_FUNC that takes a key and its values\n")
+        sys.exit(1)
+    if config.SAVE_STATE_FUNC is None and not hasattr(get_config_module(config.config), "global_result"):
+        sys.stderr.write("--journal needs SAVE_STATE_FUNC and LOAD_STATE_FUNC or global_result in config\n")
+        sys.exit(1)
+    journal = Journal(config.journal, config.reducers)
+    if config.resume:
+        journal.load()
+    return journal
+
+class Journal(object):
+    """
+    directory with the list of files that were processed, and state of each reducer after reducing their map output
+
+    journal.json is only rewritten after all reducers saved their state for the same checkpoint,
+    so it always refers to state that contains output of exactly the files it lists
+    """
+    def __init__(self, directory, reducers):
+        self.directory = directory
+        self.reducers = reducers
+        self.sequence = 0 # sequence number of last checkpoint, 0 if there is none
+        self.files = [] # files listed in journal.json
+        self.completed_files = frozenset() # files processed before the job was resumed
+        self.lock = threading.Lock() # held while a checkpoint is being made
+        self.finished = False # set once the final checkpoint was made
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def get_filename(self):
+        return os.path.join(self.directory, JOURNAL_FILENAME)
+
+    def get_state_filename(self, part, sequence):
+        return os.path.join(self.directory, "state.part-{:05d}.{}".format(part, sequence))
+
+    def load(self):
+        try:
+            with open(self.get_filename()) as f:
+                data = json.load(f)
+        except IOError:
+            print("no checkpoint in {}, starting from the beginning".format(self.directory))
+            return
+        if data["reducers"] != self.reducers:
+            sys.stderr.write("journal was written by a job with {} reducers, can't resume with {}\n".format(data["reducers"], self.reducers))
+            sys.exit(1)
+        self.sequence = data["sequence"]
+        self.files = data["files"]
+        self.completed_files = frozenset(self.files)
+        self.remove_stale_states()
+        print("resuming from checkpoint {}, skipping {} processed files".format(self.sequence, len(self.files)))
+
+    def save(self, sequence, files):
+        temp_filename = self.get_filename() + ".tmp"
+        with open(temp_filename, "w") as f:
+            json.dump({"sequence": sequence, "reducers": self.reducers, "files": files}, f)
+        os.rename(temp_filename, self.get_filename())
+        self.sequence = sequence
+        self.files = files
+        self.remove_stale_states()
+
+    def remove_stale_states(self):
+        """ removes state files of reducers other than those of the last checkpoint, e.g. of a checkpoint that was never saved """
+        for file_name in os.listdir(self.directory):
+            if file_name.startswith("state.part-") and file_name.rsplit(".", 1)[1] != unicode(self.sequence):
+                try:
+                    os.unlink(os.path.join(self.directory, file_name))
+                except OSError:
+                    pass
+
+    def has_state(self, sequence):
+        return all(os.path.exists(self.get_state_filename(part, sequence)) for part in xrange(self.reducers))
+
+class Checkpoint(object):
+    """ item of output_queue that tells reducers to save their state once they've reduced output queued before it """
+    def __init__(self, journal, sequence):
+        self.journal = journal
+        self.sequence = sequence
+
+    def get_block(self, part, config):
+        """ returns the block of map output that's written to reducer part """
+        state_filename = self.journal.get_state_filename(part, self.sequence)
+        return records_to_block([CHECKPOINT_MARKER + to_bytes(state_filename)], config)
+
+def get_restore_block(journal, part, config):
+    """ returns the block that makes reducer part load its state from the last checkpoint """
+    state_filename = journal.get_state_filename(part, journal.sequence)
+    return records_to_block([RESTORE_MARKER + to_bytes(state_filename)], config)
+
+def save_checkpoint(journal, tracker, output_queue, abort_event, final=False):
+    """
+    saves state of reducers and the list of files they've reduced, returns False if the job was aborted meanwhile
+    or the final checkpoint was already saved
+    the final checkpoint is saved once reducers took output of all files, so that resuming the job doesn't process them again
+    """
+    with journal.lock:
+        if journal.finished:
+            return False
+        journal.finished = final
+        sequence = journal.sequence + 1
+        with tracker.commit_lock:
+            # output of committed files is already in output_queue, ahead of the checkpoint
+            files = sorted(journal.completed_files) + tracker.committed_items
+            output_queue.put(Checkpoint(journal, sequence))
+        while not journal.has_state(sequence):
+            if abort_event.wait(1):
+                return False
+        journal.save(sequence, files)
+        return True
+
+def checkpoint_thread(config, journal, tracker, output_queue, abort_event):
+    """ every config.checkpoint_interval seconds, saves a checkpoint until the job is done """
+    while not abort_event.wait(config.checkpoint_interval):
+        if not save_checkpoint(journal, tracker, output_queue, abort_event):
+            return
+
+def handle_control_record(config, record):
+    """ called by smr-reduce for records that smr sends instead of map output """
+    if record.startswith(CHECKPOINT_MARKER):
+        save_reduce_state(config, record[len(CHECKPOINT_MARKER):].decode("utf-8"))
+    elif record.startswith(RESTORE_MARKER):
+        load_reduce_state(config, record[len(RESTORE_MARKER):].decode("utf-8"))
+
+def save_reduce_state(config, filename):
+    temp_filename = filename + ".tmp"
+    with open(temp_filename, "wb") as f:
+        if config.SAVE_STATE_FUNC is not None:
+            config.SAVE_STATE_FUNC(f)
+        else:
+            pickle.dump(get_config_module(config.config).global_result, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(temp_filename, filename)
+
+def load_reduce_state(config, filename):
+    with open(filename, "rb") as f:
+        if config.LOAD_STATE_FUNC is not None:
+            config.LOAD_STATE_FUNC(f)
+        else:
+            get_config_module(config.config).global_result = pickle.load(f)
@@ -3,133 +3,70 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 import curses
 import datetime
 import os
-import psutil
 from Queue import Queue
-import subprocess
 import sys
 import threading
 
-from .version import __version__
 from .config import get_config, configure_job
-from .shared import reduce_thread, progress_thread, write_file_to_descriptor, print_pid, \
-    get_param, add_message, add_str, ensure_dir_exists, get_args
-from .uri import get_uris
-
-def worker_stdout_read_thread(output_queue, map_process, abort_event):
-    check_map_process(map_process, abort_event)
-    for line in iter(map_process.stdout.readline, ""):
-        output_queue.put(line)
-    map_process.wait()
-
-def check_map_process(map_process, abort_event):
-    map_process.poll()
-    if map_process.returncode is not None:
-        abort_event.set()
-
-def worker_stderr_read_thread(processed_files_queue, input_queue, map_process, abort_event):
-    check_map_process(map_process, abort_event)
-
-    # write first file to mapper
-    if not abort_event.is_set() and not write_file_to_descriptor(input_queue, map_process.stdin):
-        abort_event.set()
-        return
-
-    for line in iter(map_process.stderr.readline, ""):
-        line = line.rstrip() # remove trailing linebreak
-        splt = line.split(",", 2)
-        if len(splt) != 3:
-            add_message("invalid message received from mapper: {}".format(line))
-        else:
-            file_status, file_size, file_name = splt
-            if file_status == "+":
-                processed_files_queue.put((file_name, int(file_size)))
-            elif file_status == "!":
-                add_message("error processing {}, requeuing...".format(file_name))
-                input_queue.put(file_name) # re-queue file
-            else:
-                add_message("invalid status received from mapper: {}".format(file_status))
-
-        if abort_event.is_set() or not write_file_to_descriptor(input_queue, map_process.stdin):
-            break
-
-        check_map_process(map_process, abort_event)
-
-    if not abort_event.is_set():
-        map_process.wait()
-
-def curses_thread(config, abort_event, map_processes, reduce_processes, window, start_time, bytes_total):
-    map_pids = [psutil.Process(x.pid) for x in map_processes]
-    reduce_pids = [psutil.Process(x.pid) for x in reduce_processes]
-    sleep_time = config.screen_refresh_interval - (config.cpu_usage_interval * (len(map_pids) + len(reduce_pids)))
-    while not abort_event.is_set() and sleep_time > 0 and not abort_event.wait(sleep_time):
-        if abort_event.is_set():
-            break
-        window.clear()
-        now = datetime.datetime.now()
-        add_str(window, 0, "smr v{} - {} - elapsed: {}".format(__version__, datetime.datetime.ctime(now), now - start_time))
-        i = 1
-        for p in map_pids:
-            print_pid(p, window, i, "smr-map")
-            i += 1
-        for p in reduce_pids:
-            print_pid(p, window, i, "smr-reduce")
-            i += 1
-
-        add_str(window, i + 1, "job progress: {0:%}".format(get_param("bytes_processed") / bytes_total))
-        add_str(window, i + 2, "last file processed: {}".format(get_param("last_file_processed")))
-        messages = get_param("messages")[-10:]
-        if len(messages) > 0:
-            add_str(window, i + 3, "last messages:")
-            i += 4
-            for message in messages:
-                add_str(window, i, "  {}".format(message))
-                i += 1
-        if not abort_event.is_set():
-            window.refresh()
+from .shared import reduce_thread, progress_thread, get_param, ensure_dir_exists, get_args, \
+    start_reduce_processes, finish_reduce_processes, merge_reduce_output, get_results_description, start_listing, \
+    restore_reduce_state, start_checkpoint_thread, stop_threads
+from .dashboard import Dashboard, dashboard_thread
+from .engine import start_map_process
+from .eventloop import Coordinator, LocalMapper, Waker, WakeupQueue
+from .journal import get_journal, save_checkpoint
+from .memo import get_map_output_cache
+from .metrics import get_job_metrics, write_job_metrics
+from .profiling import finish_profiling, start_profiling
+from .speculate import get_output_tracker
+from .trace import get_tracer
+from .transport import configure_partitions
 
 def run(config):
     configure_job(config)
-    print("getting list of the files to process...")
-    bytes_total, file_names = get_uris(config)
-    files_total = len(file_names)
-    if files_total <= 0:
-        print("no files to process")
-        sys.exit(1)
-
-    input_queue = Queue(files_total)
-    for file_name in file_names:
-        input_queue.put(file_name)
-    output_queue = Queue()
-    processed_files_queue = Queue(files_total)
-
-    start_time = datetime.datetime.now()
+    configure_partitions(config)
+    waker = Waker()
+    input_queue = WakeupQueue(waker)
+    output_queue = WakeupQueue(waker)
+    processed_files_queue = Queue()
     abort_event = threading.Event()
+    tracker = get_output_tracker(config)
+    journal = get_journal(config)
+    map_output_cache = get_map_output_cache(config)
+    job_metrics = get_job_metrics(config)
+    tracer = get_tracer(config)
 
+    start_profiling(config)
     map_args = get_args("smr-map", config)
 
-    map_processes = []
-    read_workers = []
-    for _ in xrange(config.workers):
-        map_process = subprocess.Popen(map_args, bufsize=0, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        map_processes.append(map_process)
+    # all mappers are started before listing and other threads, forked workers get a copy of the parent process,
+    # and mustn't inherit S3 connections or locks held by listing threads
+    map_processes = [start_map_process(config, map_args) for _ in xrange(config.workers)]
+
+    listing_done = start_listing(config, input_queue, abort_event, tracker, journal, map_output_cache, tracer)
+    if listing_done.is_set() and get_param("files_listed") <= 0 and (journal is None or not journal.files):
+        for map_process in map_processes:
+            map_process.kill()
+            map_process.wait()
+        finish_profiling(config)
+        print("no files to process")
+        sys.exit(1)
 
-        row = threading.Thread(target=worker_stdout_read_thread, args=(output_queue, map_process, abort_event))
-        row.daemon = True
-        row.start()
+    start_time = datetime.datetime.now()
 
-        rew = threading.Thread(target=worker_stderr_read_thread, args=(processed_files_queue, input_queue, map_process, abort_event))
-        rew.daemon = True
-        rew.start()
-        read_workers.append(rew)
+    coordinator = Coordinator(config, input_queue, output_queue, processed_files_queue, listing_done, abort_event, tracker, map_output_cache, job_metrics, tracer)
+    for map_process in map_processes:
+        coordinator.add(LocalMapper(map_process))
 
     if not config.output_filename:
         config.output_filename = "results/{}.{}.out".format(os.path.basename(config.config), datetime.datetime.now().strftime("%Y-%m-%d_%H:%M:%S.%f"))
     ensure_dir_exists(config.output_filename)
 
-    reduce_stdout = open(config.output_filename, "w")
-    reduce_process = subprocess.Popen(get_args("smr-reduce", config), bufsize=0, stdin=subprocess.PIPE, stdout=reduce_stdout, stderr=subprocess.PIPE)
+    reducers = start_reduce_processes(config)
+    reduce_processes = [reduce_process for reduce_process, _ in reducers]
+    restore_reduce_state(config, reduce_processes, journal)
 
-    reduce_worker = threading.Thread(target=reduce_thread, args=(reduce_process, output_queue, abort_event))
+    reduce_worker = threading.Thread(target=reduce_thread, args=(reduce_processes, output_queue, abort_event, config, tracer))
     #reduce_worker.daemon = True
     reduce_worker.start()
 
@@ -137,26 +74,39 @@ def run(config):
     #progress_worker.daemon = True
     progress_worker.start()
 
+    start_checkpoint_thread(config, journal, tracker, output_queue, abort_event)
+    if map_output_cache is not None:
+        map_output_cache.start(input_queue, output_queue, processed_files_queue, tracker, abort_event)
+
     if config.output_job_progress:
         window = curses.initscr()
-        curses_worker = threading.Thread(target=curses_thread, args=(config, abort_event, map_processes, [reduce_process], window, start_time, bytes_total))
+        dashboard = Dashboard("smr", coordinator.mappers, reduce_processes, input_queue, output_queue, listing_done, start_time, bool(config.input_cache_dir))
+        curses_worker = threading.Thread(target=dashboard_thread, args=(dashboard, window, abort_event, config.screen_refresh_interval))
         #curses_worker.daemon = True
         curses_worker.start()
 
     try:
-        for w in read_workers:
-            w.join()
+        coordinator.run()
     except KeyboardInterrupt:
-        abort_event.set()
+        stop_threads(abort_event, output_queue, processed_files_queue, map_output_cache)
         if config.output_job_progress:
             curses.endwin()
         print("user aborted. elapsed time: {}".format(str(datetime.datetime.now() - start_time)))
-        print("partial results are in {}".format(config.output_filename))
+        print("partial results are in {}".format(get_results_description(config)))
         sys.exit(1)
 
+    stopped_processes = []
+    for mapper in coordinator.mappers:
+        if not mapper.finished:
+            # still processing a file that was already processed by another worker, or the job was aborted
+            mapper.stop()
+            stopped_processes.append(mapper.process)
+
     if not abort_event.is_set():
         output_queue.join() # wait for reducer to process everything
-        abort_event.set()
+        if journal is not None:
+            save_checkpoint(journal, tracker, output_queue, abort_event, final=True)
+    stop_threads(abort_event, output_queue, processed_files_queue, map_output_cache)
 
     if config.output_job_progress:
         curses_worker.join()
@@ -164,26 +114,42 @@ def run(config):
 
     # wait for reduce to finish before exiting
     reduce_worker.join()
-    (_, stderr) = reduce_process.communicate()
-    if stderr:
-        sys.stderr.write(stderr)
-    if reduce_process.returncode != 0:
-        print("reduce process {} exited with code {}".format(reduce_process.pid, reduce_process.returncode))
-        print("partial results are in {}".format(config.output_filename))
+    if not finish_reduce_processes(reducers):
+        print("partial results are in {}".format(get_results_description(config)))
         sys.exit(1)
 
     for map_process in map_processes:
-        if map_process.returncode != 0:
+        if map_process.returncode != 0 and map_process not in stopped_processes:
             print("map process {} exited with code {}".format(map_process.pid, map_process.returncode))
-            print("partial results are in {}".format(config.output_filename))
+            print("partial results are in {}".format(get_results_description(config)))
             sys.exit(1)
 
-    reduce_stdout.close()
+    if get_param("files_listed") <= 0 and (journal is None or not journal.files):
+        print("no files to process")
+        sys.exit(1)
+
+    if config.merge_reduce_output:
+        merge_reduce_output(config)
+
     for message in get_param("messages"):
         print(message)
 
+    if config.input_cache_dir:
+        print("input cache: {} hits, {} misses".format(get_param("input_cache_hits"), get_param("input_cache_misses")))
+
+    if map_output_cache is not None:
+        print("map output cache: output of {} files replayed".format(map_output_cache.replayed))
+
+    if job_metrics is not None:
+        write_job_metrics(config, job_metrics, (datetime.datetime.now() - start_time).total_seconds())
+
+    finish_profiling(config)
+
+    if tracer is not None:
+        tracer.save(config.trace)
+
     print("done. elapsed time: {}".format(str(datetime.datetime.now() - start_time)))
-    print("results are in {}".format(config.output_filename))
+    print("results are in {}".format(get_results_description(config)))
 
 def main():
     config = get_config()
@@ -2,43 +2,381 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 from inspect import getargspec
 import os
+from Queue import Empty, Queue
+import shutil
 import sys
+import tempfile
+import threading
+import time
 
 from .config import get_config, configure_job
-from .uri import download, cleanup
+from .metrics import METRICS_STATUS, format_metrics
+from .profiling import dump_profile, get_profiler, profile_calls
+from .speculate import get_marker
+from .split import SplitReader, get_split_suffix, parse_work_item, split_bundle
+from .trace import SpanWriter
+from .transport import FrameWriter, PartitionWriter, to_bytes
+from .uri import download, cleanup, open_uri, pop_cache_status
 
-def write_to_stderr(file_status, file_size, file_name):
-    sys.stderr.write("{},{},{}\n".format(file_status, file_size, file_name))
-    sys.stderr.flush()
+class CombineBuffer(object):
+    """
+    file-like object that replaces sys.stdout in smr-map when COMBINE_FUNC is defined in config
+    collects lines printed by MAP_FUNC and passes them through COMBINE_FUNC before they are written to output,
+    either when the buffer grows above max_size bytes or when combine() is called after each file
+    """
+    def __init__(self, combine_func, output, max_size):
+        self.combine_func = combine_func
+        self.output = output
+        self.max_size = max_size
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data):
+        data = to_bytes(data)
+        self.chunks.append(data)
+        self.size += len(data)
+        if self.size >= self.max_size:
+            self.combine(partial=True)
+
+    def flush(self):
+        pass # output is flushed after it was combined
+
+    def combine(self, partial=False):
+        """
+        pass buffered lines through COMBINE_FUNC and write the result to output
+        if partial is True, an unterminated last line is kept in the buffer
+        """
+        data = b"".join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        lines = data.split(b"\n")
+        remainder = lines.pop()
+        if remainder and partial:
+            self.chunks.append(remainder)
+            self.size = len(remainder)
+        elif remainder:
+            lines.append(remainder)
+        if len(lines) > 0:
+            for line in self.combine_func(lines):
+                self.output.write(to_bytes(line))
+                self.output.write(b"\n")
+        self.output.flush()
+
+    def discard(self):
+        """
+        drops lines that weren't combined yet, output that was already written by combine(partial=True) is not affected,
+        it's only dropped by smr when smr-map marks the end of output of each file
+        """
+        self.chunks = []
+        self.size = 0
+
+class OutputCounter(object):
+    """ file-like object that counts records and bytes of map output written to output, used with --metrics """
+    def __init__(self, output):
+        self.output = output
+        self.records = 0
+        self.bytes = 0
+
+    def write(self, data):
+        data = to_bytes(data)
+        self.records += data.count(b"\n")
+        self.bytes += len(data)
+        self.output.write(data)
+
+    def flush(self):
+        self.output.flush()
+
+class StatusWriter(object):
+    """
+    writes status lines for smr to stderr
+    status of files that were received in a bundle is written with a single write once all of them are processed
+    """
+    def __init__(self, output):
+        self.output = output
+        self.bundles = {} # work item -> list of pending bundles it's part of
+        self.lock = threading.Lock()
+
+    def add_bundle(self, items):
+        bundle = {"remaining": len(items), "lines": []}
+        with self.lock:
+            for item in items:
+                self.bundles.setdefault(item, []).append(bundle)
+
+    def write(self, file_status, file_size, file_name, finished=True):
+        line = "{},{},{}\n".format(file_status, file_size, file_name)
+        with self.lock:
+            bundles = self.bundles.get(file_name)
+            if not bundles:
+                self.output.write(line)
+                self.output.flush()
+                return
+            bundle = bundles[0]
+            bundle["lines"].append(line)
+            if not finished:
+                return
+            bundles.pop(0)
+            if len(bundles) == 0:
+                del self.bundles[file_name]
+            bundle["remaining"] -= 1
+            if bundle["remaining"] == 0:
+                self.output.write("".join(bundle["lines"]))
+                self.output.flush()
+
+def read_uris(stream, status_writer):
+    for line in iter(stream.readline, ""):
+        items = split_bundle(line.rstrip()) # remove trailing linebreak
+        if len(items) > 1:
+            status_writer.add_bundle(items)
+        for item in items:
+            yield item
+
+def download_split(uri, split):
+    """ writes lines of split to a new temporary file, returns its name """
+    fd, temp_filename = tempfile.mkstemp(suffix=get_split_suffix(uri))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            shutil.copyfileobj(split, f)
+    except:
+        os.unlink(temp_filename)
+        raise
+    finally:
+        split.close()
+    return temp_filename
+
+def get_map_input(config, item):
+    """
+    returns what's going to be passed to MAP_FUNC for work item:
+    a readable file-like object if STREAM_INPUT is set in config, local filename otherwise
+    """
+    uri, offset, length = parse_work_item(item)
+    if offset is not None:
+        split = SplitReader(open_uri(config, uri, max(0, offset - 1)), offset, length, item)
+        if config.STREAM_INPUT:
+            return split
+        return download_split(uri, split)
+    if config.STREAM_INPUT:
+        return open_uri(config, uri)
+    return download(config, uri)
+
+def get_map_input_size(config, map_input):
+    if config.STREAM_INPUT:
+        size = getattr(map_input, "size", None)
+        if size is None:
+            size = os.fstat(map_input.fileno()).st_size
+        return size
+    return os.path.getsize(map_input)
+
+def cleanup_map_input(config, item, map_input):
+    uri, offset, _ = parse_work_item(item)
+    if config.STREAM_INPUT:
+        map_input.close()
+    elif offset is not None:
+        os.unlink(map_input)
+    else:
+        cleanup(uri, map_input)
+
+def download_map_input(config, uri, span_writer=None):
+    """ returns a tuple of (uri, input for MAP_FUNC, exception raised while downloading, seconds it took) """
+    start_time = time.time()
+    try:
+        return uri, get_map_input(config, uri), None, time.time() - start_time
+    except (KeyboardInterrupt, SystemExit):
+        raise
+    except Exception as e:
+        return uri, None, e, time.time() - start_time
+    finally:
+        if span_writer is not None:
+            span_writer.write("download", start_time, uri)
+
+def discard_download(config, downloaded):
+    """ deletes or closes input of a file that was downloaded but isn't going to be mapped """
+    uri, map_input, _, _ = downloaded
+    if map_input is not None:
+        cleanup_map_input(config, uri, map_input)
+
+class DownloadState(object):
+    """ shared by iter_downloads and its download threads """
+    def __init__(self, prefetch):
+        # a slot is taken before a download starts and given back once the file is taken by iter_downloads,
+        # so that at most prefetch files are being downloaded or waiting to be mapped
+        self.slots = threading.Semaphore(prefetch)
+        self.lock = threading.Lock()
+        self.stopped = False
+
+def download_thread(config, uri_queue, downloaded_queue, state, span_writer):
+    while True:
+        state.slots.acquire()
+        uri = uri_queue.get()
+        if uri is None or state.stopped:
+            downloaded_queue.put(None)
+            return
+        downloaded = download_map_input(config, uri, span_writer)
+        with state.lock:
+            if state.stopped:
+                # iter_downloads isn't going to take it anymore
+                discard_download(config, downloaded)
+                return
+            downloaded_queue.put(downloaded)
+
+def feed_thread(uris, uri_queue, num_download_threads):
+    for uri in uris:
+        uri_queue.put(uri)
+    for _ in xrange(num_download_threads):
+        uri_queue.put(None)
+
+def iter_downloads(config, uris, span_writer=None):
+    """
+    downloads or opens each uri, yields a tuple of
+    (uri, input for MAP_FUNC, exception raised while downloading, number of seconds it took to download)
+    if config.prefetch is positive, up to config.prefetch next files are downloaded in background threads
+    while current file is being processed
+    with STREAM_INPUT, only opening the file counts as downloading, the rest of it is read while it's being mapped
+    """
+    if config.prefetch <= 0:
+        for uri in uris:
+            yield download_map_input(config, uri, span_writer)
+        return
+
+    uri_queue = Queue()
+    downloaded_queue = Queue()
+    state = DownloadState(config.prefetch)
+    threads = [threading.Thread(target=feed_thread, args=(uris, uri_queue, config.prefetch))]
+    for i in xrange(config.prefetch):
+        threads.append(threading.Thread(target=download_thread, name="download-{}".format(i), args=(config, uri_queue, downloaded_queue, state, span_writer)))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    running_threads = config.prefetch
+    try:
+        while running_threads > 0:
+            downloaded = downloaded_queue.get()
+            if downloaded is None:
+                running_threads -= 1
+                continue
+            state.slots.release()
+            yield downloaded
+    finally:
+        # files that were already downloaded when the caller stopped iterating are deleted,
+        # download threads stop after their current download
+        with state.lock:
+            state.stopped = True
+            while True:
+                try:
+                    downloaded = downloaded_queue.get_nowait()
+                except Empty:
+                    break
+                if downloaded is not None:
+                    discard_download(config, downloaded)
+        for _ in xrange(config.prefetch):
+            state.slots.release()
+
+def end_output(output):
+    """ terminates the last line of output of a file if MAP_FUNC didn't, so that it isn't joined with output of the next file """
+    if isinstance(output, (FrameWriter, PartitionWriter)):
+        output.end_record()
+
+def write_marker(output, marker, terminate=False):
+    """ writes a marker record after output of a file, terminate starts it on a new line """
+    if isinstance(output, PartitionWriter):
+        output.write_marker(marker)
+    elif terminate:
+        output.write(b"\n" + marker + b"\n")
+    else:
+        output.write(marker + b"\n")
+    output.flush()
 
 def run(config):
     configure_job(config)
+    run_mapper(config)
+
+def run_mapper(config):
+    """ processes work items read from stdin, config must be already configured for the job """
+    if config.partitions > 1:
+        sys.stdout = PartitionWriter(sys.stdout, config.record_encoding, config.frame_size, config.partitions, config.KEY_FUNC)
+    elif config.transport == "framed":
+        sys.stdout = FrameWriter(sys.stdout, config.record_encoding, config.frame_size)
+    output = sys.stdout
+    output_counter = None
+    if config.metrics:
+        output_counter = OutputCounter(sys.stdout)
+        sys.stdout = output_counter
+    combine_buffer = None
+    if config.COMBINE_FUNC is not None:
+        combine_buffer = CombineBuffer(config.COMBINE_FUNC, sys.stdout, config.combine_buffer_size)
+        sys.stdout = combine_buffer
+    status_writer = StatusWriter(sys.stderr)
+    span_writer = SpanWriter(status_writer) if config.trace_spans else None
+    # allow passing uri to mapper, without breaking existing code
+    pass_uri = len(getargspec(config.MAP_FUNC).args) == 2
+    map_func = config.MAP_FUNC
+    profiler = get_profiler(config)
+    if profiler is not None:
+        map_func = profile_calls(profiler, map_func)
+    wait_start_time = time.time()
     try:
-        for uri in iter(sys.stdin.readline, ""):
-            uri = uri.rstrip() # remove trailing linebreak
-            temp_filename = None
+        for uri, map_input, download_error, download_seconds in iter_downloads(config, read_uris(sys.stdin, status_writer), span_writer):
+            report_start_time = None
             try:
-                temp_filename = download(config, uri)
-                file_size = os.path.getsize(temp_filename)
-                # allow passing uri to mapper, without breaking existing code
-                if len(getargspec(config.MAP_FUNC).args) == 2:
-                    config.MAP_FUNC(temp_filename, uri)
+                # time this mapper was idle, waiting for smr to send the file or for it to be downloaded in background
+                wait_seconds = time.time() - wait_start_time
+                if config.prefetch <= 0:
+                    wait_seconds = max(0.0, wait_seconds - download_seconds)
+                if download_error is not None:
+                    raise download_error
+                file_size = get_map_input_size(config, map_input)
+                if not config.STREAM_INPUT:
+                    cache_status = pop_cache_status(map_input)
+                    if cache_status is not None:
+                        status_writer.write("h" if cache_status else "m", file_size, uri, finished=False)
+                map_start_time = time.time()
+                if output_counter is not None:
+                    output_counter.records = output_counter.bytes = 0
+                if pass_uri:
+                    map_func(map_input, parse_work_item(uri)[0])
                 else:
-                    config.MAP_FUNC(temp_filename)
-                write_to_stderr("+", file_size, uri)
+                    map_func(map_input)
+                if combine_buffer is not None:
+                    combine_buffer.combine()
+                if span_writer is not None:
+                    span_writer.write("map", map_start_time, uri)
+                    report_start_time = time.time()
+                if output_counter is not None:
+                    map_seconds = time.time() - map_start_time
+                    status_writer.write(METRICS_STATUS, format_metrics(download_seconds, wait_seconds, map_seconds, file_size,
+                        output_counter.records, output_counter.bytes), uri, finished=False)
+                end_output(output)
+                if config.mark_output:
+                    # lets smr tell output of this file apart, in case another worker processes it too
+                    write_marker(output, get_marker(True, uri))
+                status_writer.write("+", file_size, uri)
             except (KeyboardInterrupt, SystemExit):
                 sys.stderr.write("map worker {} aborted\n".format(os.getpid()))
                 sys.exit(1)
             except Exception as e:
+                if combine_buffer is not None:
+                    # file is going to be requeued, don't send the rest of its output to reducer
+                    combine_buffer.discard()
+                if config.mark_output:
+                    # partial output of the file is dropped by smr, last line might not be terminated
+                    write_marker(output, get_marker(False, uri), terminate=True)
                 sys.stderr.write("{}\n".format(e))
-                write_to_stderr("!", 0, uri)
+                status_writer.write("!", 0, uri)
             finally:
+                end_output(output)
                 sys.stdout.flush() # force stdout flush after every file processed
-                if temp_filename:
-                    cleanup(uri, temp_filename)
+                if report_start_time is not None:
+                    # writing output and status of the file, blocks while smr doesn't keep up with reading them
+                    span_writer.write("report", report_start_time, uri)
+                if map_input is not None:
+                    cleanup_map_input(config, uri, map_input)
+                wait_start_time = time.time()
     except (KeyboardInterrupt, SystemExit):
         sys.stderr.write("map worker {} aborted\n".format(os.getpid()))
         sys.exit(1)
+    finally:
+        if profiler is not None:
+            dump_profile(config, profiler, "map")
 
 def main():
     config = get_config()
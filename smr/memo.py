@@ -0,0 +1,214 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+from Queue import Queue
+import hashlib
+import inspect
+import os
+import threading
+import zlib
+
+from .cache import DiskCache, get_cache_key
+from .shared import add_message
+from .split import parse_work_item
+from .speculate import wait_for_room
+from .transport import READ_SIZE, FrameDecoder, encode_frame
+from .uri import get_uri_version
+
+MAX_REPLAYED_BLOCKS = 100 # max number of replayed blocks waiting in output queue for reducers
+# max number of bytes of map output held in memory while waiting to be written to cache, output of more files isn't cached
+# (output that was spilled to disk by PendingOutput doesn't count)
+MAX_PENDING_WRITE_SIZE = 64 * 1024 * 1024
+
+def get_map_output_cache(config):
+    """ returns MapOutputCache for --map-output-cache-dir, None if it's not set """
+    if not config.map_output_cache_dir:
+        return None
+    return MapOutputCache(config)
+
+def get_func_source(func):
+    if func is None:
+        return ""
+    try:
+        return inspect.getsource(func)
+    except (IOError, TypeError):
+        return func.__name__
+
+def get_job_hash(config):
+    """
+    returns hash of code that map output depends on: the whole job file along with source of MAP_FUNC and COMBINE_FUNC,
+    which may be imported from other modules
+    with --map-output-cache-version, the rest of the job file is replaced by the version, so that cached output
+    is reused after changes elsewhere in the job, e.g. in REDUCE_FUNC
+    """
+    if config.map_output_cache_version is not None:
+        job = "version {}".format(config.map_output_cache_version)
+    else:
+        try:
+            with open(config.config, "rb") as f:
+                job = f.read().decode("utf-8", "replace")
+        except IOError:
+            job = ""
+    return hashlib.sha1(b"\0".join(source.encode("utf-8") for source in \
+        (job, get_func_source(config.MAP_FUNC), get_func_source(config.COMBINE_FUNC)))).hexdigest()
+
+class CachedBlocks(object):
+    """
+    blocks of map output in a file checked out of cache, decompressed as they're read because they may not fit in memory
+    the file is deleted once all blocks were read, or when close() is called
+    """
+    def __init__(self, filename):
+        self.filename = filename
+
+    def __iter__(self):
+        try:
+            decompressor = zlib.decompressobj()
+            decoder = FrameDecoder()
+            with open(self.filename, "rb") as f:
+                for data in iter(lambda: f.read(READ_SIZE), b""):
+                    for block in decoder.feed(decompressor.decompress(data)):
+                        yield block
+            for block in decoder.feed(decompressor.flush()):
+                yield block
+        finally:
+            self.close()
+
+    def close(self):
+        if self.filename is not None:
+            os.unlink(self.filename)
+            self.filename = None
+
+class MapOutputCache(object):
+    """
+    map output of each processed file stored across runs, keyed by source code of the job (see get_job_hash),
+    work item and etag (S3) or modification time (local files) of its file
+
+    files with cached output are not sent to mappers, their output is replayed to reducers from the cache instead.
+    output of processed files is compressed and written to the cache in a background thread,
+    so that the event loop that commits it doesn't wait for the disk
+    """
+    def __init__(self, config):
+        self.config = config
+        self.cache = DiskCache(config.map_output_cache_dir, config.map_output_cache_size)
+        self.job_hash = get_job_hash(config)
+        self.replay_queue = Queue()
+        self.write_queue = Queue()
+        self.write_lock = threading.Lock()
+        self.pending_write_size = 0 # bytes of map output in memory that's queued to be written
+        self.replayed = 0
+        self.threads = []
+        self.buckets = {} # S3 connections of write_thread
+
+    def get_key(self, item, version):
+        """ returns cache key of map output of work item, None if it can't be cached """
+        if version is None:
+            return None
+        # cached blocks are in the format of transport, tagged with partition when there are several reducers
+        return get_cache_key(self.job_hash, self.config.transport, self.config.record_encoding, self.config.partitions,
+            item, version)
+
+    def replay(self, item, size, version):
+        """ returns True if output of item is cached for version of its file and item was queued to be replayed """
+        key = self.get_key(item, version)
+        if key is None or self.cache.get(key) is None:
+            return False
+        self.replay_queue.put((item, size, key))
+        return True
+
+    def add(self, item, version, pending):
+        """
+        queues map output of item, whose file was at version when it was listed, to be written to cache
+        pending is PendingOutput of the file, it's closed once it's written
+        """
+        if version is None:
+            pending.close()
+            return
+        if not self.threads:
+            try:
+                self.write(item, version, pending)
+            finally:
+                pending.close()
+            return
+        with self.write_lock:
+            if self.pending_write_size + pending.size > MAX_PENDING_WRITE_SIZE:
+                pending.close() # writing to cache is behind, rather skip it than hold up the job or fill memory
+                return
+            self.pending_write_size += pending.size
+        self.write_queue.put((item, version, pending))
+
+    def write(self, item, version, blocks):
+        # mappers process whatever the file contains when they read it, which may have changed since it was listed
+        uri, _, _ = parse_work_item(item)
+        if get_uri_version(self.config, uri, self.buckets) != version:
+            return
+        key = self.get_key(item, version)
+        temp_filename = self.cache.get_temp_filename()
+        try:
+            with open(temp_filename, "wb") as f:
+                # compressed block by block, output that was spilled to disk may not fit in memory
+                compressor = zlib.compressobj()
+                for block in blocks:
+                    f.write(compressor.compress(encode_frame(block)))
+                f.write(compressor.flush())
+            self.cache.add(key, temp_filename, move=True)
+        except:
+            if os.path.exists(temp_filename):
+                os.unlink(temp_filename)
+            raise
+
+    def read(self, key):
+        """ returns CachedBlocks of map output cached under key, None if they were evicted """
+        temp_filename = self.cache.checkout(key)
+        if temp_filename is None:
+            return None
+        return CachedBlocks(temp_filename)
+
+    def start(self, input_queue, output_queue, processed_files_queue, tracker, abort_event):
+        self.threads = [
+            threading.Thread(target=self.replay_thread, args=(input_queue, output_queue, processed_files_queue, tracker, abort_event)),
+            threading.Thread(target=self.write_thread)
+        ]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        """ waits for replay_thread to exit and for write_thread to write pending output, called once the job is done or aborted """
+        if self.threads:
+            self.replay_queue.put(None)
+            self.write_queue.put(None)
+            for thread in self.threads:
+                thread.join()
+
+    def write_thread(self):
+        for item, version, pending in iter(self.write_queue.get, None):
+            try:
+                self.write(item, version, pending)
+            except Exception as e:
+                add_message("could not write map output of {} to cache: {}".format(item, e))
+            finally:
+                with self.write_lock:
+                    self.pending_write_size -= pending.size
+                pending.close()
+
+    def replay_thread(self, input_queue, output_queue, processed_files_queue, tracker, abort_event):
+        while not abort_event.is_set():
+            replayed_item = self.replay_queue.get()
+            if replayed_item is None:
+                break
+            item, size, key = replayed_item
+            blocks = self.read(key)
+            if blocks is None:
+                input_queue.put(item) # evicted since it was listed, let mappers process it
+                continue
+            if not tracker.claim(item):
+                blocks.close() # deletes the checked out file
+                continue
+            with tracker.commit_lock:
+                for block in blocks:
+                    # don't fill memory with replayed output faster than reducers can take it
+                    if not wait_for_room(output_queue, MAX_REPLAYED_BLOCKS, abort_event):
+                        blocks.close()
+                        return
+                    output_queue.put(block)
+                tracker.commit(item)
+            processed_files_queue.put((item, size))
+            self.replayed += 1
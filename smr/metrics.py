@@ -0,0 +1,159 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import json
+import os
+import threading
+
+from .shared import GLOBAL_SHARED_DATA, add_message
+
+# status that smr-map reports with metrics of each processed file when running with --metrics:
+# "M,download seconds;wait seconds;map seconds;input bytes;output records;output bytes,work item"
+METRICS_STATUS = "M"
+METRICS_FIELDS = ("download_seconds", "wait_seconds", "map_seconds", "input_bytes", "output_records", "output_bytes")
+THROUGHPUT_BUCKETS = (0.1, 0.5, 1, 5, 10, 50, 100, 500) # MB per second of map time
+SECONDS_BUCKETS = (0.01, 0.1, 0.5, 1, 5, 10, 60, 600)
+
+def format_metrics(download_seconds, wait_seconds, map_seconds, input_bytes, output_records, output_bytes):
+    """ returns metrics of a file in the form that smr-map writes them in its status line """
+    return "{:.6f};{:.6f};{:.6f};{};{};{}".format(download_seconds, wait_seconds, map_seconds, input_bytes, output_records, output_bytes)
+
+def parse_metrics_line(line):
+    """ returns (work item, dict of metrics) """
+    _, values, item = line.rstrip().split(",", 2)
+    values = values.split(";")
+    if len(values) != len(METRICS_FIELDS):
+        raise ValueError("expected {} metrics, got {}".format(len(METRICS_FIELDS), len(values)))
+    metrics = dict((field, float(value)) for field, value in zip(METRICS_FIELDS[:3], values[:3]))
+    metrics.update((field, int(value)) for field, value in zip(METRICS_FIELDS[3:], values[3:]))
+    return item, metrics
+
+def get_job_metrics(config):
+    """ returns JobMetrics if job report was requested, tells smr-map to report metrics of each file in that case """
+    if not config.report and not config.prometheus_file:
+        return None
+    config.metrics = True
+    return JobMetrics()
+
+class Histogram(object):
+    """ counts of values that are less than or equal to each bucket, like prometheus histograms """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def add(self, value):
+        for i, bucket in enumerate(self.buckets):
+            if value <= bucket:
+                break
+        else:
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def get_cumulative_counts(self):
+        """ returns a list of (upper bound, number of values less than or equal to it) """
+        result = []
+        total = 0
+        for bucket, count in zip(list(self.buckets) + ["+Inf"], self.counts):
+            total += count
+            result.append((bucket, total))
+        return result
+
+    def to_dict(self):
+        return {
+            "buckets": [[bucket, count] for bucket, count in self.get_cumulative_counts()],
+            "sum": self.sum,
+            "count": self.count
+        }
+
+    def to_prometheus(self, name):
+        lines = ["# TYPE {} histogram".format(name)]
+        for bucket, count in self.get_cumulative_counts():
+            lines.append("{}_bucket{{le=\"{}\"}} {}".format(name, bucket, count))
+        lines.append("{}_sum {}".format(name, self.sum))
+        lines.append("{}_count {}".format(name, self.count))
+        return lines
+
+class JobMetrics(object):
+    """ metrics of all files processed by mappers, aggregated per worker and into histograms """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.workers = {} # worker name -> dict of totals of METRICS_FIELDS and number of files
+        self.histograms = {
+            "file_throughput_mb_per_second": Histogram(THROUGHPUT_BUCKETS),
+            "file_download_seconds": Histogram(SECONDS_BUCKETS),
+            "file_wait_seconds": Histogram(SECONDS_BUCKETS),
+            "file_map_seconds": Histogram(SECONDS_BUCKETS)
+        }
+
+    def add_status_line(self, worker, line):
+        try:
+            _, metrics = parse_metrics_line(line)
+        except ValueError:
+            add_message("invalid metrics received from mapper: {}".format(line.rstrip()))
+            return
+        with self.lock:
+            stats = self.workers.get(worker)
+            if stats is None:
+                stats = self.workers[worker] = dict((field, 0) for field in METRICS_FIELDS + ("files", ))
+            stats["files"] += 1
+            for field in METRICS_FIELDS:
+                stats[field] += metrics[field]
+            if metrics["map_seconds"] > 0:
+                self.histograms["file_throughput_mb_per_second"].add(metrics["input_bytes"] / 1024 / 1024 / metrics["map_seconds"])
+            self.histograms["file_download_seconds"].add(metrics["download_seconds"])
+            self.histograms["file_wait_seconds"].add(metrics["wait_seconds"])
+            self.histograms["file_map_seconds"].add(metrics["map_seconds"])
+
+    def get_totals(self):
+        totals = dict((field, 0) for field in METRICS_FIELDS + ("files", ))
+        for stats in self.workers.itervalues():
+            for field, value in stats.iteritems():
+                totals[field] += value
+        return totals
+
+    def get_report(self, elapsed_seconds):
+        """ returns job report as a dict that can be serialized to JSON """
+        with self.lock:
+            return {
+                "elapsed_seconds": elapsed_seconds,
+                "files_listed": GLOBAL_SHARED_DATA["files_listed"],
+                "bytes_listed": GLOBAL_SHARED_DATA["bytes_listed"],
+                "files_processed": GLOBAL_SHARED_DATA["files_processed"],
+                "bytes_processed": GLOBAL_SHARED_DATA["bytes_processed"],
+                "bytes_per_second": GLOBAL_SHARED_DATA["bytes_processed"] / elapsed_seconds if elapsed_seconds > 0 else 0.0,
+                "input_cache_hits": GLOBAL_SHARED_DATA["input_cache_hits"],
+                "input_cache_misses": GLOBAL_SHARED_DATA["input_cache_misses"],
+                "messages": len(GLOBAL_SHARED_DATA["messages"]),
+                "totals": self.get_totals(),
+                "workers": dict((worker, dict(stats)) for worker, stats in self.workers.iteritems()),
+                "histograms": dict((name, histogram.to_dict()) for name, histogram in self.histograms.iteritems())
+            }
+
+    def get_prometheus_text(self, elapsed_seconds):
+        """ returns metrics in prometheus text exposition format, e.g. for node_exporter's textfile collector """
+        report = self.get_report(elapsed_seconds)
+        lines = []
+        for name in ("elapsed_seconds", "files_listed", "bytes_listed", "files_processed", "bytes_processed", "input_cache_hits", "input_cache_misses"):
+            lines.append("# TYPE smr_{} gauge".format(name))
+            lines.append("smr_{} {}".format(name, report[name]))
+        for field in ("files", ) + METRICS_FIELDS:
+            lines.append("# TYPE smr_worker_{} gauge".format(field))
+            for worker, stats in sorted(report["workers"].iteritems()):
+                lines.append("smr_worker_{}{{worker=\"{}\"}} {}".format(field, worker, stats[field]))
+        with self.lock:
+            for name, histogram in sorted(self.histograms.iteritems()):
+                lines.extend(histogram.to_prometheus("smr_{}".format(name)))
+        return "\n".join(lines) + "\n"
+
+def write_job_metrics(config, job_metrics, elapsed_seconds):
+    if config.report:
+        with open(config.report, "w") as f:
+            json.dump(job_metrics.get_report(elapsed_seconds), f, indent=2, sort_keys=True)
+        print("job report is in {}".format(config.report))
+    if config.prometheus_file:
+        temp_filename = config.prometheus_file + ".tmp"
+        with open(temp_filename, "w") as f:
+            f.write(job_metrics.get_prometheus_text(elapsed_seconds))
+        os.rename(temp_filename, config.prometheus_file)
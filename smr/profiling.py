@@ -0,0 +1,148 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import cProfile
+import glob
+import os
+import pstats
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+
+PROFILE_MODES = ("cprofile", "sampling")
+# number of functions listed in text reports
+REPORT_SIZE = 50
+
+class SamplingProfiler(object):
+    """
+    statistical profiler that records the stack of the main thread every interval seconds of CPU time while enabled,
+    much lower overhead than cProfile for MAP_FUNC or REDUCE_FUNC that call lots of small functions
+    stacks are saved in folded format, one "outermost;...;innermost count" line per stack, as used by flamegraph.pl
+    """
+    def __init__(self, interval):
+        self.stacks = {}
+        self.enabled = False
+        signal.signal(signal.SIGPROF, self.sample)
+        # system calls interrupted by a sample are restarted instead of failing with EINTR
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, interval, interval)
+
+    def sample(self, signum, frame):
+        if not self.enabled:
+            return
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(b"{} ({}:{})".format(code.co_name, code.co_filename, code.co_firstlineno))
+            frame = frame.f_back
+        stack = b";".join(reversed(stack))
+        self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def dump_stats(self, filename):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        write_folded_stacks(filename, self.stacks)
+
+def get_profile_suffix(config):
+    return ".folded" if config.profile == "sampling" else ".prof"
+
+def get_profiler(config):
+    """ returns a profiler with enable, disable and dump_stats methods if running with --profile, None otherwise """
+    if not config.profile or not config.profile_dir:
+        return None
+    if config.profile == "sampling":
+        return SamplingProfiler(config.profile_interval)
+    return cProfile.Profile()
+
+def profile_calls(profiler, func):
+    """ returns a function that calls func with profiler enabled """
+    def profiled(*args, **kwargs):
+        profiler.enable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profiler.disable()
+    return profiled
+
+def dump_profile(config, profiler, kind):
+    """ saves stats of profiler to profile_dir, kind is map or reduce """
+    try:
+        if not os.path.isdir(config.profile_dir):
+            os.makedirs(config.profile_dir)
+    except OSError:
+        pass # created by another process in the meantime
+    filename = os.path.join(config.profile_dir, "{}-{}-{}{}".format(kind, socket.gethostname(), os.getpid(), get_profile_suffix(config)))
+    try:
+        profiler.dump_stats(filename)
+    except (IOError, OSError) as e:
+        sys.stderr.write("could not save profile to {}: {}\n".format(filename, e))
+
+def start_profiling(config):
+    """ creates a directory where smr-map and smr-reduce save their profiles when running with --profile """
+    if config.profile:
+        config.profile_dir = tempfile.mkdtemp(prefix="smr-profile-")
+
+def read_folded_stacks(filename, stacks):
+    with open(filename, "rb") as f:
+        for line in f:
+            stack, count = line.rstrip(b"\n").rsplit(b" ", 1)
+            stacks[stack] = stacks.get(stack, 0) + int(count)
+
+def write_folded_stacks(filename, stacks):
+    with open(filename, "wb") as f:
+        for stack, count in sorted(stacks.iteritems()):
+            f.write(b"{} {}\n".format(stack, count))
+
+def write_sampling_report(filename, stacks):
+    """ writes functions that samples were taken in, ordered by number of samples in the function itself, then in its callees """
+    own = {}
+    total = {}
+    for stack, count in stacks.iteritems():
+        functions = stack.split(b";")
+        own[functions[-1]] = own.get(functions[-1], 0) + count
+        for function in set(functions):
+            total[function] = total.get(function, 0) + count
+    num_samples = sum(stacks.itervalues())
+    with open(filename, "wb") as f:
+        f.write(b"{} samples\n\n".format(num_samples))
+        f.write(b"{:>8} {:>8} {:>8}  function\n".format(b"own", b"total", b"own %"))
+        for function in sorted(total, key=lambda function: (own.get(function, 0), total[function]), reverse=True)[:REPORT_SIZE]:
+            own_samples = own.get(function, 0)
+            f.write(b"{:>8} {:>8} {:>8.2f}  {}\n".format(own_samples, total[function], 100 * own_samples / num_samples, function))
+
+def merge_profiles(config, kind):
+    """ merges profiles of all processes of kind into files next to output of the job, returns their names """
+    filenames = sorted(glob.glob(os.path.join(config.profile_dir, "{}-*{}".format(kind, get_profile_suffix(config)))))
+    if not filenames:
+        return []
+    prefix = "{}.{}-profile".format(config.output_filename, kind)
+    if config.profile == "sampling":
+        stacks = {}
+        for filename in filenames:
+            read_folded_stacks(filename, stacks)
+        write_folded_stacks(prefix + ".folded", stacks)
+        write_sampling_report(prefix + ".txt", stacks)
+        return [prefix + ".folded", prefix + ".txt"]
+    stats = pstats.Stats(filenames[0])
+    if len(filenames) > 1:
+        stats.add(*filenames[1:])
+    stats.dump_stats(prefix + ".prof")
+    with open(prefix + ".txt", "w") as f:
+        stats.stream = f
+        stats.sort_stats("cumulative").print_stats(REPORT_SIZE)
+    return [prefix + ".prof", prefix + ".txt"]
+
+def finish_profiling(config):
+    """ merges profiles of mappers and reducers, prints where they were saved """
+    if not config.profile:
+        return
+    for kind in ("map", "reduce"):
+        filenames = merge_profiles(config, kind)
+        if filenames:
+            print("{} profile is in {}".format(kind, ", ".join(filenames)))
+    shutil.rmtree(config.profile_dir, ignore_errors=True)
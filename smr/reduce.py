@@ -1,19 +1,109 @@
 #!/usr/bin/env python
 from __future__ import absolute_import, division, print_function, unicode_literals
+import os
+import select
 import sys
 
 from .config import get_config, configure_job
+from .journal import handle_control_record
+from .profiling import dump_profile, get_profiler, profile_calls
+from .sort import get_sorter, is_grouped_reduce, reduce_groups, split_record
+from .speculate import MARKER_PREFIX
+from .transport import READ_SIZE, block_to_records, decode_records, get_decoder, iter_frames
+
+def iter_results(config):
+    if config.transport == "framed":
+        for payload in iter_frames(sys.stdin):
+            for result in decode_records(payload, config.record_encoding):
+                yield result
+    else:
+        for result in iter(sys.stdin.readline, ""):
+            yield result.rstrip() # remove trailing linebreak
+
+def get_results(block, config):
+    """ returns records of a block of map output the same way iter_results yields them """
+    records = block_to_records(block, config)
+    if config.transport == "framed":
+        return records
+    return [record.rstrip() for record in records]
+
+def iter_batches(config):
+    """
+    yields lists of records of map output read from stdin, up to config.reduce_batch_size records each
+    a smaller list is yielded when no more map output is available yet, so that records aren't held back
+    control records that smr sends when using --journal are yielded on their own as strings
+    """
+    batch_size = config.reduce_batch_size
+    decoder = get_decoder(config)
+    fd = sys.stdin.fileno()
+    batch = []
+    while True:
+        data = os.read(fd, READ_SIZE)
+        for block in decoder.feed(data) if data else decoder.finish():
+            records = get_results(block, config)
+            if not config.mark_output or MARKER_PREFIX not in block:
+                batch.extend(records)
+                continue
+            for record in records:
+                if record.startswith(MARKER_PREFIX):
+                    if batch:
+                        yield batch
+                        batch = []
+                    yield record
+                else:
+                    batch.append(record)
+        while len(batch) >= batch_size:
+            yield batch[:batch_size]
+            batch = batch[batch_size:]
+        if batch and (not data or not select.select([fd], [], [], 0)[0]):
+            yield batch
+            batch = []
+        if not data:
+            return
+
+def reduce_batches(config):
+    for batch in iter_batches(config):
+        if isinstance(batch, list):
+            config.REDUCE_BATCH_FUNC(batch)
+        else:
+            handle_control_record(config, batch)
 
 def run(config):
     configure_job(config)
+    # with REDUCE_FUNC(key, values), map output is sorted by key before it's reduced
+    sorter = get_sorter(config) if config.REDUCE_BATCH_FUNC is None and is_grouped_reduce(config) else None
+    profiler = get_profiler(config)
+    if profiler is not None:
+        # with REDUCE_FUNC(key, values), what's profiled is reducing sorted groups, not sorting them
+        if config.REDUCE_FUNC is not None:
+            config.REDUCE_FUNC = profile_calls(profiler, config.REDUCE_FUNC)
+        if config.REDUCE_BATCH_FUNC is not None:
+            config.REDUCE_BATCH_FUNC = profile_calls(profiler, config.REDUCE_BATCH_FUNC)
+    if sorter is not None:
+        reduce_func = lambda result: sorter.add(*split_record(result, config.KEY_FUNC))
+    else:
+        reduce_func = config.REDUCE_FUNC
     try:
-        for result in iter(sys.stdin.readline, ""):
-            result = result.rstrip() # remove trailing linebreak
-            config.REDUCE_FUNC(result)
+        if config.REDUCE_BATCH_FUNC is not None:
+            reduce_batches(config)
+        elif config.mark_output:
+            # smr sends checkpoint records along with map output when using --journal
+            for result in iter_results(config):
+                if result.startswith(MARKER_PREFIX):
+                    handle_control_record(config, result)
+                else:
+                    reduce_func(result)
+        else:
+            for result in iter_results(config):
+                reduce_func(result)
     except (KeyboardInterrupt, SystemExit):
         pass
     finally:
         # we want to output results even if user aborted
+        if sorter is not None:
+            reduce_groups(config, sorter)
+        if profiler is not None:
+            dump_profile(config, profiler, "reduce")
         config.OUTPUT_RESULTS_FUNC()
 
 def main():
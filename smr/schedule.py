@@ -0,0 +1,28 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import operator
+import random
+
+SCHEDULES = ("largest-first", "smallest-first", "listing", "random")
+
+def schedule_files(files, config):
+    """
+    returns files (a list of tuples of uri, size in bytes and other listed fields) in the order in which they should be processed
+
+    processing largest files first keeps workers from idling at the end of a job
+    while one of them is still busy with a big file that was listed last.
+    SCHEDULE_FUNC in job config takes the list of (uri, size) tuples and overrides --schedule
+    """
+    if config.SCHEDULE_FUNC is not None:
+        # SCHEDULE_FUNC only sees (uri, size) tuples, other fields that were listed are added back to what it returns,
+        # version of files that weren't listed isn't known
+        listed = dict((f[0], f) for f in files)
+        return [listed.get(uri, (uri, size, None)) for uri, size in config.SCHEDULE_FUNC([tuple(f[:2]) for f in files])]
+    if config.schedule == "largest-first":
+        return sorted(files, key=operator.itemgetter(1), reverse=True)
+    if config.schedule == "smallest-first":
+        return sorted(files, key=operator.itemgetter(1))
+    if config.schedule == "random":
+        files = list(files)
+        random.shuffle(files)
+        return files
+    return files
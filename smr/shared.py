@@ -3,56 +3,205 @@ import boto
 import curses
 import os
 from Queue import Empty
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+from .config import FORWARDED_OPTIONS, get_default_config
+from .journal import Checkpoint, checkpoint_thread, get_restore_block
+from .transport import split_tagged_block, write_blocks
+from .schedule import schedule_files
+from .speculate import wait_for_room
+from .split import bundle_files, get_bundle_item, split_files
+from .uri import check_input_data, iter_uris
+
+# max number of bytes of map output that reduce_thread writes to reducers at once
+REDUCE_WRITE_SIZE = 1024 * 1024
 
 GLOBAL_SHARED_DATA = {
     "files_processed": 0,
     "bytes_processed": 0,
     "last_file_processed": "",
+    "files_listed": 0,
+    "bytes_listed": 0,
+    "input_cache_hits": 0,
+    "input_cache_misses": 0,
     "messages": []
 }
 
-def reduce_thread(reduce_process, output_queue, abort_event):
-    while not abort_event.is_set():
+def get_output_blocks(output_queue):
+    """
+    waits for map output to appear in output_queue, then takes all blocks of map output
+    that are already available, up to REDUCE_WRITE_SIZE bytes
+    a Checkpoint or None put by stop_threads is always the last item of returned list
+    """
+    blocks = []
+    size = 0
+    block = output_queue.get()
+    while True:
+        blocks.append(block)
+        if block is None or isinstance(block, Checkpoint):
+            break
+        size += len(block)
+        if size >= REDUCE_WRITE_SIZE:
+            break
         try:
-            # result has a trailing linebreak
-            result = output_queue.get(timeout=2)
+            block = output_queue.get_nowait()
+        except Empty:
+            break
+    return blocks
+
+def route_blocks(blocks, num_partitions):
+    """ splits blocks of map output, already partitioned by smr-map, into num_partitions lists of blocks """
+    partitions = [[] for _ in xrange(num_partitions)]
+    for block in blocks:
+        partition, payload = split_tagged_block(block)
+        partitions[partition].append(payload)
+    return partitions
+
+def reduce_thread(reduce_processes, output_queue, abort_event, config, tracer=None):
+    num_partitions = len(reduce_processes)
+    while not abort_event.is_set():
+        blocks = get_output_blocks(output_queue)
+        num_items = len(blocks)
+        stop = blocks[-1] is None
+        if stop:
+            blocks.pop()
+        checkpoint = blocks.pop() if blocks and isinstance(blocks[-1], Checkpoint) else None
+        if num_partitions == 1:
+            partitions = [blocks]
+        else:
+            partitions = route_blocks(blocks, num_partitions)
+        if checkpoint is not None:
+            # every reducer saves its state after reducing blocks before the checkpoint
+            for i, partition in enumerate(partitions):
+                partition.append(checkpoint.get_block(i, config))
+        for i, (reduce_process, partition) in enumerate(zip(reduce_processes, partitions)):
+            if not partition:
+                continue
             if reduce_process.poll() is not None:
                 # don't want to write if process has already terminated
                 abort_event.set()
                 break
-            reduce_process.stdin.write(result)
-            reduce_process.stdin.flush()
+            if tracer is not None:
+                # blocks while the reducer is behind
+                with tracer.span("reducer {}".format(i), "reduce-batch", blocks=len(partition)):
+                    write_blocks(reduce_process.stdin, partition, config)
+            else:
+                write_blocks(reduce_process.stdin, partition, config)
+        if abort_event.is_set():
+            break
+        for _ in xrange(num_items):
             output_queue.task_done()
-        except Empty:
-            pass
+        if stop:
+            break
     # we're calling communicate() on the process, which flushes stdin
     # so we can't close it here
     #reduce_process.stdin.close()
 
-def print_pid(process, window, line_num, process_name):
-    try:
-        cpu_percent = process.cpu_percent(0.1)
-    except:
-        cpu_percent = 0.0
-    add_str(window, line_num, "  {} pid {} CPU {}".format(process_name, process.pid, cpu_percent))
+def get_reduce_output_filenames(config):
+    """ returns the list of files that reducers write their results to, one per reducer """
+    if config.reducers <= 1:
+        return [config.output_filename]
+    return ["{}.part-{:05d}".format(config.output_filename, i) for i in xrange(config.reducers)]
+
+def get_results_description(config):
+    """ returns a human readable description of where results of the job are stored """
+    part_filenames = get_reduce_output_filenames(config)
+    if len(part_filenames) <= 1 or os.path.exists(config.output_filename):
+        return config.output_filename
+    return "{}.part-*".format(config.output_filename)
+
+def start_reduce_processes(config, config_path=None):
+    """ starts config.reducers smr-reduce processes, returns a list of (process, stdout) tuples """
+    reduce_args = get_args("smr-reduce", config, config_path)
+    reducers = []
+    for output_filename in get_reduce_output_filenames(config):
+        reduce_stdout = open(output_filename, "w")
+        reduce_process = subprocess.Popen(reduce_args, bufsize=0, stdin=subprocess.PIPE, stdout=reduce_stdout, stderr=subprocess.PIPE)
+        reducers.append((reduce_process, reduce_stdout))
+    return reducers
+
+def restore_reduce_state(config, reduce_processes, journal):
+    """ makes reducers load their state from the last checkpoint in journal when resuming a job """
+    if journal is None or journal.sequence == 0:
+        return
+    for i, reduce_process in enumerate(reduce_processes):
+        write_blocks(reduce_process.stdin, [get_restore_block(journal, i, config)], config)
+
+def start_checkpoint_thread(config, journal, tracker, output_queue, abort_event):
+    if journal is None:
+        return
+    thread = threading.Thread(target=checkpoint_thread, args=(config, journal, tracker, output_queue, abort_event))
+    thread.daemon = True
+    thread.start()
+
+def finish_reduce_processes(reducers):
+    """
+    waits for all reduce processes to finish
+    returns True if and only if all of them exited successfully
+    """
+    success = True
+    for reduce_process, reduce_stdout in reducers:
+        (_, stderr) = reduce_process.communicate()
+        if stderr:
+            sys.stderr.write(stderr)
+        reduce_stdout.close()
+        if reduce_process.returncode != 0:
+            print("reduce process {} exited with code {}".format(reduce_process.pid, reduce_process.returncode))
+            success = False
+    return success
+
+def merge_reduce_output(config):
+    """
+    merges the output of all reducers into config.output_filename
+    uses MERGE_RESULTS_FUNC from config if it's defined, otherwise output of reducers is concatenated
+    """
+    part_filenames = get_reduce_output_filenames(config)
+    if len(part_filenames) <= 1:
+        return
+    with open(config.output_filename, "w") as output_file:
+        if config.MERGE_RESULTS_FUNC is not None:
+            stdout = sys.stdout
+            sys.stdout = output_file
+            try:
+                config.MERGE_RESULTS_FUNC(part_filenames)
+            finally:
+                sys.stdout = stdout
+        else:
+            for part_filename in part_filenames:
+                with open(part_filename) as part_file:
+                    shutil.copyfileobj(part_file, output_file)
+    for part_filename in part_filenames:
+        os.unlink(part_filename)
 
 def add_str(window, line_num, str):
-    """ attempt to draw str on screen and ignore errors if they occur """
+    """ attempt to draw str on screen, cut to width of the screen, and ignore errors if they occur """
     try:
-        window.addstr(line_num, 0, str)
+        window.addnstr(line_num, 0, str, window.getmaxyx()[1] - 1)
     except curses.error:
         pass
 
 def progress_thread(processed_files_queue, abort_event):
     while not abort_event.is_set():
-        try:
-            file_name, file_size = processed_files_queue.get(timeout=2)
-            GLOBAL_SHARED_DATA["files_processed"] += 1
-            GLOBAL_SHARED_DATA["bytes_processed"] += file_size
-            GLOBAL_SHARED_DATA["last_file_processed"] = file_name
-            processed_files_queue.task_done()
-        except Empty:
-            pass
+        processed_file = processed_files_queue.get()
+        if processed_file is None:
+            break
+        file_name, file_size = processed_file
+        GLOBAL_SHARED_DATA["files_processed"] += 1
+        GLOBAL_SHARED_DATA["bytes_processed"] += file_size
+        GLOBAL_SHARED_DATA["last_file_processed"] = file_name
+        processed_files_queue.task_done()
+
+def stop_threads(abort_event, output_queue, processed_files_queue, map_output_cache=None):
+    """ stops the job, threads that wait for items of queues exit right away instead of waiting for more items """
+    abort_event.set()
+    output_queue.put(None)
+    processed_files_queue.put(None)
+    if map_output_cache is not None:
+        map_output_cache.stop()
 
 def get_param(param):
     return GLOBAL_SHARED_DATA[param]
@@ -60,23 +209,109 @@ def get_param(param):
 def add_message(message):
     GLOBAL_SHARED_DATA["messages"].append(message)
 
-def write_file_to_descriptor(input_queue, descriptor):
+def handle_status_line(line, processed_files_queue, input_queue, tracker=None):
     """
-    get item from input_queue and write it to descriptor
-    returns True if and only if it was successfully written
+    handles a line that smr-map wrote to stderr
+    returns True if and only if it reported that processing of a file has finished
     """
-    try:
-        file_name = input_queue.get(timeout=2)
-        descriptor.write("{}\n".format(file_name))
-        descriptor.flush()
-        input_queue.task_done()
-        return True
-    except Empty:
-        # no more files in queue
-        descriptor.close()
+    line = line.rstrip() # remove trailing linebreak
+    splt = line.split(",", 2)
+    if len(splt) != 3:
+        add_message("invalid message received from mapper: {}".format(line))
         return False
-    except IOError:
-        return False # probably bad descriptor
+    file_status, file_size, file_name = splt
+    if file_status == "+":
+        # with --speculative, only the first attempt to finish counts towards progress
+        if tracker is None or tracker.finish(file_name, int(file_size)):
+            processed_files_queue.put((file_name, int(file_size)))
+    elif file_status == "!":
+        if tracker is None or tracker.fail(file_name):
+            add_message("error processing {}, requeuing...".format(file_name))
+            input_queue.put(file_name) # re-queue file
+    elif file_status == "h":
+        GLOBAL_SHARED_DATA["input_cache_hits"] += 1
+        return False
+    elif file_status == "m":
+        GLOBAL_SHARED_DATA["input_cache_misses"] += 1
+        return False
+    else:
+        add_message("invalid status received from mapper: {}".format(file_status))
+        return False
+    return True
+
+def get_listed_files(config, journal):
+    """ returns a generator of lists of (work item, size in bytes, version) tuples, each list is sent to a mapper at once """
+    files = split_files(iter_uris(config), config.split_size)
+    if journal is not None and journal.completed_files:
+        # resuming a job, output of these files was already reduced
+        files = (f for f in files if f[0] not in journal.completed_files)
+    if not config.stream_listing:
+        files = schedule_files(list(files), config)
+    return bundle_files(files, config.bundle_size)
+
+def put_listed_files(input_queue, bundle, tracker, map_output_cache):
+    """ queues a bundle of (work item, size in bytes, version) tuples for mappers """
+    GLOBAL_SHARED_DATA["files_listed"] += len(bundle)
+    GLOBAL_SHARED_DATA["bytes_listed"] += sum(file_size for _, file_size, _ in bundle)
+    if tracker is not None:
+        for file_name, file_size, version in bundle:
+            # map output cache needs the version until output of the file is committed
+            tracker.add(file_name, file_size, version if map_output_cache is not None else None)
+    if map_output_cache is not None:
+        # files with cached map output are replayed to reducers instead
+        bundle = [listed for listed in bundle if not map_output_cache.replay(*listed)]
+    if len(bundle) > 0:
+        input_queue.put(get_bundle_item([file_name for file_name, _, _ in bundle]))
+
+def listing_thread(config, input_queue, listing_done, abort_event, tracker, journal, map_output_cache, tracer):
+    """ puts uris of files to process into input_queue as they are listed """
+    start_time = time.time()
+    try:
+        for bundle in get_listed_files(config, journal):
+            # keep memory usage bounded, no need to list files much faster than they're processed
+            if not wait_for_room(input_queue, config.input_queue_size, abort_event):
+                break
+            put_listed_files(input_queue, bundle, tracker, map_output_cache)
+    except Exception as e:
+        add_message("could not list files to process: {}".format(e))
+        abort_event.set()
+    finally:
+        if tracer is not None:
+            tracer.add_coordinator_span("listing", "list", start_time, time.time() - start_time)
+        listing_done.set()
+
+def start_listing(config, input_queue, abort_event, tracker=None, journal=None, map_output_cache=None, tracer=None):
+    """
+    puts uris of all files to process into input_queue
+    with config.stream_listing, files are listed in a background thread so that mappers can start right away
+    returns an event that is set once all files were listed
+    """
+    listing_done = threading.Event()
+    if config.stream_listing:
+        check_input_data(config)
+        print("listing files to process in background...")
+        thread = threading.Thread(target=listing_thread, args=(config, input_queue, listing_done, abort_event, tracker, journal, map_output_cache, tracer))
+        thread.daemon = True
+        thread.start()
+        return listing_done
+
+    print("getting list of the files to process...")
+    start_time = time.time()
+    for bundle in get_listed_files(config, journal):
+        put_listed_files(input_queue, bundle, tracker, map_output_cache)
+    if tracer is not None:
+        tracer.add_coordinator_span("listing", "list", start_time, time.time() - start_time)
+    print("going to process {} files...".format(get_param("files_listed")))
+    listing_done.set()
+    return listing_done
+
+def get_progress_str(listing_done):
+    """ returns a string that describes job progress, progress is only an estimate until all files are listed """
+    bytes_listed = get_param("bytes_listed")
+    progress = get_param("bytes_processed") / bytes_listed if bytes_listed > 0 else 0.0
+    if not listing_done.is_set():
+        return "job progress: {0:%} of {1} files listed so far (listing in progress)".format(progress, get_param("files_listed"))
+    return "job progress: {0:%}".format(progress)
 
 def ensure_dir_exists(path):
     dir_name = os.path.dirname(path)
@@ -100,6 +335,18 @@ def get_args(process, config, config_path=None):
         args.append("--aws-secret-key")
         args.append(boto.config.get('Credentials', 'aws_secret_access_key'))
 
+    default_config = get_default_config()
+    for option in FORWARDED_OPTIONS:
+        value = getattr(config, option, None)
+        if value is None or value == getattr(default_config, option):
+            continue
+        flag = "--{}".format(option.replace("_", "-"))
+        if value is True:
+            args.append(flag)
+        else:
+            args.append(flag)
+            args.append(str(value))
+
     if not config_path:
         config_path = config.config
 
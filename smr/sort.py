@@ -0,0 +1,149 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import heapq
+from inspect import getargspec
+from itertools import groupby
+import marshal
+from operator import itemgetter
+import os
+import tempfile
+
+RECORD_OVERHEAD = 100 # approximate number of bytes of memory taken by a buffered record besides its key and value
+# max number of runs merged at once, each of them is read in batches of buffer_size / MERGE_FAN_IN bytes,
+# so that merging takes about as much memory as the buffer regardless of number of runs
+MERGE_FAN_IN = 16
+
+def is_grouped_reduce(config):
+    """ returns True if REDUCE_FUNC takes a key and an iterator of its values instead of single records """
+    return config.REDUCE_FUNC is not None and len(getargspec(config.REDUCE_FUNC).args) == 2
+
+def split_record(record, key_func=None):
+    """
+    returns (key, value) of a record of map output
+    by default value is the part of the record after the first tab, with KEY_FUNC it's the whole record
+    """
+    if key_func is not None:
+        return key_func(record), record
+    splt = record.split(b"\t", 1)
+    return splt[0], splt[1] if len(splt) > 1 else b""
+
+def get_record_size(key, value):
+    """ returns approximate number of bytes of memory taken by a record """
+    size = len(value) + RECORD_OVERHEAD
+    if isinstance(key, basestring):
+        size += len(key)
+    return size
+
+def iter_run(filename):
+    """ yields (key, value) tuples of a sorted run that was spilled to disk """
+    with open(filename, "rb") as f:
+        while True:
+            try:
+                batch = marshal.load(f)
+            except EOFError:
+                return
+            for item in batch:
+                yield item
+
+def iter_run_by_key(filename, index):
+    """ yields (key, index of run, value) so that merging runs never compares values of records with equal keys """
+    for key, value in iter_run(filename):
+        yield key, index, value
+
+def merge_runs(filenames):
+    """ yields (key, value) tuples of sorted runs merged by key """
+    for key, _, value in heapq.merge(*[iter_run_by_key(filename, i) for i, filename in enumerate(filenames)]):
+        yield key, value
+
+class ExternalSorter(object):
+    """
+    sorts (key, value) tuples by key using up to buffer_size bytes of memory,
+    records that don't fit are sorted in runs that are spilled to temporary files and merged at the end
+    """
+    def __init__(self, buffer_size, temp_dir=None):
+        self.buffer_size = buffer_size
+        self.temp_dir = temp_dir
+        self.buffer = []
+        self.size = 0
+        self.runs = []
+
+    def add(self, key, value):
+        self.buffer.append((key, value))
+        self.size += get_record_size(key, value)
+        if self.size >= self.buffer_size:
+            self.spill()
+
+    def write_run(self, items):
+        """ writes sorted (key, value) tuples to a new run, in batches that fit in memory available to each merged run """
+        batch_size = max(1, self.buffer_size // MERGE_FAN_IN)
+        fd, filename = tempfile.mkstemp(prefix="smr-sort-", dir=self.temp_dir)
+        self.runs.append(filename)
+        with os.fdopen(fd, "wb") as f:
+            batch = []
+            size = 0
+            for key, value in items:
+                batch.append((key, value))
+                size += get_record_size(key, value)
+                if size >= batch_size:
+                    marshal.dump(batch, f)
+                    batch = []
+                    size = 0
+            if batch:
+                marshal.dump(batch, f)
+
+    def spill(self):
+        # only keys are compared, values of records with equal keys can be large or not comparable
+        self.buffer.sort(key=itemgetter(0))
+        self.write_run(self.buffer)
+        self.buffer = []
+        self.size = 0
+
+    def iter_sorted(self):
+        """ yields all added (key, value) tuples sorted by key """
+        if not self.runs:
+            self.buffer.sort(key=itemgetter(0))
+            return iter(self.buffer)
+        if self.buffer:
+            self.spill()
+        # merge runs in several passes if there are too many of them to read all at once,
+        # each pass replaces consecutive runs with one merged run so that runs stay in the order records were added
+        while len(self.runs) > MERGE_FAN_IN:
+            runs, self.runs = self.runs, []
+            try:
+                for i in xrange(0, len(runs), MERGE_FAN_IN):
+                    merged = runs[i:i + MERGE_FAN_IN]
+                    if len(merged) == 1:
+                        self.runs.append(merged[0])
+                        continue
+                    self.write_run(merge_runs(merged))
+                    for filename in merged:
+                        os.unlink(filename)
+            except:
+                # leave unmerged runs for cleanup
+                self.runs.extend(filename for filename in runs[i:] if os.path.exists(filename))
+                raise
+        return merge_runs(self.runs)
+
+    def iter_groups(self):
+        """ yields (key, iterator of values) for each key, in order of keys """
+        for key, group in groupby(self.iter_sorted(), key=lambda item: item[0]):
+            yield key, (value for _, value in group)
+
+    def cleanup(self):
+        for filename in self.runs:
+            try:
+                os.unlink(filename)
+            except OSError:
+                pass
+        self.runs = []
+        self.buffer = []
+
+def get_sorter(config):
+    return ExternalSorter(config.sort_buffer_size, config.sort_dir)
+
+def reduce_groups(config, sorter):
+    """ passes each key and its values to REDUCE_FUNC, once all map output was sorted """
+    try:
+        for key, values in sorter.iter_groups():
+            config.REDUCE_FUNC(key, values)
+    finally:
+        sorter.cleanup()
@@ -0,0 +1,354 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+from Queue import Queue
+import tempfile
+import threading
+import time
+
+from .transport import MARKER_PARTITION, READ_SIZE, FrameDecoder, block_to_records, decode_records, encode_frame, \
+    records_to_block, split_tagged_block, to_bytes
+
+# smr-map writes a marker record after output of each file when running with --speculative, --journal
+# or --map-output-cache-dir
+MARKER_PREFIX = b"\x00smr-"
+DONE_MARKER = b"\x00smr-done\t"
+FAILED_MARKER = b"\x00smr-failed\t"
+MIN_SAMPLES = 3 # number of finished files needed before guessing how long others should take
+MIN_SPECULATION_TIME = 5.0 # files that run for less than this many seconds are never duplicated
+# output of mappers isn't read, and output of files that was spilled to disk isn't committed,
+# while this many blocks of map output are waiting for reducers
+MAX_QUEUED_OUTPUT = 1000
+# how often threads that wait for room in a queue check whether the job was aborted
+ABORT_CHECK_INTERVAL = 1.0
+
+def wait_for_room(queue, max_size, abort_event=None):
+    """
+    blocks until fewer than max_size items are in queue, returns False if abort_event was set meanwhile
+    waiters are woken up when items are taken out of queue, WakeupQueue wakes up all of them instead of one
+    """
+    with queue.not_full:
+        while queue._qsize() >= max_size:
+            if abort_event is not None and abort_event.is_set():
+                return False
+            queue.not_full.wait(ABORT_CHECK_INTERVAL)
+    return abort_event is None or not abort_event.is_set()
+
+def get_marker(finished, item):
+    """ returns a record that separates output of item from output of the next file """
+    return (DONE_MARKER if finished else FAILED_MARKER) + to_bytes(item)
+
+def get_output_tracker(config):
+    """
+    returns SpeculationTracker if smr needs to know which map output belongs to which file, None otherwise
+    smr-map is told to mark the end of output of each file in that case
+    """
+    if not config.speculative and not config.journal and not config.resume and not config.map_output_cache_dir:
+        return None
+    config.mark_output = True
+    return SpeculationTracker(config.speculative_factor if config.speculative else None)
+
+class SpeculationTracker(object):
+    """
+    keeps track of attempts to process each work item, so that files that take much longer than others
+    can be processed again by idle workers once there's nothing else left to do
+
+    output of only the first attempt that finishes is sent to reducers, see OutputCommitter
+    factor is None if files shouldn't be processed again
+    """
+    def __init__(self, factor):
+        self.factor = factor
+        self.lock = threading.Lock()
+        self.sizes = {} # work item -> size in bytes
+        self.versions = {} # work item -> version of its file when it was listed, until its output is committed
+        self.running = {} # work item -> [number of running attempts, time when first attempt started]
+        self.speculated = set()
+        self.finished = set()
+        self.claimed = set()
+        self.committed = 0
+        self.committed_items = []
+        # held while output of a file is being queued for reducers, see save_checkpoint
+        self.commit_lock = threading.Lock()
+        self.rates = [] # seconds per byte of finished work items
+
+    def add(self, item, size, version=None):
+        with self.lock:
+            self.sizes[item] = size
+            if version is not None:
+                self.versions[item] = version
+
+    def get_version(self, item):
+        """ returns version of the file of item when it was listed, None if it's not known """
+        with self.lock:
+            return self.versions.get(item)
+
+    def start(self, item):
+        """ called when item was sent to a mapper """
+        with self.lock:
+            attempt = self.running.setdefault(item, [0, time.time()])
+            attempt[0] += 1
+
+    def stop(self, item):
+        attempt = self.running.get(item)
+        if attempt is None:
+            return None
+        attempt[0] -= 1
+        if attempt[0] <= 0:
+            del self.running[item]
+        return attempt
+
+    def finish(self, item, size):
+        """ called when a mapper reported that it processed item, returns True for the first attempt that did """
+        with self.lock:
+            attempt = self.stop(item)
+            if item in self.finished:
+                return False
+            self.finished.add(item)
+            if attempt is not None and size > 0:
+                self.rates.append((time.time() - attempt[1]) / size)
+            return True
+
+    def fail(self, item):
+        """ called when processing of item failed, returns True if it should be requeued """
+        with self.lock:
+            attempt = self.stop(item)
+            return item not in self.claimed and (attempt is None or attempt[0] <= 0)
+
+    def claim(self, item):
+        """ returns True if output of item wasn't sent to reducers yet and should be sent now """
+        with self.lock:
+            if item in self.claimed:
+                return False
+            self.claimed.add(item)
+            return True
+
+    def commit(self, item):
+        """ called after output of item was queued for reducers """
+        with self.lock:
+            self.committed += 1
+            self.committed_items.append(item)
+            self.versions.pop(item, None)
+
+    def is_finished(self, listing_done):
+        """ returns True once output of every listed item was queued for reducers """
+        with self.lock:
+            return listing_done.is_set() and self.committed >= len(self.sizes)
+
+    def get_speculative_item(self):
+        """ returns an item that has been running for much longer than expected and should be duplicated, or None """
+        with self.lock:
+            if self.factor is None or len(self.rates) < MIN_SAMPLES:
+                return None
+            rates = sorted(self.rates)
+            median_rate = rates[len(rates) // 2]
+            now = time.time()
+            stragglers = []
+            for item, (attempts, start_time) in self.running.iteritems():
+                if attempts != 1 or item in self.speculated or item in self.finished:
+                    continue
+                elapsed = now - start_time
+                expected = median_rate * self.sizes.get(item, 0)
+                if elapsed > MIN_SPECULATION_TIME and elapsed > self.factor * expected:
+                    stragglers.append((elapsed - expected, item))
+            if len(stragglers) == 0:
+                return None
+            _, item = max(stragglers)
+            self.speculated.add(item)
+            return item
+
+class PendingOutput(object):
+    """
+    blocks of map output of a file that's still being processed, the first max_size bytes of them are kept in memory
+    and the rest is spilled to a temporary file in temp_dir, so that a file with lots of output doesn't fill memory
+    """
+    def __init__(self, max_size, temp_dir=None):
+        self.max_size = max_size
+        self.temp_dir = temp_dir
+        self.blocks = []
+        self.size = 0 # number of bytes kept in memory
+        self.spill_file = None
+
+    def append(self, block):
+        if self.spill_file is None and self.size + len(block) <= self.max_size:
+            self.blocks.append(block)
+            self.size += len(block)
+            return
+        if self.spill_file is None:
+            self.spill_file = tempfile.NamedTemporaryFile(prefix="smr-output-", dir=self.temp_dir)
+        # once spilled, all following blocks are spilled too so that they stay in order
+        self.spill_file.write(encode_frame(block))
+
+    def is_spilled(self):
+        return self.spill_file is not None
+
+    def __iter__(self):
+        for block in self.blocks:
+            yield block
+        if self.spill_file is None:
+            return
+        self.spill_file.flush()
+        decoder = FrameDecoder()
+        with open(self.spill_file.name, "rb") as f:
+            for data in iter(lambda: f.read(READ_SIZE), b""):
+                for block in decoder.feed(data):
+                    yield block
+
+    def close(self):
+        """ drops the blocks, and deletes the temporary file """
+        self.blocks = []
+        self.size = 0
+        if self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
+
+class OutputCommitter(object):
+    """
+    puts blocks of map output read from a single mapper into output_queue once the marker record
+    that follows output of each file is read, output of failed attempts and of files that were
+    already processed by another worker is dropped
+
+    output of a file is kept in memory up to config.pending_output_size bytes until then, the rest is spilled to disk
+    spilled output is read back only as fast as reducers take it, by feeder if there is one so that the caller isn't blocked
+    """
+    def __init__(self, tracker, output_queue, config, map_output_cache=None, abort_event=None, feeder=None):
+        self.tracker = tracker
+        self.output_queue = output_queue
+        self.config = config
+        self.map_output_cache = map_output_cache
+        self.abort_event = abort_event
+        self.feeder = feeder
+        self.pending = self.get_pending()
+        self.marked_items = set() # items whose marker record was read and whose status wasn't handled yet
+
+    def get_pending(self):
+        return PendingOutput(self.config.pending_output_size, self.config.sort_dir)
+
+    def add(self, block):
+        if self.config.partitions > 1:
+            # smr-map sends marker records in frames of their own, other frames are kept whole
+            partition, payload = split_tagged_block(block)
+            if partition != MARKER_PARTITION:
+                self.pending.append(block)
+                return
+            for record in decode_records(payload, self.config.record_encoding):
+                self.add_marker(record)
+            return
+        if MARKER_PREFIX not in block:
+            self.pending.append(block)
+            return
+        records = block_to_records(block, self.config)
+        start = 0
+        for i, record in enumerate(records):
+            if not record.startswith(MARKER_PREFIX):
+                continue
+            if i > start:
+                self.pending.append(records_to_block(records[start:i], self.config))
+            start = i + 1
+            self.add_marker(record)
+        if start < len(records):
+            self.pending.append(records_to_block(records[start:], self.config))
+
+    def add_marker(self, record):
+        """ commits or drops output of the file that precedes marker record """
+        if record.startswith(DONE_MARKER):
+            item = record[len(DONE_MARKER):].decode("utf-8")
+            self.commit(item)
+        else:
+            item = record[len(FAILED_MARKER):].decode("utf-8")
+            self.pending.close()
+        self.marked_items.add(item)
+        self.pending = self.get_pending()
+
+    def commit(self, item):
+        pending = self.pending
+        if not self.tracker.claim(item):
+            pending.close()
+            return
+        version = self.tracker.get_version(item)
+        if self.feeder is None:
+            self.queue_output(item, version, pending)
+            return
+        # commit_lock is held by whoever waits for reducers to take spilled or replayed output, the feeder waits
+        # instead of the caller, and files committed meanwhile are queued behind it
+        if pending.is_spilled() or self.feeder.is_busy() or not self.tracker.commit_lock.acquire(False):
+            self.feeder.put(self, item, version, pending)
+            return
+        try:
+            committed = self.put_output(item, pending)
+        finally:
+            self.tracker.commit_lock.release()
+        if committed:
+            self.finish_commit(item, version, pending)
+
+    def queue_output(self, item, version, pending):
+        """ puts output of item into output_queue and marks item as committed, unless the job is aborted meanwhile """
+        with self.tracker.commit_lock:
+            committed = self.put_output(item, pending)
+        if committed:
+            self.finish_commit(item, version, pending)
+
+    def put_output(self, item, pending):
+        """ called with commit_lock held, returns False if the job was aborted and pending was dropped """
+        spilled = pending.is_spilled()
+        for block in pending:
+            # spilled output is read back only as fast as reducers take it
+            if spilled and not wait_for_room(self.output_queue, MAX_QUEUED_OUTPUT, self.abort_event):
+                pending.close()
+                return False
+            self.output_queue.put(block)
+        self.tracker.commit(item)
+        return True
+
+    def finish_commit(self, item, version, pending):
+        if self.map_output_cache is not None:
+            self.map_output_cache.add(item, version, pending) # closes pending once it's written
+        else:
+            pending.close()
+
+    def close(self):
+        """ drops output of a file that wasn't finished """
+        self.pending.close()
+
+class OutputFeeder(object):
+    """
+    thread that queues output of files committed by OutputCommitters, in order they were committed, for
+    the coordinator so that it keeps reading mappers while spilled output waits for reducers to take it
+    waker is woken up after each file is committed
+    """
+    def __init__(self, waker):
+        self.waker = waker
+        self.queue = Queue()
+        self.lock = threading.Lock()
+        self.queued = 0 # number of files that were put and aren't committed yet
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def is_busy(self):
+        with self.lock:
+            return self.queued > 0
+
+    def put(self, committer, item, version, pending):
+        with self.lock:
+            self.queued += 1
+        self.queue.put((committer, item, version, pending))
+
+    def run(self):
+        for committer, item, version, pending in iter(self.queue.get, None):
+            try:
+                committer.queue_output(item, version, pending)
+            finally:
+                with self.lock:
+                    self.queued -= 1
+                self.waker.wake()
+
+    def stop(self):
+        """ waits for output of files that were put to be committed, or dropped if the job was aborted """
+        self.queue.put(None)
+        self.thread.join()
+
+def commit_map_output(blocks, tracker, output_queue, config, map_output_cache=None):
+    """ commits output of each file in blocks of map output read from a mapper, see OutputCommitter """
+    committer = OutputCommitter(tracker, output_queue, config, map_output_cache)
+    for block in blocks:
+        committer.add(block)
+    # output of a file that wasn't finished when mapper exited is dropped
+    committer.close()
@@ -0,0 +1,126 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import os
+
+SPLIT_SEPARATOR = "\t"
+BUNDLE_SEPARATOR = "\x1e"
+# these can't be read starting from an arbitrary offset
+UNSPLITTABLE_EXTENSIONS = (".gz", ".bz2", ".xz", ".lz4", ".lzo", ".snappy", ".zst", ".zip")
+
+def is_splittable(uri):
+    return not uri.lower().endswith(UNSPLITTABLE_EXTENSIONS)
+
+def get_split_item(uri, offset, length):
+    """ returns a work item that's sent to smr-map in place of uri to process only a part of it """
+    return SPLIT_SEPARATOR.join((uri, unicode(offset), unicode(length)))
+
+def parse_work_item(item):
+    """ returns a tuple of (uri, offset, length), offset and length are None if item is a whole file """
+    parts = item.split(SPLIT_SEPARATOR)
+    if len(parts) != 3:
+        return item, None, None
+    return parts[0], int(parts[1]), int(parts[2])
+
+def split_files(files, split_size):
+    """
+    takes an iterable of (uri, size in bytes, ...) tuples, yields them back
+    with files larger than split_size replaced by (split work item, split length, ...) tuples,
+    other fields of the tuple are kept as they are
+    """
+    for listed in files:
+        uri, size = listed[:2]
+        if split_size <= 0 or size <= split_size or not is_splittable(uri):
+            yield listed
+            continue
+        for offset in xrange(0, size, split_size):
+            length = min(split_size, size - offset)
+            yield (get_split_item(uri, offset, length), length) + tuple(listed[2:])
+
+def get_bundle_item(items):
+    """ returns a work item that's sent to smr-map to process several files in one go """
+    return BUNDLE_SEPARATOR.join(items)
+
+def split_bundle(item):
+    """ returns a list of work items (files or splits) contained in item """
+    return item.split(BUNDLE_SEPARATOR)
+
+def bundle_files(files, bundle_size):
+    """
+    takes an iterable of (uri, size in bytes, ...) tuples, yields lists of them that add up to at least bundle_size bytes
+    (except for the last one), so that many small files can be sent to a mapper at once
+    """
+    bundle = []
+    size = 0
+    for listed in files:
+        bundle.append(listed)
+        size += listed[1]
+        if size >= bundle_size:
+            yield bundle
+            bundle = []
+            size = 0
+    if len(bundle) > 0:
+        yield bundle
+
+class SplitReader(object):
+    """
+    read-only file-like object that returns whole lines of a newline delimited file
+    that start within [offset, offset + length)
+
+    stream must be positioned one byte before offset (or at the start of file when offset is 0):
+    a line that begins in previous split is skipped, and the last line is read past the end of split if needed,
+    so that every line of file is read by exactly one split
+    """
+    def __init__(self, stream, offset, length, name=""):
+        self.stream = stream
+        self.offset = offset
+        self.size = length
+        self.name = name
+        self.mode = "rb"
+        self.pos = max(0, offset - 1)
+        self.end = offset + length
+        self.started = offset == 0
+        self.remainder = b"" # rest of a line that didn't fit in the last read()
+
+    def readline(self, size=-1):
+        # size is ignored, lines are always returned whole
+        if self.remainder:
+            line, self.remainder = self.remainder, b""
+            return line
+        if not self.started:
+            self.pos += len(self.stream.readline())
+            self.started = True
+        if self.pos >= self.end:
+            return b""
+        line = self.stream.readline()
+        self.pos += len(line)
+        return line
+
+    def read(self, size=-1):
+        chunks = []
+        length = 0
+        while size is None or size < 0 or length < size:
+            line = self.readline()
+            if not line:
+                break
+            chunks.append(line)
+            length += len(line)
+        data = b"".join(chunks)
+        if size is not None and 0 <= size < len(data):
+            self.remainder = data[size:]
+            data = data[:size]
+        return data
+
+    def __iter__(self):
+        return iter(self.readline, b"")
+
+    def close(self):
+        self.stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def get_split_suffix(uri):
+    """ returns extension of uri so that files with a split of uri are recognized the same way by MAP_FUNC """
+    return os.path.splitext(uri)[1]
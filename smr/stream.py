@@ -0,0 +1,140 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+from Queue import Queue
+import threading
+
+CHUNK_SIZE = 256 * 1024 # number of bytes read from source at once
+MAX_REWIND_SIZE = 16 * 1024 * 1024 # gzip in python 2 reads up to 10MB at once and may seek back over all of it
+
+def read_ahead_thread(source, chunk_queue, abort_event):
+    try:
+        while not abort_event.is_set():
+            chunk = source.read(CHUNK_SIZE)
+            chunk_queue.put(chunk)
+            if not chunk:
+                return
+    except Exception as e:
+        chunk_queue.put(e)
+
+class ReadAheadStream(object):
+    """
+    read-only file-like object that reads source (e.g. boto S3 key) in a background thread,
+    buffering up to buffer_size bytes ahead of the reader
+
+    it's not seekable except for what python's gzip module needs:
+    seeking back into data returned by recent reads, seeking forward, and seeking to the end of stream if size is known
+    """
+    def __init__(self, source, size=None, buffer_size=8 * 1024 * 1024, name=""):
+        self.source = source
+        self.size = size
+        self.name = name
+        self.mode = "rb"
+        self.closed = False
+        self.buffer = bytearray()
+        self.buffer_start = 0 # stream position of the first byte in buffer
+        self.pos = 0
+        self.eof = False
+        self.rewind_size = 0
+        self.chunk_queue = Queue(max(1, buffer_size // CHUNK_SIZE))
+        self.abort_event = threading.Event()
+        self.thread = threading.Thread(target=read_ahead_thread, args=(source, self.chunk_queue, self.abort_event))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def fill(self, end):
+        """ read chunks from background thread until buffer contains stream data up to end position """
+        while not self.eof and self.buffer_start + len(self.buffer) < end:
+            chunk = self.chunk_queue.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+            if not chunk:
+                self.eof = True
+                break
+            self.buffer += chunk
+
+    def trim(self):
+        """ discard data that is too far behind current position to seek back to it """
+        excess = self.pos - self.rewind_size - self.buffer_start
+        if excess > 0:
+            excess = min(excess, len(self.buffer))
+            del self.buffer[:excess]
+            self.buffer_start += excess
+
+    def read(self, size=-1):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        if self.size is not None and self.pos >= self.size:
+            return b""
+        if size is None or size < 0:
+            self.fill(float("inf"))
+        else:
+            self.rewind_size = min(MAX_REWIND_SIZE, max(self.rewind_size, size))
+            self.fill(self.pos + size)
+        start = self.pos - self.buffer_start
+        if start >= len(self.buffer):
+            if self.eof:
+                self.pos = max(self.pos, self.buffer_start + len(self.buffer))
+            return b""
+        end = len(self.buffer) if size is None or size < 0 else start + size
+        data = bytes(self.buffer[start:end])
+        self.pos += len(data)
+        self.trim()
+        return data
+
+    def readline(self, size=-1):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        chunks = []
+        length = 0
+        while size is None or size < 0 or length < size:
+            start = self.pos - self.buffer_start
+            if start >= len(self.buffer):
+                self.fill(self.pos + CHUNK_SIZE)
+                if start >= len(self.buffer):
+                    break # end of stream
+            end = self.buffer.find(b"\n", start)
+            end = len(self.buffer) if end < 0 else end + 1
+            if size is not None and size >= 0:
+                end = min(end, start + size - length)
+            data = bytes(self.buffer[start:end])
+            chunks.append(data)
+            length += len(data)
+            self.pos += len(data)
+            if data.endswith(b"\n"):
+                break
+        self.trim()
+        return b"".join(chunks)
+
+    def __iter__(self):
+        return iter(self.readline, b"")
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            if self.size is None:
+                raise IOError("can't seek relative to end of stream of unknown size")
+            offset += self.size
+        if offset < self.buffer_start:
+            raise IOError("can't seek back to {}, data before {} was already discarded".format(offset, self.buffer_start))
+        self.pos = offset
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.abort_event.set()
+        # unblock read ahead thread if it's waiting for free space in the queue
+        while not self.chunk_queue.empty():
+            self.chunk_queue.get_nowait()
+        close = getattr(self.source, "close", None)
+        if close is not None:
+            close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,127 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+from contextlib import contextmanager
+import json
+import threading
+import time
+
+from .shared import add_message
+
+# status that smr-map reports for each span of work on a file when running with --trace-spans:
+# "T,span name;thread name;start timestamp;duration in seconds,work item"
+TRACE_STATUS = "T"
+# name of the process that spans of smr itself are shown under, mappers are shown under their own names
+COORDINATOR = "smr"
+
+class SpanWriter(object):
+    """ writes spans of work on files to smr-map's status output, from any of its threads """
+    def __init__(self, status_writer):
+        self.status_writer = status_writer
+
+    def write(self, name, start_time, item):
+        value = "{};{};{:.6f};{:.6f}".format(name, threading.current_thread().name, start_time, time.time() - start_time)
+        self.status_writer.write(TRACE_STATUS, value, item, finished=False)
+
+def parse_span_line(line):
+    """ returns (span name, thread name, start timestamp, duration in seconds, work item) """
+    _, value, item = line.rstrip().split(",", 2)
+    name, thread, start_time, duration = value.split(";")
+    return name, thread, float(start_time), float(duration), item
+
+def get_tracer(config):
+    """ returns Tracer if a trace was requested, tells smr-map to report spans of its work in that case """
+    if not config.trace:
+        return None
+    config.trace_spans = True
+    return Tracer()
+
+def to_microseconds(seconds):
+    return int(seconds * 1000000)
+
+class Tracer(object):
+    """
+    collects spans of work of smr and its mappers and saves them in Chrome trace event format,
+    that can be opened in Perfetto (ui.perfetto.dev) or chrome://tracing
+    each mapper is shown as a process with files that were sent to it and not processed yet, and a thread
+    for mapping and one for each download thread, smr is shown as a process with threads for listing and reducers
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = []
+        self.pids = {} # process name -> pid in trace
+        self.tids = {} # (pid, thread name) -> tid in trace
+        self.dispatched = {} # (process name, work item) -> id of its dispatch span
+        self.next_id = 0
+
+    def get_pid(self, process):
+        pid = self.pids.get(process)
+        if pid is None:
+            pid = self.pids[process] = len(self.pids) + 1
+            self.events.append({"name": "process_name", "ph": "M", "pid": pid, "tid": 0, "args": {"name": process}})
+            self.events.append({"name": "process_sort_index", "ph": "M", "pid": pid, "tid": 0, "args": {"sort_index": pid}})
+        return pid
+
+    def get_tid(self, pid, thread):
+        tid = self.tids.get((pid, thread))
+        if tid is None:
+            tid = self.tids[(pid, thread)] = len(self.tids) + 1
+            self.events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": thread}})
+        return tid
+
+    def add_span(self, process, thread, name, start_time, duration, args=None):
+        with self.lock:
+            pid = self.get_pid(process)
+            event = {
+                "name": name, "ph": "X", "pid": pid, "tid": self.get_tid(pid, thread),
+                "ts": to_microseconds(start_time), "dur": to_microseconds(duration)
+            }
+            if args:
+                event["args"] = args
+            self.events.append(event)
+
+    def add_coordinator_span(self, thread, name, start_time, duration, args=None):
+        """ records a span of work done by smr itself """
+        self.add_span(COORDINATOR, thread, name, start_time, duration, args)
+
+    @contextmanager
+    def span(self, thread, name, **args):
+        """ records a span of work done by smr itself while the with block runs """
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.add_coordinator_span(thread, name, start_time, time.time() - start_time, args)
+
+    def dispatch(self, process, item):
+        """ called when work item was sent to mapper, it's shown as in flight until finish_dispatch is called """
+        with self.lock:
+            self.next_id += 1
+            self.dispatched[(process, item)] = self.next_id
+            self.add_async_event(process, "b", self.next_id, {"item": item})
+
+    def finish_dispatch(self, process, item):
+        with self.lock:
+            span_id = self.dispatched.pop((process, item), None)
+            if span_id is not None:
+                self.add_async_event(process, "e", span_id)
+
+    def add_async_event(self, process, phase, span_id, args=None):
+        # mappers have several files in flight with --prefetch, async spans don't need to nest like other spans
+        event = {"name": "dispatch", "cat": "dispatch", "ph": phase, "id": span_id, "pid": self.get_pid(process), "ts": to_microseconds(time.time())}
+        if args:
+            event["args"] = args
+        self.events.append(event)
+
+    def add_status_line(self, process, line):
+        try:
+            name, thread, start_time, duration, item = parse_span_line(line)
+        except ValueError:
+            add_message("invalid span received from mapper: {}".format(line.rstrip()))
+            return
+        self.add_span(process, thread, name, start_time, duration, {"item": item})
+
+    def save(self, filename):
+        with self.lock:
+            trace = {"traceEvents": self.events, "displayTimeUnit": "ms"}
+            with open(filename, "w") as f:
+                json.dump(trace, f)
+        print("trace is in {}".format(filename))
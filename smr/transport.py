@@ -0,0 +1,262 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import marshal
+import struct
+import zlib
+
+TRANSPORTS = ("lines", "framed")
+RECORD_ENCODINGS = ("text", "marshal")
+
+FRAME_HEADER = struct.Struct(b">I")
+# with several reducers, smr-map partitions map output and each frame starts with index of the reducer it's for,
+# so that smr only routes whole frames instead of looking at each record
+PARTITION_HEADER = struct.Struct(b">H")
+# marker records that follow output of each file are sent in frames of their own with this index
+MARKER_PARTITION = 0xffff
+READ_SIZE = 64 * 1024
+
+def configure_partitions(config):
+    """ with several reducers, map output is partitioned by smr-map, which needs framed transport to tag frames """
+    if config.reducers > 1:
+        config.transport = "framed"
+        config.partitions = config.reducers
+
+def to_bytes(data):
+    if isinstance(data, unicode):
+        return data.encode("utf-8")
+    return data
+
+def encode_records(records, encoding):
+    """ encodes a list of records (map output lines without trailing linebreaks) into a frame payload """
+    if encoding == "marshal":
+        return marshal.dumps(records)
+    return b"\n".join(records)
+
+def decode_records(payload, encoding):
+    """ decodes frame payload into a list of records """
+    if encoding == "marshal":
+        return marshal.loads(payload)
+    return payload.split(b"\n")
+
+def encode_frame(payload):
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+def get_partition_key(line, key_func=None):
+    """
+    returns the key used to partition line across reducers
+    by default it's the part of the line before the first tab, or the whole line if there is no tab
+    """
+    if key_func is not None:
+        return key_func(line)
+    return line.split(b"\t", 1)[0]
+
+def get_partition(line, num_partitions, key_func=None):
+    """ returns index of the reducer that should receive line """
+    key = get_partition_key(line.rstrip(b"\n"), key_func)
+    if isinstance(key, unicode):
+        key = key.encode("utf-8")
+    elif not isinstance(key, bytes):
+        key = str(key)
+    # crc32 is stable across processes and runs, unlike hash()
+    return (zlib.crc32(key) & 0xffffffff) % num_partitions
+
+def tag_payload(partition, payload):
+    """ returns a block of partitioned map output, payload prefixed with index of its partition """
+    return PARTITION_HEADER.pack(partition) + payload
+
+def split_tagged_block(block):
+    """ returns (index of partition, payload) of a block of partitioned map output """
+    (partition, ) = PARTITION_HEADER.unpack_from(block)
+    return partition, block[PARTITION_HEADER.size:]
+
+def block_to_records(block, config):
+    """ returns a list of records that are contained in a block of map output """
+    if config.transport == "framed":
+        return decode_records(block, config.record_encoding)
+    # blocks of lines always end with a linebreak
+    return block[:-1].split(b"\n")
+
+def records_to_block(records, config):
+    """ inverse of block_to_records """
+    if config.transport == "framed":
+        return encode_records(records, config.record_encoding)
+    return b"".join(record + b"\n" for record in records)
+
+def write_blocks(output, blocks, config):
+    """ writes blocks of map output to output (usually stdin of a reducer) with a single write """
+    if config.transport == "framed":
+        output.write(b"".join(encode_frame(block) for block in blocks))
+    else:
+        output.write(b"".join(blocks))
+    output.flush()
+
+class LineDecoder(object):
+    """ incremental decoder that splits a stream of bytes into blocks of complete lines """
+    def __init__(self):
+        self.remainder = b""
+
+    def feed(self, data):
+        data = self.remainder + data
+        end = data.rfind(b"\n") + 1
+        self.remainder = data[end:]
+        if end == 0:
+            return []
+        return [data[:end]]
+
+    def finish(self):
+        """ returns the last line if stream didn't end with a linebreak """
+        if self.remainder:
+            return [self.remainder + b"\n"]
+        return []
+
+class FrameDecoder(object):
+    """ incremental decoder that splits a stream of bytes into frame payloads """
+    def __init__(self):
+        self.buffer = b""
+
+    def feed(self, data):
+        self.buffer += data
+        payloads = []
+        start = 0
+        while len(self.buffer) - start >= FRAME_HEADER.size:
+            (length, ) = FRAME_HEADER.unpack_from(self.buffer, start)
+            end = start + FRAME_HEADER.size + length
+            if end > len(self.buffer):
+                break
+            payloads.append(self.buffer[start + FRAME_HEADER.size:end])
+            start = end
+        self.buffer = self.buffer[start:]
+        return payloads
+
+    def finish(self):
+        return [] # incomplete frames are dropped
+
+def get_decoder(config):
+    if config.transport == "framed":
+        return FrameDecoder()
+    return LineDecoder()
+
+def iter_blocks(read_func, config):
+    """
+    reads map output using read_func(size) until it returns an empty string
+    yields blocks of map output that contain whole records
+    """
+    decoder = get_decoder(config)
+    for data in iter(lambda: read_func(READ_SIZE), b""):
+        for block in decoder.feed(data):
+            yield block
+    for block in decoder.finish():
+        yield block
+
+def iter_frames(stream):
+    """ yields payloads of frames read from stream """
+    while True:
+        header = stream.read(FRAME_HEADER.size)
+        if len(header) < FRAME_HEADER.size:
+            return
+        (length, ) = FRAME_HEADER.unpack(header)
+        payload = stream.read(length)
+        if len(payload) < length:
+            return
+        yield payload
+
+class FrameWriter(object):
+    """
+    file-like object that replaces sys.stdout in smr-map when using framed transport
+    collects lines printed by MAP_FUNC and writes them as length-prefixed frames of many records
+    """
+    def __init__(self, output, encoding, frame_size):
+        self.output = output
+        self.encoding = encoding
+        self.frame_size = frame_size
+        self.chunks = []
+        self.size = 0
+        self.complete = False # whether chunks contain a complete record, only new chunks are searched for a linebreak
+
+    def write(self, data):
+        data = to_bytes(data)
+        self.chunks.append(data)
+        self.size += len(data)
+        if not self.complete and b"\n" in data:
+            self.complete = True
+        if self.complete and self.size >= self.frame_size:
+            self.write_frame()
+
+    def write_frame(self):
+        data = b"".join(self.chunks)
+        end = data.rfind(b"\n")
+        self.chunks = [data[end + 1:]]
+        self.size = len(self.chunks[0])
+        self.complete = False
+        payload = encode_records(data[:end].split(b"\n"), self.encoding)
+        self.output.write(encode_frame(payload))
+
+    def end_record(self):
+        """ terminates the last record if it wasn't, called after output of each file so that it doesn't run into the next file """
+        # only the last non-empty chunk needs to be looked at, joining all of them is slow for records written in many pieces
+        for chunk in reversed(self.chunks):
+            if chunk:
+                if not chunk.endswith(b"\n"):
+                    self.write(b"\n")
+                return
+
+    def flush(self):
+        if self.complete:
+            self.write_frame()
+        self.output.flush()
+
+class PartitionWriter(object):
+    """
+    file-like object that replaces sys.stdout in smr-map when map output is partitioned across several reducers
+    collects lines printed by MAP_FUNC into a frame for each reducer, tagged with index of the reducer
+    """
+    def __init__(self, output, encoding, frame_size, num_partitions, key_func=None):
+        self.output = output
+        self.encoding = encoding
+        self.frame_size = frame_size
+        self.num_partitions = num_partitions
+        self.key_func = key_func
+        self.records = [[] for _ in xrange(num_partitions)]
+        self.sizes = [0] * num_partitions
+        self.chunks = [] # an incomplete record
+
+    def write(self, data):
+        data = to_bytes(data)
+        if b"\n" not in data:
+            self.chunks.append(data)
+            return
+        self.chunks.append(data)
+        data = b"".join(self.chunks)
+        end = data.rfind(b"\n")
+        self.chunks = [data[end + 1:]] if end + 1 < len(data) else []
+        for record in data[:end].split(b"\n"):
+            partition = get_partition(record, self.num_partitions, self.key_func)
+            self.records[partition].append(record)
+            self.sizes[partition] += len(record) + 1
+            if self.sizes[partition] >= self.frame_size:
+                self.write_frame(partition)
+
+    def end_record(self):
+        """ terminates the last record if it wasn't, called after output of each file so that it doesn't run into the next file """
+        if any(self.chunks): # chunks may be empty strings
+            self.write(b"\n")
+
+    def write_frame(self, partition):
+        payload = encode_records(self.records[partition], self.encoding)
+        self.output.write(encode_frame(tag_payload(partition, payload)))
+        self.records[partition] = []
+        self.sizes[partition] = 0
+
+    def write_marker(self, marker):
+        """ writes marker record after all output written so far, in a frame of its own """
+        self.end_record()
+        for partition in xrange(self.num_partitions):
+            if self.records[partition]:
+                self.write_frame(partition)
+        self.output.write(encode_frame(tag_payload(MARKER_PARTITION, encode_records([marker], self.encoding))))
+        self.output.flush()
+
+    def flush(self):
+        for partition in xrange(self.num_partitions):
+            if self.records[partition]:
+                self.write_frame(partition)
+        self.output.flush()
@@ -1,75 +1,390 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 import boto
+from boto.exception import S3ResponseError
 from boto.s3.key import Key
+from boto.s3.prefix import Prefix
 from datetime import timedelta
+import errno
+import functools
+import json
 import os
+from Queue import Empty, Full, Queue
 import re
+import shutil
 import sys
 import tempfile
+import threading
+import time
+
+from .cache import DiskCache, get_cache_key
+from .stream import CHUNK_SIZE, ReadAheadStream
 
 S3_BUCKETS = {} # cache s3 buckets to re-use them
+INPUT_CACHES = {} # input cache directory -> DiskCache
+INPUT_CACHE_STATUS = {} # downloaded filename -> whether it was served from input cache
+LISTING_QUEUE_SIZE = 10000 # max number of listed S3 keys waiting to be consumed
+LISTING_PUT_TIMEOUT = 1.0 # how often listing threads blocked on a full queue check whether listing was aborted
+
+def connect_s3(config):
+    if config.aws_access_key and config.aws_secret_key:
+        return boto.connect_s3(config.aws_access_key, config.aws_secret_key)
+    return boto.connect_s3() # use local boto config or IAM profile
 
 def get_s3_bucket(bucket_name, config):
     if bucket_name not in S3_BUCKETS:
-        if config.aws_access_key and config.aws_secret_key:
-            s3conn = boto.connect_s3(config.aws_access_key, config.aws_secret_key)
-        else:
-            s3conn = boto.connect_s3() # use local boto config or IAM profile
-        S3_BUCKETS[bucket_name] = s3conn.get_bucket(bucket_name)
+        S3_BUCKETS[bucket_name] = connect_s3(config).get_bucket(bucket_name)
     return S3_BUCKETS[bucket_name]
 
+def reset_after_fork():
+    """
+    drops connections and caches inherited from the parent process, a forked worker must open its own connections,
+    otherwise it would share pooled sockets with the parent and other workers
+    """
+    S3_BUCKETS.clear()
+    INPUT_CACHES.clear()
+    INPUT_CACHE_STATUS.clear()
+
 def date_generator(end_date, num_days):
     for n in reversed(xrange(num_days)):
         yield end_date - timedelta(n)
 
-def get_s3_uri(m, file_names, config):
+def read_listing_manifest(manifest_filename, ttl):
+    """ returns listing stored in manifest_filename, None if it doesn't exist or is older than ttl seconds """
+    try:
+        if time.time() - os.path.getmtime(manifest_filename) > ttl:
+            return None
+        with open(manifest_filename) as f:
+            keys, prefixes = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    return [tuple(key) for key in keys], prefixes
+
+def write_listing_manifest(manifest_filename, listing):
+    try:
+        os.makedirs(os.path.dirname(manifest_filename))
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    # write to a temporary file first so that concurrent runs never see a partial manifest
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(manifest_filename), delete=False) as f:
+        json.dump(listing, f)
+    os.rename(f.name, manifest_filename)
+
+def get_listing_manifest_filename(bucket_name, prefix, delimiter, config):
+    """ returns filename of listing manifest for prefix, None if listing cache is disabled """
+    if not config.listing_cache_dir:
+        return None
+    return os.path.join(config.listing_cache_dir, "{}.json".format(get_cache_key(bucket_name, prefix, delimiter)))
+
+def iter_s3_prefix(bucket, prefix, delimiter, config):
     """
-    populates file_names list with urls that matched the regex match object
-    returns the total filesize of all the files matched
+    yields (name, size, etag) of S3 keys under prefix as they are listed,
+    and (name, None, None) of sub-prefixes when delimiter is not empty
+    listing is reused from a manifest in config.listing_cache_dir if it's set and manifest isn't too old
     """
+    manifest_filename = get_listing_manifest_filename(bucket.name, prefix, delimiter, config)
+    if manifest_filename:
+        listing = read_listing_manifest(manifest_filename, config.listing_cache_ttl)
+        if listing is not None:
+            keys, prefixes = listing
+            for key in keys:
+                yield key
+            for sub_prefix in prefixes:
+                yield sub_prefix, None, None
+            return
+
+    keys = []
+    prefixes = []
+    for item in bucket.list(prefix=prefix, delimiter=delimiter):
+        if isinstance(item, Prefix):
+            prefixes.append(item.name)
+            yield item.name, None, None
+        else:
+            key = (item.name, item.size, item.etag)
+            if manifest_filename:
+                keys.append(key)
+            yield key
+
+    if manifest_filename:
+        write_listing_manifest(manifest_filename, (keys, prefixes))
+
+def put_unless_aborted(queue, item, abort_event):
+    """ puts item into a bounded queue, returns False if abort_event was set before there was room for it """
+    while not abort_event.is_set():
+        try:
+            queue.put(item, timeout=LISTING_PUT_TIMEOUT)
+            return True
+        except Full:
+            pass
+    return False
+
+def iter_s3_prefix_thread(config, bucket_name, prefix_queue, delimiter, key_queue, abort_event):
+    try:
+        # each thread uses its own connection, boto connections aren't thread safe
+        bucket = connect_s3(config).get_bucket(bucket_name, validate=False)
+        while not abort_event.is_set():
+            try:
+                prefix = prefix_queue.get_nowait()
+            except Empty:
+                break
+            for key in iter_s3_prefix(bucket, prefix, delimiter, config):
+                # consumer stops taking keys once it's aborted
+                if not put_unless_aborted(key_queue, key, abort_event):
+                    return
+    except Exception as e:
+        put_unless_aborted(key_queue, e, abort_event)
+    finally:
+        put_unless_aborted(key_queue, None, abort_event)
+
+def iter_s3_prefixes(bucket_name, prefixes, delimiter, config):
+    """
+    yields what iter_s3_prefix yields for all prefixes as they are listed, using up to config.s3_list_threads threads
+    with more than one thread, keys of different prefixes are interleaved
+    """
+    if len(prefixes) <= 1 or config.s3_list_threads <= 1:
+        bucket = get_s3_bucket(bucket_name, config)
+        for prefix in prefixes:
+            for key in iter_s3_prefix(bucket, prefix, delimiter, config):
+                yield key
+        return
+
+    prefix_queue = Queue()
+    for prefix in prefixes:
+        prefix_queue.put(prefix)
+    key_queue = Queue(LISTING_QUEUE_SIZE)
+    abort_event = threading.Event()
+    running_threads = min(config.s3_list_threads, len(prefixes))
+    for _ in xrange(running_threads):
+        thread = threading.Thread(target=iter_s3_prefix_thread, args=(config, bucket_name, prefix_queue, delimiter, key_queue, abort_event))
+        thread.daemon = True
+        thread.start()
+    try:
+        while running_threads > 0:
+            key = key_queue.get()
+            if key is None:
+                running_threads -= 1
+            elif isinstance(key, Exception):
+                raise key
+            else:
+                yield key
+    finally:
+        abort_event.set()
+
+def get_s3_prefixes(path, config):
+    """ returns a list of S3 prefixes to list for path, one per day if path uses date macros """
+    if (config.start_date or config.date_range) and ("{year" in path or "{month" in path or "{day" in path):
+        # +1 because we want to include end_date
+        num_days = config.date_range or ((config.end_date - config.start_date).days + 1)
+        return [path.format(year=tmp_date.year, month=tmp_date.month, day=tmp_date.day) for tmp_date in date_generator(config.end_date, num_days)]
+    return [path]
+
+def iter_s3_uri(m, config):
+    """ yields (uri, size, etag) of all S3 files that matched the regex match object as they are listed """
     bucket_name = m.group(1)
     path = m.group(2)
-    bucket = get_s3_bucket(bucket_name, config)
-    result = 0
-    if (config.start_date or config.date_range) and ("{year" in path or "{month" in path or "{day" in path):
-        for tmp_date in date_generator(config.end_date, config.date_range or ((config.end_date - config.start_date).days + 1)):
-            # +1 because we want to include end_date
-            for key in bucket.list(prefix=path.format(year=tmp_date.year, month=tmp_date.month, day=tmp_date.day)):
-                file_names.append("s3://{}/{}".format(bucket_name, key.name))
-                result += key.size
-    else:
-        for key in bucket.list(prefix=path):
-            file_names.append("s3://{}/{}".format(bucket_name, key.name))
-            result += key.size
-    return result
-
-def get_local_uri(m, file_names, _):
-    """
-    populates file_names list with urls that matched the regex match object
-    returns the total filesize of all the files matched
-    """
+    prefixes = get_s3_prefixes(path, config)
+    # split prefixes into sub-prefixes by "/" so that more of them can be listed concurrently
+    for _ in xrange(config.s3_list_split_depth):
+        sub_prefixes = []
+        for name, size, etag in iter_s3_prefixes(bucket_name, prefixes, "/", config):
+            if size is None:
+                sub_prefixes.append(name)
+            else:
+                yield "s3://{}/{}".format(bucket_name, name), size, etag
+        prefixes = sub_prefixes
+    for name, size, etag in iter_s3_prefixes(bucket_name, prefixes, "", config):
+        yield "s3://{}/{}".format(bucket_name, name), size, etag
+
+def iter_local_uri(m, config):
+    """ yields (uri, size, modification time) of all local files that matched the regex match object """
     path = m.group(2)
-    result = 0
     for root, _, files in os.walk(path):
         for file_name in files:
             absolute_path = os.path.join(root, file_name)
-            file_names.append("file:/{}".format(absolute_path))
-            result += os.path.getsize(absolute_path)
-    return result
+            st = os.stat(absolute_path)
+            yield "file:/{}".format(absolute_path), st.st_size, st.st_mtime
+
+def get_contents_if_match(k, f, etag, headers=None):
+    """ downloads key k to file f, fails if the key doesn't have etag anymore, e.g. because it was overwritten """
+    headers = dict(headers or {})
+    if etag is not None:
+        headers["If-Match"] = etag
+    try:
+        k.get_contents_to_file(f, headers=headers)
+    except S3ResponseError as e:
+        if e.status != 412:
+            raise
+        # the file is requeued by smr and downloaded again in whole
+        raise IOError("s3://{}/{} changed while it was being downloaded".format(k.bucket.name, k.key))
+
+def download_s3_range_thread(config, bucket_name, path, etag, file_name, part_queue, errors):
+    # each thread uses its own connection, boto connections aren't thread safe
+    bucket = connect_s3(config).get_bucket(bucket_name, validate=False)
+    with open(file_name, "r+b") as f:
+        while not errors:
+            try:
+                start, end = part_queue.get_nowait()
+            except Empty:
+                return
+            try:
+                k = Key(bucket)
+                k.key = path
+                f.seek(start)
+                get_contents_if_match(k, f, etag, {"Range": "bytes={}-{}".format(start, end)})
+            except Exception as e:
+                errors.append(e)
+
+def download_s3_key_ranges(bucket_name, path, size, etag, file_name, config, offset=0):
+    """
+    downloads an S3 key of given size to file_name in parts of config.s3_part_size bytes,
+    using up to config.s3_download_concurrency parallel range requests
+    each request is made only if the key still has etag, so that parts of different versions are never mixed
+    the first offset bytes are already in file_name
+    """
+    with open(file_name, "r+b") as f:
+        f.truncate(size) # preallocate the file so that parts can be written in any order
+    part_queue = Queue()
+    for start in xrange(offset, size, config.s3_part_size):
+        part_queue.put((start, min(start + config.s3_part_size, size) - 1))
+    errors = []
+    threads = []
+    for _ in xrange(min(config.s3_download_concurrency, part_queue.qsize())):
+        thread = threading.Thread(target=download_s3_range_thread, args=(config, bucket_name, path, etag, file_name, part_queue, errors))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+def get_input_cache(config):
+    """ returns DiskCache for downloaded S3 files, None if input cache is disabled """
+    if not config.input_cache_dir:
+        return None
+    if config.input_cache_dir not in INPUT_CACHES:
+        INPUT_CACHES[config.input_cache_dir] = DiskCache(config.input_cache_dir, config.input_cache_size)
+    return INPUT_CACHES[config.input_cache_dir]
+
+def pop_cache_status(temp_filename):
+    """
+    returns True if temp_filename returned by download() was served from input cache,
+    False if it was downloaded and added to input cache, None if input cache wasn't used
+    """
+    return INPUT_CACHE_STATUS.pop(temp_filename, None)
+
+def open_s3_key(bucket, path, headers=None):
+    """ sends a GET request for S3 key, returns Key with size and etag from the response, its body is read from the Key """
+    k = Key(bucket)
+    k.key = path
+    try:
+        k.open_read(headers=headers)
+    except S3ResponseError as e:
+        if e.status == 404:
+            raise IOError("s3://{}/{} does not exist".format(bucket.name, path))
+        raise
+    return k
+
+def download_s3_key(bucket, path, file_name, config, size=None, etag=None):
+    """
+    downloads S3 key to file_name, keys of at least config.s3_multipart_threshold bytes are downloaded in parts,
+    each part only if the key still has the etag it had when it was first requested
+
+    if size and etag aren't known, they're taken from the response to the first request, which asks only
+    for the first config.s3_multipart_threshold bytes, so that smaller keys take a single request
+    and larger ones don't start a transfer of the whole key
+    """
+    if size is not None:
+        if config.s3_multipart_threshold > 0 and size >= config.s3_multipart_threshold:
+            download_s3_key_ranges(bucket.name, path, size, etag, file_name, config)
+        else:
+            k = Key(bucket)
+            k.key = path
+            with open(file_name, "wb") as f:
+                get_contents_if_match(k, f, etag)
+        return
+    threshold = config.s3_multipart_threshold
+    try:
+        # size of the key is in Content-Range of the response to a range request
+        k = open_s3_key(bucket, path, {"Range": "bytes=0-{}".format(threshold - 1)} if threshold > 0 else None)
+    except S3ResponseError as e:
+        if e.status != 416:
+            raise
+        open(file_name, "wb").close() # range of an empty key can't be satisfied
+        return
+    try:
+        with open(file_name, "wb") as f:
+            shutil.copyfileobj(k, f, CHUNK_SIZE)
+    finally:
+        k.close(fast=True)
+    if threshold > 0 and k.size > threshold:
+        download_s3_key_ranges(bucket.name, path, k.size, k.etag, file_name, config, threshold)
 
 def download_s3_uri(m, config):
     bucket_name = m.group(1)
     path = m.group(2)
     bucket = get_s3_bucket(bucket_name, config)
-    k = Key(bucket)
-    k.key = path
-    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-        k.get_contents_to_filename(temp_file.name)
-        return temp_file.name
+    input_cache = get_input_cache(config)
+    if input_cache is None:
+        with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+            download_s3_key(bucket, path, temp_file.name, config)
+            return temp_file.name
+
+    # etag is needed to look up the cache, a HEAD request gets it without starting to transfer the key
+    k = bucket.get_key(path)
+    if k is None:
+        raise IOError("s3://{}/{} does not exist".format(bucket_name, path))
+    cache_key = get_cache_key(bucket_name, path, k.etag)
+    temp_filename = input_cache.checkout(cache_key)
+    if temp_filename is not None:
+        INPUT_CACHE_STATUS[temp_filename] = True
+        return temp_filename
+    temp_filename = input_cache.get_temp_filename()
+    try:
+        download_s3_key(bucket, path, temp_filename, config, k.size, k.etag)
+        input_cache.add(cache_key, temp_filename)
+    except:
+        cleanup_s3_uri(temp_filename)
+        raise
+    INPUT_CACHE_STATUS[temp_filename] = False
+    return temp_filename
 
 def download_local_uri(m, _):
     return m.group(2)
 
+def open_s3_uri(m, config, offset=0):
+    bucket_name = m.group(1)
+    path = m.group(2)
+    bucket = get_s3_bucket(bucket_name, config)
+    k = bucket.get_key(path)
+    if k is None:
+        raise IOError("s3://{}/{} does not exist".format(bucket_name, path))
+    if offset > 0:
+        k.open_read(headers={"Range": "bytes={}-".format(offset)})
+        # reader of a split stops before the end of object, don't read the rest of the response when closing
+        k.close = functools.partial(k.close, fast=True)
+    return ReadAheadStream(k, k.size - offset, config.stream_buffer_size, "s3://{}/{}".format(bucket_name, path))
+
+def open_local_uri(m, _, offset=0):
+    f = open(m.group(2), "rb")
+    f.seek(offset)
+    return f
+
+def get_s3_uri_version(m, config, buckets):
+    """ returns current etag of S3 key, None if it doesn't exist, buckets is a dict of connections owned by the calling thread """
+    bucket_name = m.group(1)
+    if bucket_name not in buckets:
+        buckets[bucket_name] = connect_s3(config).get_bucket(bucket_name, validate=False)
+    k = buckets[bucket_name].get_key(m.group(2))
+    return k.etag if k is not None else None
+
+def get_local_uri_version(m, _, __):
+    """ returns current modification time of local file, None if it doesn't exist """
+    try:
+        return os.stat(m.group(2)).st_mtime
+    except OSError:
+        return None
+
 def cleanup_s3_uri(temp_filename):
     try:
         os.unlink(temp_filename)
@@ -77,36 +392,70 @@ def cleanup_s3_uri(temp_filename):
         pass
 
 URI_REGEXES = [
-    (re.compile(r"^s3://([^/]+)/?(.*)", re.IGNORECASE), get_s3_uri, download_s3_uri, cleanup_s3_uri),
-    (re.compile(r"^(file:/)?(/.*)", re.IGNORECASE), get_local_uri, download_local_uri, None)
+    (re.compile(r"^s3://([^/]+)/?(.*)", re.IGNORECASE), iter_s3_uri, download_s3_uri, cleanup_s3_uri, open_s3_uri, get_s3_uri_version),
+    (re.compile(r"^(file:/)?(/.*)", re.IGNORECASE), iter_local_uri, download_local_uri, None, open_local_uri, get_local_uri_version)
 ]
 
-def get_uris(config):
-    """ returns a tuple of total file size in bytes, and the list of files """
-    file_names = []
+def check_input_data(config):
+    """ makes sure that config has a list of INPUT_DATA uris """
     if config.INPUT_DATA is None:
         sys.stderr.write("you need to provide INPUT_DATA in config\n")
         sys.exit(1)
     if isinstance(config.INPUT_DATA, basestring):
         config.INPUT_DATA = [config.INPUT_DATA]
-    file_size = 0
+
+def iter_uris(config):
+    """
+    yields a tuple of (uri, size in bytes, version) for each file to process as they are listed,
+    version is the etag (S3) or modification time (local files) of the file when it was listed
+    """
+    check_input_data(config)
     for uri in config.INPUT_DATA:
-        for regex, uri_method, _, _ in URI_REGEXES:
+        for regex, uri_method, _, _, _, _ in URI_REGEXES:
             m = regex.match(uri)
             if m is not None:
-                file_size += uri_method(m, file_names, config)
+                for item in uri_method(m, config):
+                    yield item
                 break
+
+def get_uris(config):
+    """ returns a tuple of total file size in bytes, and the list of files """
+    file_names = []
+    file_size = 0
+    for file_name, size, _ in iter_uris(config):
+        file_names.append(file_name)
+        file_size += size
     print("going to process {} files...".format(len(file_names)))
     return file_size, file_names
 
 def download(config, uri):
-    for regex, _, dl_method, _ in URI_REGEXES:
+    for regex, _, dl_method, _, _, _ in URI_REGEXES:
         m = regex.match(uri)
         if m is not None:
             return dl_method(m, config)
 
 def cleanup(uri, temp_filename):
-    for regex, _, _, cleanup_method in URI_REGEXES:
+    for regex, _, _, cleanup_method, _, _ in URI_REGEXES:
         m = regex.match(uri)
         if m is not None and cleanup_method is not None:
             return cleanup_method(temp_filename)
+
+def open_uri(config, uri, offset=0):
+    """
+    returns a readable file-like object with contents of uri starting at offset,
+    without downloading it to a local file first
+    """
+    for regex, _, _, _, open_method, _ in URI_REGEXES:
+        m = regex.match(uri)
+        if m is not None:
+            return open_method(m, config, offset)
+
+def get_uri_version(config, uri, buckets):
+    """
+    returns current etag (S3) or modification time (local files) of uri, comparable with version yielded by iter_uris
+    buckets is a dict where S3 connections of the calling thread are kept
+    """
+    for regex, _, _, _, _, version_method in URI_REGEXES:
+        m = regex.match(uri)
+        if m is not None:
+            return version_method(m, config, buckets)
@@ -0,0 +1,85 @@
+import random
+
+from smr.aggregators import Counter, HyperLogLog, QuantileSketch, Sum, TopK
+
+import sure
+
+def test_counter():
+    counter1 = Counter()
+    for word in ["a", "b", "a", "c", "a", "b"]:
+        counter1.add(word)
+    counter2 = Counter.loads(counter1.dumps())
+    counter2.add("c", 5)
+    counter1.merge(counter2)
+    counter1.most_common().should.equal([("c", 7), ("a", 6), ("b", 4)])
+    counter1.most_common(1).should.equal([("c", 7)])
+    counter1.get("d").should.equal(0)
+    len(counter1).should.equal(3)
+
+def test_sum():
+    result = Sum()
+    for value in xrange(10):
+        result.add(value)
+    merged = Sum.loads(result.dumps())
+    merged.merge(result)
+    merged.total.should.equal(90)
+    merged.count.should.equal(20)
+    merged.mean().should.equal(4.5)
+
+def test_top_k():
+    random.seed(0)
+    # a few frequent keys among lots of rare ones
+    keys = ["frequent{}".format(i) for i in xrange(5) for _ in xrange(1000 * (i + 1))]
+    keys += ["rare{}".format(i) for i in xrange(10000)]
+    random.shuffle(keys)
+    halves = [TopK(50), TopK(50)]
+    for i, key in enumerate(keys):
+        halves[i % 2].add(key)
+    top_k = TopK.loads(halves[0].dumps())
+    top_k.merge(halves[1])
+    len(top_k.counts).should.equal(50)
+    top = top_k.top(5)
+    [key for key, _ in top].should.equal(["frequent{}".format(i) for i in reversed(xrange(5))])
+    for key, count in top:
+        exact = 1000 * (int(key[-1]) + 1)
+        count.should.be.greater_than_or_equal_to(exact)
+        (count - top_k.errors[key]).should.be.lower_than_or_equal_to(exact)
+
+def test_hyperloglog():
+    hll1 = HyperLogLog(12)
+    hll2 = HyperLogLog(12)
+    for i in xrange(20000):
+        hll1.add("value{}".format(i))
+        hll2.add("value{}".format(i + 10000))
+    hll = HyperLogLog.loads(hll1.dumps())
+    hll.merge(hll2)
+    # standard error is about 1.6% with precision 12
+    hll.count().should.be.within(30000 * 0.95, 30000 * 1.05)
+    small = HyperLogLog(12)
+    for i in xrange(100):
+        small.add(i)
+        small.add(i)
+    small.count().should.be.within(97, 103)
+    hll.merge.when.called_with(HyperLogLog(10)).should.throw(ValueError)
+
+def test_quantile_sketch():
+    random.seed(0)
+    values = [random.lognormvariate(0, 2) * random.choice([-1, 1, 1, 1]) for _ in xrange(20000)] + [0] * 100
+    sketches = [QuantileSketch(0.01), QuantileSketch(0.01)]
+    for i, value in enumerate(values):
+        sketches[i % 2].add(value)
+    sketch = QuantileSketch.loads(sketches[0].dumps())
+    sketch.merge(sketches[1])
+    sketch.count.should.equal(len(values))
+    values.sort()
+    for q in (0.0, 0.01, 0.2, 0.5, 0.9, 0.99, 1.0):
+        exact = values[int(q * (len(values) - 1))]
+        abs(sketch.quantile(q) - exact).should.be.lower_than_or_equal_to(abs(exact) * 0.01 + 1e-9)
+    QuantileSketch().quantile(0.5).should.equal(None)
+
+def test_quantile_sketch_collapses_lowest_buckets():
+    sketch = QuantileSketch(0.01, max_buckets=100)
+    for i in xrange(1, 10001):
+        sketch.add(i)
+    len(sketch.positive).should.equal(100)
+    sketch.quantile(0.99).should.be.within(9900 * 0.99, 9900 * 1.01)
@@ -0,0 +1,91 @@
+import smr.cache
+from smr.cache import DiskCache, get_cache_key
+
+import os
+import shutil
+import sure
+import tempfile
+import time
+
+def write_file(path, size):
+    with open(path, "wb") as f:
+        f.write(b"x" * size)
+
+def test_get_cache_key():
+    get_cache_key("bucket", "key", "etag").should.equal(get_cache_key("bucket", "key", "etag"))
+    get_cache_key("bucket", "key", "etag").shouldnt.equal(get_cache_key("bucket", "key", "etag2"))
+
+def test_disk_cache():
+    directory = tempfile.mkdtemp()
+    try:
+        cache = DiskCache(directory, 250)
+        cache.get("a").should.be.none
+        for key in ("a", "b"):
+            temp_filename = cache.get_temp_filename()
+            write_file(temp_filename, 100)
+            cache.add(key, temp_filename, move=True)
+        checked_out = cache.checkout("b")
+        os.utime(cache.get_path("b"), (time.time() - 10, time.time() - 10))
+        os.utime(cache.get_path("a"), (time.time() - 5, time.time() - 5))
+
+        temp_filename = cache.get_temp_filename()
+        write_file(temp_filename, 100)
+        cache.add("c", temp_filename)
+        # "b" was least recently used, but its data is still available through checked out link
+        cache.get("b").should.be.none
+        cache.get("a").shouldnt.be.none
+        cache.get("c").shouldnt.be.none
+        os.path.getsize(checked_out).should.equal(100)
+    finally:
+        shutil.rmtree(directory)
+
+def test_disk_cache_total_size():
+    directory = tempfile.mkdtemp()
+    try:
+        cache = DiskCache(directory, 1000)
+        for i in xrange(9):
+            temp_filename = cache.get_temp_filename()
+            write_file(temp_filename, 100)
+            cache.add(unicode(i), temp_filename, move=True)
+            os.utime(cache.get_path(unicode(i)), (time.time() - 100 + i, time.time() - 100 + i))
+        cache.read_total_size().should.equal(900)
+        # adding an existing key doesn't change size
+        temp_filename = cache.get_temp_filename()
+        write_file(temp_filename, 100)
+        cache.add("0", temp_filename)
+        cache.read_total_size().should.equal(900)
+
+        # a cache from before size was tracked is scanned once
+        os.unlink(cache.size_filename)
+        temp_filename = cache.get_temp_filename()
+        write_file(temp_filename, 100)
+        cache.add("9", temp_filename, move=True)
+        cache.read_total_size().should.equal(1000)
+
+        # going over max_size evicts least recently used files down to EVICTION_TARGET of it
+        temp_filename = cache.get_temp_filename()
+        write_file(temp_filename, 100)
+        cache.add("10", temp_filename, move=True)
+        cache.read_total_size().should.equal(900)
+        cache.get("0").should.be.none
+        cache.get("1").should.be.none
+        cache.get("2").shouldnt.be.none
+        sorted(os.listdir(cache.data_dir)).should.have.length_of(9)
+    finally:
+        shutil.rmtree(directory)
+
+def test_disk_cache_removes_old_temp_files():
+    directory = tempfile.mkdtemp()
+    max_age = smr.cache.TEMP_FILE_MAX_AGE
+    try:
+        cache = DiskCache(directory, 1000)
+        temp_filename = cache.get_temp_filename()
+        cache.evict()
+        os.path.exists(temp_filename).should.be.ok
+        # left behind by a crashed process long ago
+        smr.cache.TEMP_FILE_MAX_AGE = -1
+        cache.evict()
+        os.listdir(cache.temp_dir).should.equal([])
+    finally:
+        smr.cache.TEMP_FILE_MAX_AGE = max_age
+        shutil.rmtree(directory)
@@ -0,0 +1,48 @@
+import datetime
+import os
+from Queue import Queue
+import threading
+
+from smr.dashboard import Dashboard, ProcessSampler, RateTracker, get_eta
+from smr.eventloop import MapperConnection
+
+import sure
+
+def test_rate_tracker():
+    rate = RateTracker(window=10)
+    rate.get_rates().should.equal((0.0, 0.0))
+    rate.add(100, 0, 0)
+    rate.add(105, 10, 1000)
+    rate.get_rates().should.equal((2.0, 200.0))
+    rate.add(110, 20, 2000)
+    rate.add(115, 50, 2500)
+    # rate covers the last 10 seconds
+    rate.get_rates().should.equal((4.0, 150.0))
+    len(rate.snapshots).should.equal(3)
+
+def test_get_eta():
+    get_eta(1000, 100).should.equal(10.0)
+    get_eta(0, 0).should.equal(0.0)
+    get_eta(1000, 0).should.be.none
+
+def test_process_sampler():
+    sampler = ProcessSampler()
+    sampler.sample([os.getpid()])[os.getpid()].should.be.greater_than_or_equal_to(0)
+    sampler.sample([os.getpid(), 2 ** 22 + 1]).should.have.key(2 ** 22 + 1).being.none
+
+def test_dashboard():
+    mappers = []
+    for i in xrange(100):
+        mapper = MapperConnection("worker{}".format(i))
+        mapper.files_in_flight.append("file{}".format(i))
+        mappers.append(mapper)
+    mappers[0].files_processed = 3
+    mappers[0].bytes_processed = 3 * 1024 * 1024
+    listing_done = threading.Event()
+    listing_done.set()
+    dashboard = Dashboard("smr", mappers, [], Queue(), Queue(), listing_done, datetime.datetime.now())
+    lines = dashboard.get_lines(40)
+    len(lines).should.equal(40)
+    lines[5].should.contain("worker0")
+    lines[5].should.contain("file0")
+    lines.should.contain("  ... and {} more".format(100 - 40 + 8))
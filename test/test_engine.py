@@ -0,0 +1,75 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import sure
+
+JOB = """
+INPUT_DATA = "{input_dir}"
+result = {{}}
+def MAP_FUNC(file_name):
+    with open(file_name) as f:
+        for line in f:
+            for word in line.split():
+                print(word)
+def REDUCE_FUNC(word):
+    result[word] = result.get(word, 0) + 1
+def OUTPUT_RESULTS_FUNC():
+    for word, count in sorted(result.items()):
+        print("{{}}\\t{{}}".format(word, count))
+"""
+
+def run_job(job_filename, output_filename, engine, args=[]):
+    # smr-map and smr-reduce are installed next to the python that runs the tests
+    env = dict(os.environ)
+    env["PATH"] = "{}:{}".format(os.path.dirname(sys.executable), env.get("PATH", ""))
+    args = [sys.executable, "-c", "from smr.main import main; main()", job_filename, "--workers", "3", "--engine", engine,
+        "--no-output-job-progress", "--output-filename", output_filename] + args
+    process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+    output = process.communicate()[0]
+    process.returncode.should.equal(0, output)
+    with open(output_filename) as f:
+        return f.read()
+
+def test_multiprocessing_engine():
+    directory = tempfile.mkdtemp()
+    try:
+        input_dir = os.path.join(directory, "input")
+        os.mkdir(input_dir)
+        for i in xrange(20):
+            with open(os.path.join(input_dir, "file{}.txt".format(i)), "w") as f:
+                for j in xrange(100):
+                    f.write("word{} word{} common\n".format(i, j))
+        job_filename = os.path.join(directory, "job.py")
+        with open(job_filename, "w") as f:
+            f.write(JOB.format(input_dir=input_dir))
+
+        expected = run_job(job_filename, os.path.join(directory, "subprocess.out"), "subprocess")
+        expected.should.contain("common\t2000\n")
+        run_job(job_filename, os.path.join(directory, "multiprocessing.out"), "multiprocessing").should.equal(expected)
+    finally:
+        shutil.rmtree(directory)
+
+def test_partitioned_non_ascii_output():
+    directory = tempfile.mkdtemp()
+    try:
+        input_dir = os.path.join(directory, "input")
+        os.mkdir(input_dir)
+        for i in xrange(10):
+            with open(os.path.join(input_dir, "file{}.txt".format(i)), "w") as f:
+                for j in xrange(50):
+                    f.write(u"caf\xe9{} na\xefve{} \u65e5\u672c common\n".format(i, j).encode("utf-8"))
+        job_filename = os.path.join(directory, "job.py")
+        with open(job_filename, "w") as f:
+            f.write(JOB.format(input_dir=input_dir))
+
+        expected = run_job(job_filename, os.path.join(directory, "single.out"), "subprocess", ["--reducers", "1"])
+        expected.should.contain(u"\u65e5\u672c\t500\n".encode("utf-8"))
+        output = run_job(job_filename, os.path.join(directory, "partitioned.out"), "subprocess",
+            ["--reducers", "2", "--merge-reduce-output"])
+        # output of reducers is concatenated, so it's only sorted within each part
+        sorted(output.splitlines()).should.equal(sorted(expected.splitlines()))
+    finally:
+        shutil.rmtree(directory)
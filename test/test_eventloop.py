@@ -0,0 +1,155 @@
+from Queue import Queue
+import os
+import select
+import subprocess
+import sys
+import threading
+
+from smr.config import get_config
+import smr.eventloop
+from smr.eventloop import Coordinator, LocalMapper, Waker, WakeupQueue
+from smr.speculate import SpeculationTracker, wait_for_room
+from smr.split import get_bundle_item
+
+import sure
+
+# stands in for smr-map: outputs a line for each work item and reports it as processed
+MAPPER = """
+import sys
+for line in iter(sys.stdin.readline, ""):
+    item = line.rstrip("\\n")
+    sys.stdout.write("{}\\t1\\n".format(item))
+    sys.stdout.flush()
+    sys.stderr.write("+,{},{}\\n".format(len(item), item))
+    sys.stderr.flush()
+"""
+
+# same for bundles of files, with a marker record after output of each file
+BUNDLE_MAPPER = """
+import sys
+from smr.speculate import get_marker
+from smr.split import split_bundle
+for line in iter(sys.stdin.readline, ""):
+    for item in split_bundle(line.rstrip("\\n")):
+        sys.stdout.write("{}\\t1\\n".format(item))
+        sys.stdout.write(get_marker(True, item) + "\\n")
+        sys.stdout.flush()
+        sys.stderr.write("+,{},{}\\n".format(len(item), item))
+        sys.stderr.flush()
+"""
+
+def start_mapper(script=MAPPER):
+    return subprocess.Popen([sys.executable, "-c", script], bufsize=0, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+def test_coordinator():
+    config = get_config(["job.py", "--prefetch", "2"])
+    waker = Waker()
+    input_queue = WakeupQueue(waker)
+    output_queue = WakeupQueue(waker)
+    processed_files_queue = Queue()
+    listing_done = threading.Event()
+    items = ["file{}".format(i) for i in xrange(20)]
+    for item in items:
+        input_queue.put(item)
+    listing_done.set()
+
+    coordinator = Coordinator(config, input_queue, output_queue, processed_files_queue, listing_done, threading.Event())
+    map_processes = [start_mapper() for _ in xrange(3)]
+    for map_process in map_processes:
+        coordinator.add(LocalMapper(map_process))
+    coordinator.run()
+
+    [mapper.exit_code for mapper in coordinator.mappers].should.equal([0, 0, 0])
+    output = b"".join(output_queue.get() for _ in xrange(output_queue.qsize()))
+    sorted(output.splitlines()).should.equal(sorted("{}\t1".format(item) for item in items))
+    sorted(processed_files_queue.get()[0] for _ in xrange(processed_files_queue.qsize())).should.equal(sorted(items))
+    sum(mapper.files_processed for mapper in coordinator.mappers).should.equal(len(items))
+    sum(mapper.bytes_processed for mapper in coordinator.mappers).should.equal(sum(len(item) for item in items))
+    [mapper.files_in_flight for mapper in coordinator.mappers].should.equal([[], [], []])
+
+def test_coordinator_tracks_files_of_bundles():
+    config = get_config(["job.py", "--speculative", "--bundle-size", "3"])
+    waker = Waker()
+    input_queue = WakeupQueue(waker)
+    output_queue = WakeupQueue(waker)
+    listing_done = threading.Event()
+    tracker = SpeculationTracker(config.speculative_factor)
+    items = ["file{}".format(i) for i in xrange(12)]
+    for item in items:
+        tracker.add(item, len(item))
+    for i in xrange(0, len(items), 3):
+        input_queue.put(get_bundle_item(items[i:i + 3]))
+    listing_done.set()
+
+    coordinator = Coordinator(config, input_queue, output_queue, Queue(), listing_done, threading.Event(), tracker)
+    for _ in xrange(2):
+        coordinator.add(LocalMapper(start_mapper(BUNDLE_MAPPER)))
+    coordinator.run()
+
+    output = b"".join(output_queue.get() for _ in xrange(output_queue.qsize()))
+    sorted(output.splitlines()).should.equal(sorted("{}\t1".format(item) for item in items))
+    # attempts are started and stopped for each file of a bundle, not for the whole bundle
+    # (the job ends once all output is committed, status of the last files might not be read by then)
+    set(tracker.running).issubset(items).should.be.ok
+    set(tracker.running).intersection(tracker.finished).should.be.empty
+    len(tracker.finished).should.be.greater_than(0)
+    tracker.committed.should.equal(len(items))
+    # idle mappers had their input closed and exited on their own instead of being left for smr to kill
+    [mapper.exit_code for mapper in coordinator.mappers].should.equal([0, 0])
+
+def test_coordinator_waits_for_listing():
+    config = get_config(["job.py"])
+    input_queue = WakeupQueue(Waker())
+    output_queue = WakeupQueue(input_queue.waker)
+    listing_done = threading.Event()
+
+    def list_files():
+        input_queue.put("file1")
+        listing_done.set()
+    timer = threading.Timer(0.5, list_files)
+    timer.start()
+
+    coordinator = Coordinator(config, input_queue, output_queue, Queue(), listing_done, threading.Event())
+    coordinator.add(LocalMapper(start_mapper()))
+    coordinator.run()
+    output_queue.get().should.equal(b"file1\t1\n")
+
+def test_waker_wakes_after_concurrent_clear():
+    waker = Waker()
+    waker.wake()
+    read = os.read
+    def read_and_wake(fd, size):
+        # another thread wakes the coordinator while clear() is draining the pipe
+        thread = threading.Thread(target=waker.wake)
+        thread.start()
+        thread.join(0.2)
+        return read(fd, size)
+    smr.eventloop.os.read = read_and_wake
+    try:
+        waker.clear()
+    finally:
+        smr.eventloop.os.read = read
+    # the wakeup must not be lost, otherwise the coordinator would wait forever
+    select.select([waker], [], [], 1)[0].should.equal([waker])
+    waker.clear()
+    waker.wake()
+    select.select([waker], [], [], 1)[0].should.equal([waker])
+
+def test_wait_for_room():
+    queue = WakeupQueue(Waker())
+    queue.put(1)
+    queue.put(2)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(wait_for_room(queue, 2))) for _ in xrange(2)]
+    for thread in threads:
+        thread.start()
+    queue.get()
+    # taking a single item wakes up every thread that waits for room, not just one of them
+    for thread in threads:
+        thread.join(0.5)
+    results.should.equal([True, True])
+
+    abort_event = threading.Event()
+    abort_event.set()
+    queue.put(3)
+    wait_for_room(queue, 2, abort_event).should_not.be.ok
@@ -0,0 +1,73 @@
+from Queue import Queue
+import os
+import shutil
+import tempfile
+import threading
+
+from smr.journal import Checkpoint, Journal, save_checkpoint
+from smr.shared import get_output_blocks
+from smr.speculate import SpeculationTracker
+
+import sure
+
+def test_journal():
+    directory = tempfile.mkdtemp()
+    try:
+        journal = Journal(directory, 2)
+        journal.save(1, ["/a", "/b"])
+        for part in xrange(2):
+            open(journal.get_state_filename(part, 2), "w").close()
+        journal.has_state(2).should.be.ok
+        journal.has_state(3).should_not.be.ok
+
+        resumed = Journal(directory, 2)
+        resumed.load()
+        resumed.sequence.should.equal(1)
+        resumed.completed_files.should.equal(frozenset(["/a", "/b"]))
+        # state of checkpoint 2 was never committed to journal.json
+        os.listdir(directory).should.equal(["journal.json"])
+    finally:
+        shutil.rmtree(directory)
+
+def test_save_checkpoint():
+    directory = tempfile.mkdtemp()
+    try:
+        journal = Journal(directory, 2)
+        tracker = SpeculationTracker(None)
+        tracker.committed_items.extend(["/b", "/a"])
+        output_queue = Queue()
+        abort_event = threading.Event()
+
+        def reduce_checkpoints():
+            while True:
+                checkpoint = output_queue.get()
+                if checkpoint is None:
+                    return
+                for part in xrange(2):
+                    open(journal.get_state_filename(part, checkpoint.sequence), "w").close()
+
+        reducer = threading.Thread(target=reduce_checkpoints)
+        reducer.start()
+        try:
+            save_checkpoint(journal, tracker, output_queue, abort_event).should.be.ok
+            tracker.committed_items.append("/c")
+            save_checkpoint(journal, tracker, output_queue, abort_event, final=True).should.be.ok
+            # no checkpoints after the final one
+            save_checkpoint(journal, tracker, output_queue, abort_event).should_not.be.ok
+        finally:
+            output_queue.put(None)
+            reducer.join()
+
+        journal.sequence.should.equal(2)
+        journal.files.should.equal(["/b", "/a", "/c"])
+        sorted(os.listdir(directory)).should.equal(["journal.json", "state.part-00000.2", "state.part-00001.2"])
+    finally:
+        shutil.rmtree(directory)
+
+def test_checkpoint_ends_output_blocks():
+    output_queue = Queue()
+    checkpoint = Checkpoint(None, 1)
+    for item in (b"a\n", b"b\n", checkpoint, b"c\n"):
+        output_queue.put(item)
+    get_output_blocks(output_queue).should.equal([b"a\n", b"b\n", checkpoint])
+    get_output_blocks(output_queue).should.equal([b"c\n"])
@@ -0,0 +1,157 @@
+from smr import get_default_config
+import smr.map
+from smr.map import CombineBuffer, iter_downloads
+
+from io import BytesIO
+import os
+import shutil
+import sure
+import tempfile
+import threading
+import time
+
+def get_config(prefetch, stream_input=False):
+    config = get_default_config()
+    config.prefetch = prefetch
+    config.STREAM_INPUT = stream_input
+    return config
+
+def create_files(temp_dir, count):
+    uris = []
+    for i in xrange(count):
+        file_name = os.path.join(temp_dir, "file{}.txt".format(i))
+        with open(file_name, "w") as f:
+            f.write("line {}\n".format(i))
+        uris.append("file://{}".format(file_name))
+    return uris
+
+def wait_for_threads(threads, timeout=5):
+    """ returns threads that are still alive after timeout seconds """
+    end_time = time.time() + timeout
+    while time.time() < end_time and any(thread.is_alive() for thread in threads):
+        time.sleep(0.01)
+    return [thread for thread in threads if thread.is_alive()]
+
+def test_iter_downloads_yields_each_uri_once():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        uris = create_files(temp_dir, 50)
+        for prefetch in (0, 1, 4):
+            downloads = list(iter_downloads(get_config(prefetch), iter(uris)))
+            sorted(uri for uri, _, _, _ in downloads).should.equal(sorted(uris))
+            for uri, map_input, download_error, download_seconds in downloads:
+                download_error.should.be.none
+                os.path.samefile(map_input, uri[len("file://"):]).should.be.ok
+                download_seconds.should.be.greater_than_or_equal_to(0)
+    finally:
+        shutil.rmtree(temp_dir)
+
+def test_iter_downloads_reports_errors():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        uris = create_files(temp_dir, 5)
+        missing = "file://{}".format(os.path.join(temp_dir, "missing.txt"))
+        for prefetch in (0, 3):
+            downloads = dict((uri, (map_input, download_error)) for uri, map_input, download_error, _ in
+                iter_downloads(get_config(prefetch, stream_input=True), iter(uris[:2] + [missing] + uris[2:])))
+            len(downloads).should.equal(6)
+            map_input, download_error = downloads.pop(missing)
+            map_input.should.be.none
+            download_error.should.be.a(IOError)
+            # a failed download doesn't stop the others
+            for map_input, download_error in downloads.values():
+                download_error.should.be.none
+                map_input.read().should.match(r"^line \d\n$")
+                map_input.close()
+    finally:
+        shutil.rmtree(temp_dir)
+
+def test_iter_downloads_stops_threads():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        uris = create_files(temp_dir, 20)
+        threads_before = set(threading.enumerate())
+        list(iter_downloads(get_config(4), iter(uris))).should.have.length_of(20)
+        wait_for_threads([thread for thread in threading.enumerate() if thread not in threads_before]).should.equal([])
+    finally:
+        shutil.rmtree(temp_dir)
+
+def record_downloads(started, cleaned_up):
+    """ replaces downloading and cleanup in smr.map with functions that record uris, returns a function that restores them """
+    download_map_input = smr.map.download_map_input
+    cleanup_map_input = smr.map.cleanup_map_input
+    def record_download(config, uri, span_writer=None):
+        started.append(uri)
+        return uri, uri, None, 0.0
+    def record_cleanup(config, uri, map_input):
+        cleaned_up.append(uri)
+    smr.map.download_map_input = record_download
+    smr.map.cleanup_map_input = record_cleanup
+    def restore():
+        smr.map.download_map_input = download_map_input
+        smr.map.cleanup_map_input = cleanup_map_input
+    return restore
+
+def test_iter_downloads_limits_prefetched_files():
+    started = []
+    restore = record_downloads(started, [])
+    try:
+        uris = ["file:///file{}.txt".format(i) for i in xrange(20)]
+        for i, _ in enumerate(iter_downloads(get_config(3), iter(uris))):
+            time.sleep(0.02) # let download threads run ahead as far as they can
+            # files that were taken, and at most 3 more that are downloaded or waiting
+            len(started).should.be.lower_than_or_equal_to(i + 1 + 3)
+        len(started).should.equal(20)
+    finally:
+        restore()
+
+def test_iter_downloads_cleans_up_on_exit():
+    started = []
+    cleaned_up = []
+    restore = record_downloads(started, cleaned_up)
+    try:
+        uris = ["file:///file{}.txt".format(i) for i in xrange(20)]
+        threads_before = set(threading.enumerate())
+        downloads = iter_downloads(get_config(4), iter(uris))
+        uri, _, _, _ = next(downloads)
+        time.sleep(0.05)
+        downloads.close()
+        wait_for_threads([thread for thread in threading.enumerate() if thread not in threads_before]).should.equal([])
+        # every file that was downloaded but not taken is cleaned up
+        sorted(cleaned_up).should.equal(sorted([started_uri for started_uri in started if started_uri != uri]))
+        len(cleaned_up).should.be.greater_than(0)
+    finally:
+        restore()
+
+def count_words(lines):
+    counts = {}
+    for line in lines:
+        counts[line] = counts.get(line, 0) + 1
+    return ["{}\t{}".format(word, count) for word, count in sorted(counts.items())]
+
+def test_combine_buffer_keeps_unterminated_line_on_partial_flush():
+    output = BytesIO()
+    combine_buffer = CombineBuffer(count_words, output, 12)
+    combine_buffer.write("a\na\nb\n")
+    output.getvalue().should.equal(b"")
+    # buffer is full in the middle of a line, only complete lines are combined
+    combine_buffer.write("b\na\nbanan")
+    output.getvalue().should.equal(b"a\t3\nb\t2\n")
+    combine_buffer.write("a\n")
+    combine_buffer.combine()
+    output.getvalue().should.equal(b"a\t3\nb\t2\nbanana\t1\n")
+
+def test_combine_buffer_discard():
+    output = BytesIO()
+    combine_buffer = CombineBuffer(count_words, output, 8)
+    combine_buffer.write("a\nb\nc\nd\ne")
+    output.getvalue().should.equal(b"a\t1\nb\t1\nc\t1\nd\t1\n")
+    combine_buffer.write("\nf\n")
+    # output that was already combined stays, lines that weren't are dropped
+    combine_buffer.discard()
+    combine_buffer.size.should.equal(0)
+    combine_buffer.combine()
+    output.getvalue().should.equal(b"a\t1\nb\t1\nc\t1\nd\t1\n")
+    combine_buffer.write("g\n")
+    combine_buffer.combine()
+    output.getvalue().should.equal(b"a\t1\nb\t1\nc\t1\nd\t1\ng\t1\n")
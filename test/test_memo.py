@@ -0,0 +1,139 @@
+import os
+from Queue import Queue
+import shutil
+import tempfile
+import threading
+
+from smr.config import get_config
+import smr.memo
+from smr.memo import MapOutputCache, get_job_hash
+from smr.speculate import PendingOutput
+
+import sure
+
+def MAP_FUNC(file_name):
+    pass
+
+def get_pending(blocks):
+    pending = PendingOutput(1024)
+    for block in blocks:
+        pending.append(block)
+    return pending
+
+def test_map_output_cache():
+    directory = tempfile.mkdtemp()
+    try:
+        config = get_config(["job.py", "--map-output-cache-dir", directory])
+        config.MAP_FUNC = MAP_FUNC
+        config.COMBINE_FUNC = None
+        cache = MapOutputCache(config)
+        input_filename = os.path.join(directory, "a.txt")
+        with open(input_filename, "w") as f:
+            f.write("a\nb\nc\n")
+        uri = "file:/{}".format(input_filename)
+        version = os.stat(input_filename).st_mtime
+
+        cache.replay(uri, 10, None).should_not.be.ok # unknown version, can't be cached
+        cache.replay(uri, 10, version).should_not.be.ok
+        cache.add(uri, version, get_pending([b"a\n", b"b\nc\n"]))
+        cache.pending_write_size.should.equal(0) # written right away without background threads
+        cache.replay(uri, 10, version).should.be.ok
+        _, _, key = cache.replay_queue.get_nowait()
+        list(cache.read(key)).should.equal([b"a\n", b"b\nc\n"])
+        # checked out files are deleted once they're read or closed
+        cache.read(key).close()
+        os.listdir(cache.cache.temp_dir).should.equal([])
+
+        # file was modified since
+        cache.replay(uri, 10, version + 1).should_not.be.ok
+        # file was modified after it was listed, mapper might have processed the new contents
+        cache.add(uri, version - 1, get_pending([b"a\n"]))
+        cache.replay(uri, 10, version - 1).should_not.be.ok
+    finally:
+        shutil.rmtree(directory)
+
+def test_map_output_cache_writes_in_background():
+    directory = tempfile.mkdtemp()
+    try:
+        config = get_config(["job.py", "--map-output-cache-dir", directory])
+        config.MAP_FUNC = MAP_FUNC
+        config.COMBINE_FUNC = None
+        cache = MapOutputCache(config)
+        input_filename = os.path.join(directory, "a.txt")
+        with open(input_filename, "w") as f:
+            f.write("a\n")
+        uri = "file:/{}".format(input_filename)
+        version = os.stat(input_filename).st_mtime
+
+        cache.start(Queue(), Queue(), Queue(), None, threading.Event())
+        cache.add(uri, version, get_pending([b"a\n"]))
+        cache.stop() # waits for pending output to be written
+        cache.replay(uri, 1, version).should.be.ok
+    finally:
+        shutil.rmtree(directory)
+
+def test_job_hash():
+    directory = tempfile.mkdtemp()
+    try:
+        job_filename = os.path.join(directory, "job.py")
+        def get_hash(job, args=[]):
+            with open(job_filename, "w") as f:
+                f.write(job)
+            config = get_config([job_filename] + args)
+            config.MAP_FUNC = MAP_FUNC
+            config.COMBINE_FUNC = None
+            return get_job_hash(config)
+        job_hash = get_hash("SCALE = 1\n")
+        get_hash("SCALE = 1\n").should.equal(job_hash)
+        # e.g. a constant that MAP_FUNC uses changed
+        get_hash("SCALE = 2\n").should_not.equal(job_hash)
+        # with an explicit version, only the version and source of MAP_FUNC and COMBINE_FUNC matter
+        version_hash = get_hash("SCALE = 1\n", ["--map-output-cache-version", "1"])
+        get_hash("SCALE = 2\n", ["--map-output-cache-version", "1"]).should.equal(version_hash)
+        get_hash("SCALE = 2\n", ["--map-output-cache-version", "2"]).should_not.equal(version_hash)
+    finally:
+        shutil.rmtree(directory)
+
+def test_map_output_cache_limits_pending_writes():
+    directory = tempfile.mkdtemp()
+    max_pending_write_size = smr.memo.MAX_PENDING_WRITE_SIZE
+    smr.memo.MAX_PENDING_WRITE_SIZE = 10
+    try:
+        config = get_config(["job.py", "--map-output-cache-dir", directory])
+        config.MAP_FUNC = MAP_FUNC
+        config.COMBINE_FUNC = None
+        cache = MapOutputCache(config)
+        cache.threads = [None] # pretend write_thread is running
+        first, second = get_pending([b"aaaa\n"]), get_pending([b"bbbbbbbb\n"])
+        cache.add("a", 1, first)
+        # second output doesn't fit in memory along with the first one, it's not cached
+        cache.add("b", 1, second)
+        cache.pending_write_size.should.equal(5)
+        cache.write_queue.qsize().should.equal(1)
+        second.blocks.should.equal([])
+    finally:
+        smr.memo.MAX_PENDING_WRITE_SIZE = max_pending_write_size
+        shutil.rmtree(directory)
+
+def test_map_output_cache_reads_large_output():
+    directory = tempfile.mkdtemp()
+    try:
+        config = get_config(["job.py", "--map-output-cache-dir", directory])
+        config.MAP_FUNC = MAP_FUNC
+        config.COMBINE_FUNC = None
+        cache = MapOutputCache(config)
+        input_filename = os.path.join(directory, "a.txt")
+        with open(input_filename, "w") as f:
+            f.write("a\n")
+        uri = "file:/{}".format(input_filename)
+        version = os.stat(input_filename).st_mtime
+        blocks = [b"line {}\n".format(i) * 1000 for i in xrange(200)]
+        cache.add(uri, version, get_pending(blocks))
+        cache.replay(uri, 1, version).should.be.ok
+        _, _, key = cache.replay_queue.get_nowait()
+        # blocks are decoded as the file is read, not all at once
+        cached = iter(cache.read(key))
+        next(cached).should.equal(blocks[0])
+        list(cached).should.equal(blocks[1:])
+    finally:
+        shutil.rmtree(directory)
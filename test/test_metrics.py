@@ -0,0 +1,44 @@
+from smr.metrics import Histogram, JobMetrics, format_metrics, parse_metrics_line
+
+import sure
+
+def test_parse_metrics_line():
+    line = "M,{},s3://bucket/file,with,commas\n".format(format_metrics(0.5, 0.25, 2.0, 1024, 10, 100))
+    item, metrics = parse_metrics_line(line)
+    item.should.equal("s3://bucket/file,with,commas")
+    metrics.should.equal({
+        "download_seconds": 0.5, "wait_seconds": 0.25, "map_seconds": 2.0,
+        "input_bytes": 1024, "output_records": 10, "output_bytes": 100
+    })
+    parse_metrics_line.when.called_with("M,1;2,file").should.throw(ValueError)
+
+def test_histogram():
+    histogram = Histogram((1, 10))
+    for value in (0.5, 1, 5, 50):
+        histogram.add(value)
+    histogram.get_cumulative_counts().should.equal([(1, 2), (10, 3), ("+Inf", 4)])
+    histogram.sum.should.equal(56.5)
+    histogram.count.should.equal(4)
+
+def test_job_metrics():
+    job_metrics = JobMetrics()
+    job_metrics.add_status_line("worker1", "M,{},file1".format(format_metrics(1.0, 0.0, 2.0, 4 * 1024 * 1024, 10, 100)))
+    job_metrics.add_status_line("worker1", "M,{},file2".format(format_metrics(0.0, 0.5, 0.0, 10, 1, 10)))
+    job_metrics.add_status_line("worker2", "M,{},file3".format(format_metrics(0.0, 0.0, 1.0, 1024 * 1024, 5, 50)))
+    job_metrics.add_status_line("worker2", "M,invalid,file4")
+
+    report = job_metrics.get_report(10.0)
+    report["workers"]["worker1"]["files"].should.equal(2)
+    report["workers"]["worker1"]["output_records"].should.equal(11)
+    report["workers"]["worker2"]["map_seconds"].should.equal(1.0)
+    report["totals"]["files"].should.equal(3)
+    report["totals"]["output_bytes"].should.equal(160)
+    # files that took no time to map don't count towards throughput
+    report["histograms"]["file_throughput_mb_per_second"]["count"].should.equal(2)
+    report["histograms"]["file_throughput_mb_per_second"]["sum"].should.equal(3.0)
+    report["histograms"]["file_map_seconds"]["count"].should.equal(3)
+
+    text = job_metrics.get_prometheus_text(10.0)
+    text.should.contain("smr_worker_files{worker=\"worker1\"} 2\n")
+    text.should.contain("smr_file_throughput_mb_per_second_bucket{le=\"+Inf\"} 2\n")
+    text.should.contain("smr_file_map_seconds_count 3\n")
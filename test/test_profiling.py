@@ -0,0 +1,49 @@
+import cProfile
+import os
+import shutil
+import tempfile
+
+from smr.config import get_config
+from smr.profiling import dump_profile, finish_profiling, get_profiler, profile_calls, read_folded_stacks, \
+    write_folded_stacks
+
+import sure
+
+def busy(n):
+    return sum(i * i for i in xrange(n))
+
+def test_get_profiler():
+    get_profiler(get_config(["job.py"])).should.equal(None)
+    config = get_config(["job.py", "--profile"])
+    config.profile.should.equal("cprofile")
+    config.profile_dir = "/tmp"
+    get_profiler(config).should.be.a(cProfile.Profile)
+
+def test_folded_stacks():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(temp_dir, "map.folded")
+        write_folded_stacks(filename, {b"main;map (job.py:1)": 3, b"main": 1})
+        stacks = {b"main": 1}
+        read_folded_stacks(filename, stacks)
+        stacks.should.equal({b"main;map (job.py:1)": 3, b"main": 2})
+    finally:
+        shutil.rmtree(temp_dir)
+
+def test_merge_profiles():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        for mode, suffixes in (("cprofile", (".prof", ".txt")), ("sampling", (".folded", ".txt"))):
+            config = get_config(["job.py", "--profile", mode, "--profile-interval", "0.001", "--output-filename", os.path.join(temp_dir, "job.out")])
+            config.profile_dir = os.path.join(temp_dir, "profiles")
+            profiler = get_profiler(config)
+            profile_calls(profiler, busy)(300000).should.equal(busy(300000))
+            dump_profile(config, profiler, "map")
+            finish_profiling(config)
+
+            os.path.exists(config.profile_dir).should.equal(False)
+            for suffix in suffixes:
+                with open(os.path.join(temp_dir, "job.out.map-profile" + suffix), "rb") as f:
+                    f.read().should.contain(b"busy")
+    finally:
+        shutil.rmtree(temp_dir)
@@ -0,0 +1,42 @@
+import os
+import sys
+
+from smr.config import get_config
+from smr.journal import CHECKPOINT_MARKER
+from smr.reduce import iter_batches, iter_results
+
+import sure
+
+def read_stdin(iter_func, data, args):
+    config = get_config(["job.py"] + args)
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, data)
+    os.close(write_fd)
+    stdin = sys.stdin
+    sys.stdin = os.fdopen(read_fd, "rb")
+    try:
+        return list(iter_func(config))
+    finally:
+        sys.stdin.close()
+        sys.stdin = stdin
+
+def get_batches(data, args):
+    return read_stdin(iter_batches, data, args)
+
+def test_iter_batches():
+    data = b"".join(b"line {}\n".format(i) for i in xrange(25))
+    batches = get_batches(data, ["--reduce-batch-size", "10"])
+    [len(batch) for batch in batches].should.equal([10, 10, 5])
+    sum(batches, []).should.equal([b"line {}".format(i) for i in xrange(25)])
+
+def test_iter_batches_with_control_records():
+    checkpoint = CHECKPOINT_MARKER + b"state.part-00000.1"
+    data = b"a\nb\n" + checkpoint + b"\nc\n"
+    get_batches(data, ["--mark-output"]).should.equal([[b"a", b"b"], checkpoint, [b"c"]])
+
+def test_batches_match_results():
+    # REDUCE_BATCH_FUNC sees the same records as REDUCE_FUNC
+    data = b"a\t1\r\nb\t2  \nc\t3\n"
+    results = read_stdin(iter_results, data, [])
+    results.should.equal([b"a\t1", b"b\t2", b"c\t3"])
+    sum(get_batches(data, []), []).should.equal(results)
@@ -0,0 +1,29 @@
+from smr.config import get_config
+from smr.schedule import schedule_files
+
+import sure
+
+FILES = [("a", 10), ("b", 30), ("c", 20)]
+
+def get_schedule_config(schedule, schedule_func=None):
+    config = get_config(["job.py", "--schedule", schedule])
+    config.SCHEDULE_FUNC = schedule_func
+    return config
+
+def test_schedule_files():
+    schedule_files(FILES, get_schedule_config("largest-first")).should.equal([("b", 30), ("c", 20), ("a", 10)])
+    schedule_files(FILES, get_schedule_config("smallest-first")).should.equal([("a", 10), ("c", 20), ("b", 30)])
+    schedule_files(FILES, get_schedule_config("listing")).should.equal(FILES)
+    sorted(schedule_files(FILES, get_schedule_config("random"))).should.equal(sorted(FILES))
+
+def test_schedule_func():
+    config = get_schedule_config("largest-first", lambda files: reversed(files))
+    schedule_files(FILES, config).should.equal([("c", 20), ("b", 30), ("a", 10)])
+
+def test_schedule_func_keeps_listed_fields():
+    config = get_schedule_config("listing", lambda files: sorted(files, key=lambda f: f[1]))
+    schedule_files([("a", 10, "v1"), ("b", 5, "v2")], config).should.equal([("b", 5, "v2"), ("a", 10, "v1")])
+
+def test_schedule_func_adds_files():
+    config = get_schedule_config("listing", lambda files: files + [("c", 20)])
+    schedule_files([("a", 10, "v1")], config).should.equal([("a", 10, "v1"), ("c", 20, None)])
@@ -0,0 +1,8 @@
+from smr.shared import route_blocks
+from smr.transport import tag_payload
+
+import sure
+
+def test_route_blocks():
+    blocks = [tag_payload(1, b"a\nb"), tag_payload(0, b"c"), tag_payload(1, b"d")]
+    route_blocks(blocks, 3).should.equal([[b"c"], [b"a\nb", b"d"], []])
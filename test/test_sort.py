@@ -0,0 +1,75 @@
+import os
+import random
+import shutil
+import tempfile
+
+from smr.config import get_config
+from smr.sort import MERGE_FAN_IN, ExternalSorter, is_grouped_reduce, split_record
+
+import sure
+
+def test_split_record():
+    split_record(b"key\tvalue\twith tab").should.equal((b"key", b"value\twith tab"))
+    split_record(b"key").should.equal((b"key", b""))
+    split_record(b"a,b", lambda record: record.split(b",")[1]).should.equal((b"b", b"a,b"))
+
+def test_is_grouped_reduce():
+    config = get_config(["job.py"])
+    config.REDUCE_FUNC = lambda record: None
+    is_grouped_reduce(config).should.equal(False)
+    config.REDUCE_FUNC = lambda key, values: None
+    is_grouped_reduce(config).should.equal(True)
+
+def test_external_sort():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        records = [(b"key{}".format(random.randint(0, 100)), b"{}".format(i)) for i in xrange(5000)]
+        sorter = ExternalSorter(10000, temp_dir)
+        for key, value in records:
+            sorter.add(key, value)
+        # records that don't fit in the buffer are spilled in sorted runs
+        len(sorter.runs).should.be.greater_than(10)
+
+        groups = [(key, sorted(values, key=int)) for key, values in sorter.iter_groups()]
+        [key for key, _ in groups].should.equal(sorted(set(key for key, _ in records)))
+        expected = {}
+        for key, value in records:
+            expected.setdefault(key, []).append(value)
+        dict(groups).should.equal(expected)
+
+        sorter.cleanup()
+        len(sorter.runs).should.equal(0)
+        os.listdir(temp_dir).should.equal([])
+    finally:
+        shutil.rmtree(temp_dir)
+
+def test_external_sort_merges_in_passes():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        sorter = ExternalSorter(2000, temp_dir)
+        for i in xrange(2000):
+            sorter.add(random.randint(0, 1000), b"{}".format(i))
+        len(sorter.runs).should.be.greater_than(MERGE_FAN_IN * 2)
+        merged = list(sorter.iter_sorted())
+        # no more than MERGE_FAN_IN runs are open at once
+        len(sorter.runs).should.be.lower_than_or_equal_to(MERGE_FAN_IN)
+        [key for key, _ in merged].should.equal(sorted(key for key, _ in merged))
+        sorted(int(value) for _, value in merged).should.equal(range(2000))
+        sorter.cleanup()
+        os.listdir(temp_dir).should.equal([])
+    finally:
+        shutil.rmtree(temp_dir)
+
+def test_external_sort_compares_only_keys():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        for buffer_size in (1000, 1000000):
+            sorter = ExternalSorter(buffer_size, temp_dir)
+            values = [b"{}".format(random.randint(0, 1000)) for _ in xrange(300)]
+            for i, value in enumerate(values):
+                sorter.add(i % 3, value)
+            # values aren't compared, so records with equal keys stay in the order they were added
+            list(sorter.iter_sorted()).should.equal([(key, value) for key in xrange(3) for value in values[key::3]])
+            sorter.cleanup()
+    finally:
+        shutil.rmtree(temp_dir)
@@ -0,0 +1,164 @@
+from io import BytesIO
+import os
+from Queue import Empty, Queue
+import shutil
+import tempfile
+import threading
+
+from smr.config import get_config
+from smr.speculate import MAX_QUEUED_OUTPUT, OutputCommitter, OutputFeeder, PendingOutput, SpeculationTracker, \
+    commit_map_output, get_marker
+from smr.transport import PartitionWriter, decode_records, get_partition, iter_blocks, iter_frames, split_tagged_block
+
+import sure
+
+def get_committed_output(data, tracker, transport="lines", args=[]):
+    config = get_config(["job.py", "--transport", transport] + args)
+    output_queue = Queue()
+    chunks = iter([data[i:i + 7] for i in xrange(0, len(data), 7)] + [b""])
+    commit_map_output(iter_blocks(lambda size: next(chunks), config), tracker, output_queue, config)
+    blocks = []
+    while not output_queue.empty():
+        blocks.append(output_queue.get())
+    return b"".join(blocks)
+
+def test_commit_map_output():
+    tracker = SpeculationTracker(2.0)
+    data = b"".join([
+        b"a\nb\n", get_marker(True, "file1"), b"\n",
+        b"partial", b"\n", get_marker(False, "file2"), b"\n",
+        b"c\n", get_marker(True, "file3"), b"\n",
+        b"a\nb\n", get_marker(True, "file1"), b"\n", # duplicate of file1
+        b"unfinished\n",
+    ])
+    get_committed_output(data, tracker).should.equal(b"a\nb\nc\n")
+    tracker.committed.should.equal(2)
+
+def test_speculative_item():
+    tracker = SpeculationTracker(2.0)
+    for i in xrange(4):
+        tracker.add("file{}".format(i), 100)
+        tracker.start("file{}".format(i))
+    tracker.get_speculative_item().should.be.none # not enough finished files to tell
+    for i in xrange(3):
+        tracker.finish("file{}".format(i), 100).should.be.ok
+    tracker.finish("file0", 100).should_not.be.ok # duplicate finished later
+    tracker.running["file3"][1] -= 60 # pretend file3 was started a minute ago
+    tracker.get_speculative_item().should.equal("file3")
+    tracker.get_speculative_item().should.be.none # only one duplicate per file
+    tracker.start("file3")
+
+    # file is requeued only after all of its attempts failed
+    tracker.fail("file3").should_not.be.ok
+    tracker.fail("file3").should.be.ok
+
+    listing_done = threading.Event()
+    listing_done.set()
+    tracker.is_finished(listing_done).should_not.be.ok
+
+def test_pending_output_spills():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        pending = PendingOutput(10, temp_dir)
+        blocks = [b"a\n", b"bbbb\n", b"cccccc\n", b"d\n"]
+        for block in blocks:
+            pending.append(block)
+        pending.is_spilled().should.be.ok
+        pending.size.should.equal(7) # blocks that don't fit, and all blocks after them, are on disk
+        list(pending).should.equal(blocks)
+        list(pending).should.equal(blocks) # can be read again, e.g. by map output cache
+        pending.close()
+        os.listdir(temp_dir).should.equal([])
+    finally:
+        shutil.rmtree(temp_dir)
+
+def test_commit_spilled_map_output():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        tracker = SpeculationTracker(None)
+        data = b"".join([b"line {}\n".format(i) for i in xrange(100)] + [get_marker(True, "file1"), b"\n",
+            b"partial\n" * 10, get_marker(False, "file2"), b"\n", b"unfinished\n" * 10])
+        output = get_committed_output(data, tracker, args=["--pending-output-size", "20", "--sort-dir", temp_dir])
+        output.should.equal(b"".join(b"line {}\n".format(i) for i in xrange(100)))
+        # spilled output of failed and unfinished files is deleted too
+        os.listdir(temp_dir).should.equal([])
+    finally:
+        shutil.rmtree(temp_dir)
+
+def test_commit_partitioned_map_output():
+    tracker = SpeculationTracker(None)
+    config = get_config(["job.py", "--transport", "framed", "--partitions", "2"])
+    data = BytesIO()
+    writer = PartitionWriter(data, config.record_encoding, 1024, 2)
+    writer.write(b"a\t1\nb\t1\nc\t1\n")
+    writer.write_marker(get_marker(True, "file1"))
+    writer.write(b"partial\t1\n")
+    writer.write_marker(get_marker(False, "file2"))
+    writer.write(b"d\t1\n")
+    writer.write_marker(get_marker(True, "file1")) # duplicate of file1
+    writer.write(b"unfinished\t1\n")
+    writer.flush()
+    output_queue = Queue()
+    commit_map_output(iter_frames(BytesIO(data.getvalue())), tracker, output_queue, config)
+    records = []
+    while not output_queue.empty():
+        # committed blocks are still tagged with their partition, for reduce_thread
+        partition, payload = split_tagged_block(output_queue.get())
+        records.extend((partition, record) for record in decode_records(payload, config.record_encoding))
+    sorted(records).should.equal(sorted((get_partition(record, 2), record) for record in (b"a\t1", b"b\t1", b"c\t1")))
+    tracker.committed.should.equal(1)
+
+class EventWaker(object):
+    def __init__(self):
+        self.event = threading.Event()
+
+    def wake(self):
+        self.event.set()
+
+def test_feeder_commits_spilled_output():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        tracker = SpeculationTracker(None)
+        config = get_config(["job.py", "--pending-output-size", "20", "--sort-dir", temp_dir])
+        output_queue = Queue()
+        for _ in xrange(MAX_QUEUED_OUTPUT):
+            output_queue.put(b"queued\n")
+        waker = EventWaker()
+        feeder = OutputFeeder(waker)
+        committer = OutputCommitter(tracker, output_queue, config, feeder=feeder)
+        spilled = b"".join(b"line {}\n".format(i) for i in xrange(100))
+        # reducers are behind, commit returns right away and leaves spilled output to the feeder
+        committer.add(spilled + get_marker(True, "file1") + b"\n")
+        # files committed meanwhile are queued behind it, even if they're in memory
+        committer.add(b"small\n" + get_marker(True, "file2") + b"\n")
+        feeder.is_busy().should.be.ok
+        tracker.committed.should.equal(0)
+
+        blocks = []
+        try:
+            while True:
+                blocks.append(output_queue.get(timeout=1))
+        except Empty:
+            pass
+        feeder.stop()
+        waker.event.is_set().should.be.ok
+        tracker.committed_items.should.equal(["file1", "file2"])
+        b"".join(blocks).should.equal(b"queued\n" * MAX_QUEUED_OUTPUT + spilled + b"small\n")
+        os.listdir(temp_dir).should.equal([])
+    finally:
+        shutil.rmtree(temp_dir)
+
+def test_feeder_commits_while_commit_lock_is_held():
+    tracker = SpeculationTracker(None)
+    config = get_config(["job.py"])
+    output_queue = Queue()
+    feeder = OutputFeeder(EventWaker())
+    committer = OutputCommitter(tracker, output_queue, config, feeder=feeder)
+    # e.g. replayed output of a cached file waits for reducers
+    with tracker.commit_lock:
+        committer.add(b"a\n" + get_marker(True, "file1") + b"\n")
+        feeder.is_busy().should.be.ok
+        tracker.committed.should.equal(0)
+    feeder.stop()
+    tracker.committed_items.should.equal(["file1"])
+    output_queue.get_nowait().should.equal(b"a\n")
@@ -0,0 +1,65 @@
+from io import BytesIO
+
+from smr.split import SplitReader, bundle_files, get_bundle_item, get_split_item, parse_work_item, split_bundle, split_files
+
+import sure
+
+DATA = b"first line\nsecond\n\nfourth line is longer\nlast line without linebreak"
+
+def read_split(offset, length):
+    stream = BytesIO(DATA)
+    stream.seek(max(0, offset - 1))
+    return SplitReader(stream, offset, length).read()
+
+def test_parse_work_item():
+    parse_work_item("s3://bucket/file.txt").should.equal(("s3://bucket/file.txt", None, None))
+    parse_work_item(get_split_item("/tmp/file.txt", 100, 50)).should.equal(("/tmp/file.txt", 100, 50))
+
+def test_split_files():
+    files = [("/a.txt", 25), ("/b.txt", 5), ("/c.gz", 25)]
+    list(split_files(files, 0)).should.equal(files)
+    list(split_files(files, 10)).should.equal([
+        (get_split_item("/a.txt", 0, 10), 10),
+        (get_split_item("/a.txt", 10, 10), 10),
+        (get_split_item("/a.txt", 20, 5), 5),
+        ("/b.txt", 5),
+        ("/c.gz", 25), # compressed files can't be split
+    ])
+    # other listed fields are kept for each split
+    list(split_files([("/a.txt", 15, 1.0)], 10)).should.equal([(get_split_item("/a.txt", 0, 10), 10, 1.0), (get_split_item("/a.txt", 10, 5), 5, 1.0)])
+
+def test_bundle_files():
+    files = [("/a", 5), ("/b", 3), ("/c", 10), ("/d", 1)]
+    list(bundle_files(files, 0)).should.equal([[f] for f in files])
+    list(bundle_files(files, 8)).should.equal([[("/a", 5), ("/b", 3)], [("/c", 10)], [("/d", 1)]])
+    split_bundle(get_bundle_item(["/a", "/b"])).should.equal(["/a", "/b"])
+    split_bundle("/a").should.equal(["/a"])
+
+def test_split_reader():
+    # every line is read by exactly one split, whatever the split size
+    for split_size in xrange(1, len(DATA) + 1):
+        splits = [read_split(offset, min(split_size, len(DATA) - offset)) for offset in xrange(0, len(DATA), split_size)]
+        b"".join(splits).should.equal(DATA)
+        # and splits only contain whole lines
+        pos = 0
+        for split in splits:
+            if pos > 0 and split:
+                DATA[pos - 1:pos].should.equal(b"\n")
+            pos += len(split)
+
+def test_split_reader_read_size():
+    for size in xrange(1, 12):
+        stream = BytesIO(DATA)
+        stream.seek(10)
+        reader = SplitReader(stream, 11, 20)
+        chunks = []
+        for chunk in iter(lambda: reader.read(size), b""):
+            len(chunk).should.be.lower_than_or_equal_to(size)
+            chunks.append(chunk)
+        # the last line is read past the end of split
+        b"".join(chunks).should.equal(b"second\n\nfourth line is longer\n")
+    stream = BytesIO(DATA)
+    reader = SplitReader(stream, 0, 5)
+    reader.read(3).should.equal(b"fir")
+    reader.readline().should.equal(b"st line\n")
+    reader.read().should.equal(b"")
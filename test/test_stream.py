@@ -0,0 +1,45 @@
+from smr.stream import ReadAheadStream
+
+import gzip
+from io import BytesIO
+import sure
+
+def get_stream(data, buffer_size=1024):
+    return ReadAheadStream(BytesIO(data), len(data), buffer_size)
+
+def gzip_member(data):
+    out = BytesIO()
+    with gzip.GzipFile(fileobj=out, mode="wb") as f:
+        f.write(data)
+    return out.getvalue()
+
+def test_read():
+    data = b"".join(b"line {}\n".format(i) for i in xrange(100000))
+    stream = get_stream(data)
+    stream.read(5).should.equal(b"line ")
+    stream.readline().should.equal(b"0\n")
+    stream.readline().should.equal(b"line 1\n")
+    stream.read().should.equal(data[len(b"line 0\nline 1\n"):])
+    stream.read(10).should.equal(b"")
+    stream.tell().should.equal(len(data))
+
+def test_seek():
+    data = b"0123456789" * 100000
+    stream = get_stream(data)
+    stream.read(100000)
+    stream.seek(-10, 1)
+    stream.read(10).should.equal(b"0123456789")
+    stream.seek(0, 2)
+    stream.tell().should.equal(len(data))
+    stream.seek(100000)
+    stream.read(3).should.equal(b"012")
+    stream.seek(500003)
+    stream.read(3).should.equal(b"345")
+    stream.seek.when.called_with(0).should.throw(IOError)
+
+def test_multi_member_gzip():
+    data = b"".join(gzip_member(b"record {}\n".format(i) * 1000) for i in xrange(20))
+    with gzip.GzipFile(fileobj=get_stream(data)) as f:
+        lines = f.readlines()
+    len(lines).should.equal(20000)
+    lines[-1].should.equal(b"record 19\n")
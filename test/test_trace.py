@@ -0,0 +1,59 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from smr.map import StatusWriter
+from smr.trace import SpanWriter, Tracer, parse_span_line
+
+import sure
+
+class Output(object):
+    def __init__(self):
+        self.lines = []
+
+    def write(self, data):
+        self.lines.extend(data.splitlines())
+
+    def flush(self):
+        pass
+
+def test_span_writer():
+    output = Output()
+    start_time = time.time()
+    SpanWriter(StatusWriter(output)).write("map", start_time, "s3://bucket/file,1")
+    len(output.lines).should.equal(1)
+    name, thread, span_start_time, duration, item = parse_span_line(output.lines[0])
+    (name, thread, item).should.equal(("map", "MainThread", "s3://bucket/file,1"))
+    span_start_time.should.equal(start_time, epsilon=0.000001)
+    duration.should.be.greater_than_or_equal_to(0)
+
+def test_tracer():
+    tracer = Tracer()
+    with tracer.span("reducer 0", "reduce-batch", blocks=2):
+        pass
+    tracer.dispatch("worker1", "file1")
+    tracer.add_status_line("worker1", "T,download;download-0;100.5;0.25,file1")
+    tracer.add_status_line("worker1", "T,invalid,file1")
+    tracer.finish_dispatch("worker1", "file1")
+    tracer.finish_dispatch("worker1", "file2")
+
+    spans = [event for event in tracer.events if event["ph"] == "X"]
+    [span["name"] for span in spans].should.equal(["reduce-batch", "download"])
+    spans[0]["args"].should.equal({"blocks": 2})
+    spans[1]["ts"].should.equal(100500000)
+    spans[1]["dur"].should.equal(250000)
+    spans[0]["pid"].shouldnt.equal(spans[1]["pid"])
+    [event["ph"] for event in tracer.events if event["name"] == "dispatch"].should.equal(["b", "e"])
+    names = dict((event["pid"], event["args"]["name"]) for event in tracer.events if event["name"] == "process_name")
+    names[spans[1]["pid"]].should.equal("worker1")
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(temp_dir, "trace.json")
+        tracer.save(filename)
+        with open(filename) as f:
+            json.load(f)["traceEvents"].should.have.length_of(len(tracer.events))
+    finally:
+        shutil.rmtree(temp_dir)
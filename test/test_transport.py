@@ -0,0 +1,154 @@
+from io import BytesIO
+import time
+
+from smr.transport import MARKER_PARTITION, FrameDecoder, FrameWriter, LineDecoder, PartitionWriter, decode_records, \
+    encode_frame, get_partition, get_partition_key, iter_frames, split_tagged_block
+
+import sure
+
+RECORDS = [b"key{}\tvalue{}".format(i, i) for i in xrange(1000)]
+
+def write_records(encoding, frame_size):
+    output = BytesIO()
+    writer = FrameWriter(output, encoding, frame_size)
+    for record in RECORDS:
+        writer.write(record)
+        writer.write(b"\n")
+    writer.flush()
+    return output.getvalue()
+
+def test_frame_round_trip():
+    for encoding in ("text", "marshal"):
+        data = write_records(encoding, 1024)
+        decoder = FrameDecoder()
+        payloads = []
+        # split frame headers and payloads across feed() calls
+        for i in xrange(0, len(data), 3):
+            payloads.extend(decoder.feed(data[i:i + 3]))
+        decoder.finish().should.equal([])
+        len(payloads).should.be.greater_than(1)
+        records = []
+        for payload in payloads:
+            records.extend(decode_records(payload, encoding))
+        records.should.equal(RECORDS)
+
+def test_iter_frames():
+    for encoding in ("text", "marshal"):
+        data = write_records(encoding, 1024)
+        records = []
+        for payload in iter_frames(BytesIO(data)):
+            records.extend(decode_records(payload, encoding))
+        records.should.equal(RECORDS)
+    # incomplete frame at the end is dropped
+    list(iter_frames(BytesIO(encode_frame(b"a\nb") + encode_frame(b"c")[:-1]))).should.equal([b"a\nb"])
+
+def test_frame_writer_keeps_incomplete_record():
+    output = BytesIO()
+    writer = FrameWriter(output, "text", 4)
+    writer.write(b"a\nbc")
+    writer.write(u"d")
+    writer.flush()
+    list(iter_frames(BytesIO(output.getvalue()))).should.equal([b"a"])
+    writer.write(b"e\n")
+    writer.flush()
+    list(iter_frames(BytesIO(output.getvalue()))).should.equal([b"a", b"bcde"])
+
+def test_frame_writer_end_record():
+    output = BytesIO()
+    writer = FrameWriter(output, "text", 1024)
+    writer.write(b"a\nunterminated")
+    writer.end_record()
+    writer.flush()
+    # the marker that follows output of a file isn't joined with its last line
+    writer.write(b"marker\n")
+    writer.end_record() # already terminated
+    writer.flush()
+    list(iter_frames(BytesIO(output.getvalue()))).should.equal([b"a\nunterminated", b"marker"])
+    writer.write(b"")
+    writer.end_record() # nothing was written since
+    writer.flush()
+    list(iter_frames(BytesIO(output.getvalue()))).should.equal([b"a\nunterminated", b"marker"])
+
+def test_frame_writer_end_long_record():
+    output = BytesIO()
+    writer = FrameWriter(output, "text", 1024 * 1024)
+    start_time = time.time()
+    for _ in xrange(20000):
+        writer.write(b"x" * 50)
+        writer.end_record()
+        writer.write(b"")
+    writer.flush()
+    (time.time() - start_time).should.be.lower_than(1)
+    list(iter_frames(BytesIO(output.getvalue()))).should.equal([b"\n".join([b"x" * 50] * 20000)])
+
+def test_frame_writer_long_record():
+    output = BytesIO()
+    writer = FrameWriter(output, "text", 1024)
+    start_time = time.time()
+    for _ in xrange(20000):
+        writer.write(b"x" * 50)
+    writer.write(b"\n")
+    writer.flush()
+    (time.time() - start_time).should.be.lower_than(1)
+    list(iter_frames(BytesIO(output.getvalue()))).should.equal([b"x" * 50 * 20000])
+
+def test_get_partition_key():
+    get_partition_key("word").should.equal("word")
+    get_partition_key("word\t5").should.equal("word")
+    get_partition_key("a,b", lambda line: line.split(",")[1]).should.equal("b")
+
+def test_get_partition():
+    for line in ("word\n", "other\t1\n", "third"):
+        partition = get_partition(line, 4)
+        partition.should.be.within(0, 3)
+        get_partition(line, 4).should.equal(partition)
+    # lines with the same key always go to the same reducer
+    get_partition("word\t1\n", 7).should.equal(get_partition("word\t2\n", 7))
+    get_partition("anything\n", 1).should.equal(0)
+    # keys are bytes and may contain any utf-8
+    get_partition(b"caf\xc3\xa9\t1\n", 2).should.equal(get_partition(b"caf\xc3\xa9\t2", 2))
+    get_partition_key(b"caf\xc3\xa9\t1").should.equal(b"caf\xc3\xa9")
+
+def test_partition_writer():
+    for encoding in ("text", "marshal"):
+        output = BytesIO()
+        writer = PartitionWriter(output, encoding, 256, 3)
+        for record in RECORDS[:500]:
+            writer.write(record + b"\n")
+        writer.write_marker(b"marker1")
+        for record in RECORDS[500:]:
+            writer.write(record[:3])
+            writer.write(record[3:] + b"\n")
+        writer.write(b"unterminated")
+        writer.write_marker(b"marker2")
+        partitions = [[] for _ in xrange(3)]
+        markers = []
+        for block in iter_frames(BytesIO(output.getvalue())):
+            partition, payload = split_tagged_block(block)
+            records = decode_records(payload, encoding)
+            if partition == MARKER_PARTITION:
+                markers.append((records, sum(len(records) for records in partitions)))
+            else:
+                partitions[partition].extend(records)
+        # markers follow all output written before them
+        markers.should.equal([([b"marker1"], 500), ([b"marker2"], 1001)])
+        for i, records in enumerate(partitions):
+            records.should.equal([record for record in RECORDS + [b"unterminated"] if get_partition(record, 3) == i])
+
+def test_partition_writer_end_record():
+    output = BytesIO()
+    writer = PartitionWriter(output, "text", 256, 2)
+    writer.write(b"")
+    writer.end_record() # no spurious empty record
+    writer.write(b"a\t1")
+    writer.end_record()
+    writer.flush()
+    [split_tagged_block(block)[1] for block in iter_frames(BytesIO(output.getvalue()))].should.equal([b"a\t1"])
+
+def test_line_decoder():
+    decoder = LineDecoder()
+    decoder.feed(b"a\nb").should.equal([b"a\n"])
+    decoder.feed(b"c").should.equal([])
+    decoder.feed(b"\nd\ne").should.equal([b"bc\nd\n"])
+    decoder.finish().should.equal([b"e\n"])
+    LineDecoder().finish().should.equal([])
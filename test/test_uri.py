@@ -1,9 +1,21 @@
 from smr import get_default_config
-from smr.uri import get_uris
+import smr.uri
+from smr.shared import get_param, start_listing
+from smr.uri import cleanup, download, download_s3_key_ranges, get_uris, iter_s3_prefixes, open_uri, pop_cache_status
 
+from contextlib import contextmanager
+import datetime
+from io import BytesIO
+import os
+from Queue import Queue
+import shutil
 import sure
+import tempfile
+import threading
+import time
 from moto import mock_s3
 import boto
+from boto.exception import S3ResponseError
 from boto.s3.key import Key
 
 def upload_file(bucket, file):
@@ -38,3 +50,397 @@ def test_get_uris():
     len(uris).should.equal(2)
     uris.should.have("s3://mybucket/dir1/file1.csv")
     uris.should.have("s3://mybucket/dir1/dir2/file2.csv")
+
+@mock_s3
+def test_open_uri():
+    conn = boto.connect_s3()
+    bucket = conn.create_bucket('mybucket')
+    k = Key(bucket)
+    k.key = "dir1/big.txt"
+    data = "".join("line {}\n".format(i) for i in xrange(100000))
+    k.set_contents_from_string(data)
+
+    config = get_config_for_prefix("s3://mybucket")
+    config.stream_buffer_size = 1024 * 1024
+    stream = open_uri(config, "s3://mybucket/dir1/big.txt")
+    stream.size.should.equal(len(data))
+    stream.readline().should.equal("line 0\n")
+    stream.read().should.equal(data[len("line 0\n"):])
+    stream.close()
+
+    # reading a split starts at an offset with a range request
+    stream = open_uri(config, "s3://mybucket/dir1/big.txt", 1000)
+    stream.size.should.equal(len(data) - 1000)
+    stream.read().should.equal(data[1000:])
+    stream.close()
+
+@mock_s3
+def test_download_s3_uri_in_parts():
+    conn = boto.connect_s3()
+    bucket = conn.create_bucket('mybucket')
+    k = Key(bucket)
+    k.key = "dir1/big.txt"
+    data = "".join("line {}\n".format(i) for i in xrange(10000))
+    k.set_contents_from_string(data)
+
+    config = get_config_for_prefix("s3://mybucket")
+    config.s3_part_size = 1000
+    config.s3_download_concurrency = 1 # moto can mix up responses to concurrent requests
+    for threshold in (0, 1024):
+        config.s3_multipart_threshold = threshold
+        file_name = download(config, "s3://mybucket/dir1/big.txt")
+        try:
+            with open(file_name, "rb") as f:
+                f.read().should.equal(data)
+        finally:
+            cleanup("s3://mybucket/dir1/big.txt", file_name)
+
+class StubBucket(object):
+    """ serves range requests of a single key from memory like S3 does, records threads that made them """
+    def __init__(self, data, etag):
+        self.name = "mybucket"
+        self.data = data
+        self.etag = etag
+        self.threads = set()
+        self.requests = 0
+        self.methods = []
+        self.lock = threading.Lock()
+        self.on_request = None
+
+    def get_bucket(self, bucket_name, validate=True):
+        return self
+
+    def get_key(self, path):
+        self.methods.append("HEAD")
+        k = StubKey(self)
+        k.key = path
+        k.size = len(self.data)
+        k.etag = self.etag
+        return k
+
+class StubKey(object):
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.key = None
+
+    def open_read(self, headers=None):
+        """ like a GET without If-Match, size is the size of the whole key also for range requests """
+        self.body = BytesIO()
+        self.get_contents_to_file(self.body, headers or {})
+        self.body.seek(0)
+        self.size = len(self.bucket.data)
+        self.etag = self.bucket.etag
+
+    def read(self, size=-1):
+        return self.body.read(size)
+
+    def close(self, fast=False):
+        pass
+
+    def get_contents_to_file(self, f, headers=None):
+        bucket = self.bucket
+        with bucket.lock:
+            bucket.requests += 1
+            bucket.threads.add(threading.current_thread().ident)
+            if bucket.on_request is not None:
+                bucket.on_request(bucket)
+            bucket.methods.append("GET")
+            if headers.get("If-Match", bucket.etag) != bucket.etag:
+                raise S3ResponseError(412, "Precondition Failed")
+            if "Range" in headers:
+                start, end = [int(x) for x in headers["Range"][len("bytes="):].split("-")]
+                data = bucket.data[start:end + 1]
+            else:
+                data = bucket.data
+        time.sleep(0.01) # give other threads a chance to make their requests
+        f.write(data)
+
+def download_with_stub(bucket, config):
+    connect_s3, key_class = smr.uri.connect_s3, smr.uri.Key
+    smr.uri.connect_s3 = lambda config: bucket
+    smr.uri.Key = StubKey
+    fd, file_name = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        download_s3_key_ranges("mybucket", "big.txt", len(bucket.data), '"v1"', file_name, config)
+        with open(file_name, "rb") as f:
+            return f.read()
+    finally:
+        smr.uri.connect_s3, smr.uri.Key = connect_s3, key_class
+        os.unlink(file_name)
+
+def test_download_s3_key_ranges_concurrently():
+    data = b"".join(b"line {}\n".format(i) for i in xrange(10000))
+    config = get_config_for_prefix("s3://mybucket")
+    config.s3_part_size = 4096
+    config.s3_download_concurrency = 4
+    bucket = StubBucket(data, '"v1"')
+    download_with_stub(bucket, config).should.equal(data)
+    bucket.requests.should.equal((len(data) + 4095) // 4096)
+    len(bucket.threads).should.be.greater_than(1)
+
+def test_download_s3_key_ranges_of_changed_key():
+    data = b"x" * 100000
+    config = get_config_for_prefix("s3://mybucket")
+    config.s3_part_size = 4096
+    config.s3_download_concurrency = 4
+    bucket = StubBucket(data, '"v1"')
+    def overwrite(bucket):
+        # key is overwritten after a few parts were downloaded
+        if bucket.requests == 5:
+            bucket.data, bucket.etag = b"y" * 100000, '"v2"'
+    bucket.on_request = overwrite
+    download_with_stub.when.called_with(bucket, config).should.throw(IOError, "changed while it was being downloaded")
+
+def test_download_s3_uri_from_cache_without_get():
+    data = b"x" * 1000
+    config = get_config_for_prefix("s3://mybucket")
+    config.input_cache_dir = tempfile.mkdtemp()
+    bucket = StubBucket(data, '"v1"')
+    key_class = smr.uri.Key
+    smr.uri.Key = StubKey
+    try:
+        with stub_connect_s3(bucket):
+            for cache_status, methods in ((False, ["HEAD", "GET"]), (True, ["HEAD"])):
+                bucket.methods = []
+                file_name = download(config, "s3://mybucket/big.txt")
+                pop_cache_status(file_name).should.equal(cache_status)
+                with open(file_name, "rb") as f:
+                    f.read().should.equal(data)
+                cleanup("s3://mybucket/big.txt", file_name)
+                # cache hits only need etag of the key
+                bucket.methods.should.equal(methods)
+    finally:
+        smr.uri.Key = key_class
+        shutil.rmtree(config.input_cache_dir)
+
+def test_download_s3_uri_without_wasted_get():
+    config = get_config_for_prefix("s3://mybucket")
+    config.s3_part_size = 4096
+    config.s3_multipart_threshold = 4096
+    config.s3_download_concurrency = 2
+    key_class = smr.uri.Key
+    smr.uri.Key = StubKey
+    try:
+        # the first request asks for the first s3_multipart_threshold bytes only, the rest is downloaded in parts
+        for data, requests in ((b"x" * 1000, 1), (b"".join(b"line {}\n".format(i) for i in xrange(2000)), 1 + 4)):
+            bucket = StubBucket(data, '"v1"')
+            with stub_connect_s3(bucket):
+                file_name = download(config, "s3://mybucket/big.txt")
+                with open(file_name, "rb") as f:
+                    f.read().should.equal(data)
+                cleanup("s3://mybucket/big.txt", file_name)
+            bucket.methods.should.equal(["GET"] * requests)
+    finally:
+        smr.uri.Key = key_class
+
+@mock_s3
+def test_download_s3_uri_from_cache():
+    conn = boto.connect_s3()
+    bucket = conn.create_bucket('mybucket')
+    upload_file(bucket, "dir1/file1.csv")
+
+    config = get_config_for_prefix("s3://mybucket")
+    config.input_cache_dir = tempfile.mkdtemp()
+    try:
+        for cache_status in (False, True):
+            file_name = download(config, "s3://mybucket/dir1/file1.csv")
+            pop_cache_status(file_name).should.equal(cache_status)
+            with open(file_name, "rb") as f:
+                f.read().should.equal("dir1/file1.csv")
+            cleanup("s3://mybucket/dir1/file1.csv", file_name)
+
+        # changed files are downloaded again
+        bucket.get_key("dir1/file1.csv").set_contents_from_string("changed")
+        file_name = download(config, "s3://mybucket/dir1/file1.csv")
+        pop_cache_status(file_name).should.equal(False)
+        cleanup("s3://mybucket/dir1/file1.csv", file_name)
+    finally:
+        shutil.rmtree(config.input_cache_dir)
+
+@mock_s3
+def test_get_uris_by_date():
+    conn = boto.connect_s3()
+    bucket = conn.create_bucket('mybucket')
+    upload_file(bucket, "logs/2014/07/01/file1.csv")
+    upload_file(bucket, "logs/2014/07/02/a/file2.csv")
+    upload_file(bucket, "logs/2014/07/02/b/file3.csv")
+    upload_file(bucket, "logs/2014/07/03/file4.csv")
+
+    config = get_config_for_prefix("s3://mybucket/logs/{year}/{month:02d}/{day:02d}/")
+    config.end_date = datetime.date(2014, 7, 2)
+    config.date_range = 2
+    config.s3_list_threads = 1 # moto can mix up responses to concurrent requests
+    for split_depth in (0, 2):
+        config.s3_list_split_depth = split_depth
+        bytes_total, uris = get_uris(config)
+        sorted(uris).should.equal([
+            "s3://mybucket/logs/2014/07/01/file1.csv",
+            "s3://mybucket/logs/2014/07/02/a/file2.csv",
+            "s3://mybucket/logs/2014/07/02/b/file3.csv"
+        ])
+        bytes_total.should.equal(len("logs/2014/07/01/file1.csv") + len("logs/2014/07/02/a/file2.csv") + len("logs/2014/07/02/b/file3.csv"))
+
+@mock_s3
+def test_get_uris_from_listing_cache():
+    conn = boto.connect_s3()
+    bucket = conn.create_bucket('mybucket')
+    upload_file(bucket, "dir1/file1.csv")
+
+    config = get_config_for_prefix("s3://mybucket/dir1")
+    config.listing_cache_dir = tempfile.mkdtemp()
+    try:
+        get_uris(config)[1].should.equal(["s3://mybucket/dir1/file1.csv"])
+        upload_file(bucket, "dir1/file2.csv")
+        # listing is reused until it expires
+        get_uris(config)[1].should.equal(["s3://mybucket/dir1/file1.csv"])
+        config.listing_cache_ttl = -1
+        len(get_uris(config)[1]).should.equal(2)
+
+        # sub-prefixes are stored in the listing too
+        upload_file(bucket, "dir1/dir2/file3.csv")
+        config.listing_cache_ttl = 24 * 60 * 60
+        config.s3_list_split_depth = 1
+        config.INPUT_DATA = ["s3://mybucket/dir1/"]
+        for _ in xrange(2):
+            sorted(get_uris(config)[1]).should.equal(["s3://mybucket/dir1/dir2/file3.csv", "s3://mybucket/dir1/file1.csv", "s3://mybucket/dir1/file2.csv"])
+    finally:
+        shutil.rmtree(config.listing_cache_dir)
+
+class StubListedKey(object):
+    def __init__(self, name):
+        self.name = name
+        self.size = len(name)
+        self.etag = '"{}"'.format(name)
+
+class StubListingBucket(object):
+    """ lists keys of each prefix with a function that returns an iterable of keys, so that listing can block or fail midway """
+    def __init__(self, listings):
+        self.name = "mybucket"
+        self.listings = listings # prefix -> function that returns iterable of StubListedKey
+
+    def get_bucket(self, bucket_name, validate=True):
+        return self
+
+    def list(self, prefix="", delimiter=""):
+        return self.listings[prefix]()
+
+@contextmanager
+def stub_connect_s3(bucket):
+    connect_s3 = smr.uri.connect_s3
+    smr.uri.connect_s3 = lambda config: bucket
+    smr.uri.S3_BUCKETS.clear()
+    try:
+        yield
+    finally:
+        smr.uri.connect_s3 = connect_s3
+        smr.uri.S3_BUCKETS.clear()
+
+def get_streaming_config():
+    config = get_config_for_prefix("s3://mybucket/logs/{year}/{month:02d}/{day:02d}/")
+    config.end_date = datetime.date(2014, 7, 2)
+    config.date_range = 2
+    config.s3_list_threads = 2
+    config.stream_listing = True
+    return config
+
+def test_listing_threads_stop_when_consumer_stops():
+    bucket = StubListingBucket(dict(("prefix{}/".format(i), lambda: (StubListedKey("key{}".format(j)) for j in xrange(100))) for i in xrange(3)))
+    config = get_config_for_prefix("s3://mybucket/")
+    config.s3_list_threads = 3
+    queue_size, put_timeout = smr.uri.LISTING_QUEUE_SIZE, smr.uri.LISTING_PUT_TIMEOUT
+    smr.uri.LISTING_QUEUE_SIZE = 1
+    smr.uri.LISTING_PUT_TIMEOUT = 0.01
+    active_threads = threading.active_count()
+    try:
+        with stub_connect_s3(bucket):
+            keys = iter_s3_prefixes("mybucket", ["prefix0/", "prefix1/", "prefix2/"], "", config)
+            next(keys)
+            keys.close()
+            # threads that were blocked on the full queue exit instead of waiting for a consumer forever
+            for _ in xrange(100):
+                if threading.active_count() <= active_threads:
+                    break
+                time.sleep(0.05)
+            threading.active_count().should.equal(active_threads)
+    finally:
+        smr.uri.LISTING_QUEUE_SIZE, smr.uri.LISTING_PUT_TIMEOUT = queue_size, put_timeout
+
+def test_stream_listing_queues_files_before_listing_is_done():
+    release = threading.Event()
+    def slow_listing():
+        yield StubListedKey("logs/2014/07/01/file1.csv")
+        release.wait(5)
+        yield StubListedKey("logs/2014/07/01/file2.csv")
+    bucket = StubListingBucket({
+        "logs/2014/07/01/": slow_listing,
+        "logs/2014/07/02/": lambda: [StubListedKey("logs/2014/07/02/file3.csv")]
+    })
+    input_queue = Queue()
+    abort_event = threading.Event()
+    with stub_connect_s3(bucket):
+        listing_done = start_listing(get_streaming_config(), input_queue, abort_event)
+        try:
+            # files that were listed so far are queued while the other prefix is still being listed
+            uris = set([input_queue.get(timeout=5), input_queue.get(timeout=5)])
+            uris.should.equal(set(["s3://mybucket/logs/2014/07/01/file1.csv", "s3://mybucket/logs/2014/07/02/file3.csv"]))
+            listing_done.is_set().should.equal(False)
+        finally:
+            release.set()
+        listing_done.wait(5).should.equal(True)
+    input_queue.get(timeout=5).should.equal("s3://mybucket/logs/2014/07/01/file2.csv")
+    abort_event.is_set().should.equal(False)
+
+def test_stream_listing_error_aborts_job():
+    def failing_listing():
+        yield StubListedKey("logs/2014/07/01/file1.csv")
+        raise S3ResponseError(500, "Internal Error")
+    bucket = StubListingBucket({
+        "logs/2014/07/01/": failing_listing,
+        "logs/2014/07/02/": lambda: [StubListedKey("logs/2014/07/02/file3.csv")]
+    })
+    abort_event = threading.Event()
+    with stub_connect_s3(bucket):
+        listing_done = start_listing(get_streaming_config(), Queue(), abort_event)
+        listing_done.wait(5).should.equal(True)
+    abort_event.is_set().should.equal(True)
+    get_param("messages")[-1].should.contain("could not list files to process")
+
+@mock_s3
+def test_download_s3_uri_requests():
+    conn = boto.connect_s3()
+    bucket = conn.create_bucket('mybucket')
+    upload_file(bucket, "dir1/file1.csv")
+    k = Key(bucket)
+    k.key = "dir1/big.txt"
+    data = "".join("line {}\n".format(i) for i in xrange(10000))
+    k.set_contents_from_string(data)
+
+    config = get_config_for_prefix("s3://mybucket")
+    config.s3_part_size = 10000
+    config.s3_multipart_threshold = 20000
+    config.s3_download_concurrency = 1
+    cache_dir = tempfile.mkdtemp()
+    smr.uri.S3_BUCKETS.clear()
+    smr.uri.get_s3_bucket("mybucket", config) # bucket is checked once per process
+    methods = []
+    make_request = boto.s3.connection.S3Connection.make_request
+    def record_request(self, method, *args, **kwargs):
+        methods.append(method)
+        return make_request(self, method, *args, **kwargs)
+    boto.s3.connection.S3Connection.make_request = record_request
+    try:
+        for uri, contents in (("s3://mybucket/dir1/file1.csv", "dir1/file1.csv"), ("s3://mybucket/dir1/big.txt", data)):
+            for input_cache_dir in (None, cache_dir):
+                config.input_cache_dir = input_cache_dir
+                file_name = download(config, uri)
+                with open(file_name, "rb") as f:
+                    f.read().should.equal(contents)
+                cleanup(uri, file_name)
+        # without input cache small files take a single request, with it etag is got with HEAD first
+        # so that cache hits don't start a GET
+        methods[:2].should.equal(["GET", "HEAD"])
+        methods.count("HEAD").should.equal(2)
+    finally:
+        boto.s3.connection.S3Connection.make_request = make_request
+        shutil.rmtree(cache_dir)